@@ -0,0 +1,323 @@
+"""
+Host analytics: occupancy, revenue, lead time and ratings per listing.
+
+A report covers the nights from ``start`` to ``end``, both inclusive:
+
+- ``nights_booked`` counts the nights of the window some booking holds;
+  ``occupancy_rate`` divides it by the nights on offer.
+- ``bookings`` counts the bookings checking in within the window. Their
+  Success payments make up ``revenue`` (per currency) and their average
+  days between booking and check-in is ``lead_time_days``.
+- ``rating_avg`` averages the reviews written within the window.
+
+Besides the per-listing figures and their totals, a report has a series
+per day, ISO week or month: bookings and revenue by check-in date,
+reviews by the date they were written, nights by the night.
+
+The live report aggregates in the database with six queries however many
+listings and bookings the host has: the listings, then per-listing and
+per-period aggregates of bookings (with their payments) and of reviews.
+Nights per period are one conditional sum per period in a single query.
+
+Hosts with ANALYTICS_ROLLUP_MIN_LISTINGS listings or more are read from
+ListingDailyStats instead when the window lies within the days the
+rollup covers: three queries over a row per listing and active day,
+rebuilt every ANALYTICS_ROLLUP_INTERVAL minutes by ``refresh_rollup``.
+Such a report is as fresh as the last refresh.
+"""
+
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, DateField, F, Q, Sum, Value
+from django.db.models.functions import Greatest, Least, Trunc, TruncDate
+from django.utils import timezone
+
+from .models import Booking, Listing, ListingDailyStats, Review
+
+INTERVALS = ('day', 'week', 'month')
+LIVE = 'live'
+ROLLUP = 'rollup'
+
+# Days the rollup was last rebuilt for, and when
+COVERAGE_KEY = 'listings:analytics:rollup'
+
+CENTS = Decimal('0.01')
+
+
+def truncate(day, interval):
+    """The first day of the period ``day`` falls in, as Trunc computes it."""
+    if interval == 'week':
+        return day - timedelta(days=day.weekday())
+    if interval == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def periods(start, end, interval):
+    """(period, first night, night after the last) of each period, clipped to [start, end]."""
+    result = []
+    first = start
+    while first <= end:
+        period = truncate(first, interval)
+        if interval == 'week':
+            after = period + timedelta(days=7)
+        elif interval == 'month':
+            after = (period + timedelta(days=31)).replace(day=1)
+        else:
+            after = period + timedelta(days=1)
+        result.append((period, first, min(after, end + timedelta(days=1))))
+        first = after
+    return result
+
+
+def _days(duration):
+    return round(duration.total_seconds() / 86400) if duration else 0
+
+
+def _nights_between(first, after):
+    """Nights a booking holds in [first, after), as a duration; only meaningful where they overlap."""
+    return Least('check_out', Value(after)) - Greatest('check_in', Value(first))
+
+
+def _lead_time():
+    return F('check_in') - TruncDate('created_at')
+
+
+def _period(field, interval):
+    """``field`` (a DateField) truncated to the interval; days need no truncation."""
+    return F(field) if interval == 'day' else Trunc(field, interval)
+
+
+def _midnight(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+class Figures:
+    """Sums for one listing or period, turned into rates by ``as_dict``."""
+
+    def __init__(self):
+        self.nights_booked = self.bookings = self.lead_days = self.reviews = self.rating_sum = 0
+        self.revenue = defaultdict(Decimal)
+
+    def add(self, nights_booked=0, bookings=0, lead_days=0, revenue=None, currency=None, reviews=0, rating_sum=0):
+        self.nights_booked += nights_booked
+        self.bookings += bookings
+        self.lead_days += lead_days
+        if revenue:
+            self.revenue[currency] += revenue
+        self.reviews += reviews
+        self.rating_sum += rating_sum
+
+    def merge(self, other):
+        self.add(other.nights_booked, other.bookings, other.lead_days, reviews=other.reviews, rating_sum=other.rating_sum)
+        for currency, amount in other.revenue.items():
+            self.revenue[currency] += amount
+
+    def as_dict(self, nights):
+        return {
+            'nights': nights,
+            'nights_booked': self.nights_booked,
+            'occupancy_rate': round(self.nights_booked / nights, 4) if nights else None,
+            'bookings': self.bookings,
+            'revenue': {currency: str(amount.quantize(CENTS)) for currency, amount in sorted(self.revenue.items())},
+            'lead_time_days': round(self.lead_days / self.bookings, 1) if self.bookings else None,
+            'reviews': self.reviews,
+            'rating_avg': round(self.rating_sum / self.reviews, 2) if self.reviews else None,
+        }
+
+
+class Report:
+    def __init__(self, host, start, end, interval='day'):
+        self.host = host
+        self.start, self.end, self.interval = start, end, interval
+        self.periods = periods(start, end, interval)
+        self.by_listing = defaultdict(Figures)
+        self.by_period = defaultdict(Figures)
+        self.listings = []
+        self.source = LIVE
+        self.refreshed_at = None
+
+    @property
+    def nights(self):
+        return (self.end - self.start).days + 1
+
+    def load(self, source=None):
+        """
+        Run the report's queries; ``source`` forces LIVE or ROLLUP, by default
+        large hosts use the rollup when it covers the window.
+        """
+        self.listings = list(Listing.objects.filter(host=self.host).order_by('pk').values_list('pk', 'title'))
+        if not self.listings:
+            return self
+        coverage = cache.get(COVERAGE_KEY)
+        covered = coverage is not None and coverage[0] <= self.start and self.end <= coverage[1]
+        if source is None:
+            large = len(self.listings) >= settings.ANALYTICS_ROLLUP_MIN_LISTINGS
+            source = ROLLUP if large and covered else LIVE
+        self.source = source
+        if source == ROLLUP:
+            self.refreshed_at = coverage[2] if coverage is not None else None
+            self._load_rollup()
+        else:
+            self._load_live()
+        return self
+
+    def _load_live(self):
+        after = self.end + timedelta(days=1)
+        checked_in = Q(check_in__gte=self.start, check_in__lte=self.end)
+        paid = checked_in & Q(payment__status='Success')
+        bookings = Booking.objects.filter(listing__host=self.host).order_by()
+
+        for row in bookings.overlapping(self.start, after).values('listing_id', 'currency').annotate(
+            nights=Sum(_nights_between(self.start, after)),
+            count=Count('pk', filter=checked_in),
+            lead=Sum(_lead_time(), filter=checked_in),
+            revenue=Sum('payment__amount', filter=paid),
+        ):
+            self.by_listing[row['listing_id']].add(
+                _days(row['nights']), row['count'], _days(row['lead']), row['revenue'], row['currency'],
+            )
+
+        for row in bookings.filter(checked_in).annotate(period=_period('check_in', self.interval)).values(
+            'period', 'currency',
+        ).annotate(
+            count=Count('pk'), lead=Sum(_lead_time()), revenue=Sum('payment__amount', filter=Q(payment__status='Success')),
+        ):
+            self.by_period[row['period']].add(
+                bookings=row['count'], lead_days=_days(row['lead']), revenue=row['revenue'], currency=row['currency'],
+            )
+
+        nights = bookings.overlapping(self.start, after).aggregate(**{
+            f'p{index}': Sum(_nights_between(first, after), filter=Q(check_in__lt=after, check_out__gt=first))
+            for index, (_, first, after) in enumerate(self.periods)
+        })
+        for index, (period, _, _) in enumerate(self.periods):
+            self.by_period[period].add(nights_booked=_days(nights[f'p{index}']))
+
+        reviews = Review.objects.filter(
+            listing__host=self.host, created_at__gte=_midnight(self.start), created_at__lt=_midnight(after),
+        ).order_by()
+        for row in reviews.values('listing_id').annotate(count=Count('pk'), total=Sum('rating')):
+            self.by_listing[row['listing_id']].add(reviews=row['count'], rating_sum=row['total'])
+        for row in reviews.annotate(
+            period=Trunc('created_at', self.interval, output_field=DateField()),
+        ).values('period').annotate(count=Count('pk'), total=Sum('rating')):
+            self.by_period[row['period']].add(reviews=row['count'], rating_sum=row['total'])
+
+    def _load_rollup(self):
+        sums = {
+            'nights_booked': Sum('nights_booked'), 'bookings': Sum('bookings'), 'lead_days': Sum('lead_days'),
+            'revenue': Sum('revenue'), 'reviews': Sum('reviews'), 'rating_sum': Sum('rating_sum'),
+        }
+        rows = ListingDailyStats.objects.filter(
+            listing__host=self.host, day__gte=self.start, day__lte=self.end,
+        ).order_by()
+        for row in rows.values('listing_id', 'currency').annotate(**sums):
+            self.by_listing[row.pop('listing_id')].add(**row)
+        for row in rows.annotate(period=_period('day', self.interval)).values('period', 'currency').annotate(**sums):
+            self.by_period[row.pop('period')].add(**row)
+
+    def as_dict(self):
+        totals = Figures()
+        listings = []
+        for pk, title in self.listings:
+            figures = self.by_listing[pk]
+            totals.merge(figures)
+            listings.append({'id': pk, 'title': title, **figures.as_dict(self.nights)})
+        return {
+            'start': self.start,
+            'end': self.end,
+            'interval': self.interval,
+            'source': self.source,
+            'refreshed_at': self.refreshed_at,
+            'totals': {'listings': len(self.listings), **totals.as_dict(self.nights * len(self.listings))},
+            'listings': listings,
+            'series': [
+                {'period': period, **self.by_period[period].as_dict((after - first).days * len(self.listings))}
+                for period, first, after in self.periods
+            ],
+        }
+
+
+def rollup_window(today=None):
+    """(first day, last day) the rollup job rebuilds."""
+    today = today or timezone.localdate()
+    return (
+        today - timedelta(days=settings.ANALYTICS_ROLLUP_PAST_DAYS),
+        today + timedelta(days=settings.ANALYTICS_ROLLUP_FUTURE_DAYS),
+    )
+
+
+def build_rollup(listings, first, last):
+    """ListingDailyStats rows of ``listings`` ((pk, currency) pairs) for the days [first, last]."""
+    currencies = dict(listings)
+    after = last + timedelta(days=1)
+    rows = defaultdict(lambda: defaultdict(int))
+    bookings = Booking.objects.filter(listing_id__in=currencies).order_by()
+
+    stays = bookings.overlapping(first, after).values_list('listing_id', 'currency', 'check_in', 'check_out')
+    for listing_id, currency, check_in, check_out in stays.iterator(chunk_size=10000):
+        night, stop = max(check_in, first), min(check_out, after)
+        while night < stop:
+            rows[listing_id, night, currency]['nights_booked'] += 1
+            night += timedelta(days=1)
+
+    for row in bookings.filter(check_in__gte=first, check_in__lte=last).values(
+        'listing_id', 'check_in', 'currency',
+    ).annotate(
+        count=Count('pk'), lead=Sum(_lead_time()), revenue=Sum('payment__amount', filter=Q(payment__status='Success')),
+    ):
+        stats = rows[row['listing_id'], row['check_in'], row['currency']]
+        stats['bookings'] = row['count']
+        stats['lead_days'] = _days(row['lead'])
+        stats['revenue'] = row['revenue'] or 0
+
+    for row in Review.objects.filter(
+        listing_id__in=currencies, created_at__gte=_midnight(first), created_at__lt=_midnight(after),
+    ).order_by().annotate(day=TruncDate('created_at')).values('listing_id', 'day').annotate(
+        count=Count('pk'), total=Sum('rating'),
+    ):
+        stats = rows[row['listing_id'], row['day'], currencies[row['listing_id']]]
+        stats['reviews'] = row['count']
+        stats['rating_sum'] = row['total']
+
+    return [
+        ListingDailyStats(listing_id=listing_id, day=day, currency=currency, **stats)
+        for (listing_id, day, currency), stats in rows.items()
+    ]
+
+
+def refresh_rollup(first=None, last=None, chunk_size=None):
+    """
+    Rebuild the ListingDailyStats of every listing for the days [first,
+    last] (by default ``rollup_window()``), chunk_size listings per
+    transaction. Returns the number of rows written.
+    """
+    if first is None or last is None:
+        first, last = rollup_window()
+    chunk_size = chunk_size or settings.ANALYTICS_ROLLUP_CHUNK
+    written = 0
+    position = 0
+    while True:
+        listings = list(
+            Listing.objects.filter(pk__gt=position).order_by('pk').values_list('pk', 'currency')[:chunk_size]
+        )
+        if not listings:
+            break
+        position = listings[-1][0]
+        with transaction.atomic():
+            ListingDailyStats.objects.filter(
+                listing_id__in=[pk for pk, _ in listings], day__gte=first, day__lte=last,
+            ).delete()
+            rows = ListingDailyStats.objects.bulk_create(
+                build_rollup(listings, first, last), batch_size=settings.BULK_IMPORT_BATCH_SIZE,
+            )
+        written += len(rows)
+    # Forgotten when two runs in a row are missed, so reports fall back to live
+    cache.set(COVERAGE_KEY, (first, last, timezone.now()), timeout=settings.ANALYTICS_ROLLUP_INTERVAL * 60 * 2)
+    return written
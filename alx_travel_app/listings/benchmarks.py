@@ -0,0 +1,978 @@
+"""
+Benchmark scenarios for the listings app.
+
+Each scenario seeds the data it needs and writes its timings to stdout.
+Run them with ``python manage.py benchmark <scenario>``, which executes the
+scenario inside a throwaway test database.
+"""
+
+import json
+import math
+import random
+import statistics
+import tempfile
+from io import StringIO
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from decimal import Decimal
+from functools import partial
+from unittest import mock
+
+import requests
+from celery import current_app
+from celery.contrib.testing.worker import start_worker
+from celery.signals import task_postrun, task_prerun
+from django.contrib.auth import get_user_model
+from django.core import mail as outbox
+from django.core.management import call_command
+from django.db import OperationalError, connection, transaction
+from django.core.cache import cache
+from django.test import modify_settings, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db.models import Exists, F, OuterRef
+from django.db.models.functions import ASin, Cos, Power, Radians, Sin, Sqrt
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from . import analytics
+from . import geo
+from . import mail
+from . import occupancy
+from . import pricing
+from .chapa import ChapaClient
+from .chapa_stub import StubChapaServer
+from .models import (
+    Listing, ListingCalendar, Booking, BookingConflict, Payment, PricingRule, Review, StayDiscount,
+)
+from .renderers import FastJSONRenderer
+from .serializers import BookingSerializer, FieldPlan, ListingSerializer
+from .reconcile import Reconciliation
+from . import search as listing_search
+from .tasks import initiate_chapa_payment, send_payment_confirmation_email
+
+User = get_user_model()
+
+# Days of history seeded by ``host_analytics``
+ANALYTICS_PAST_DAYS = 400
+
+SCENARIOS = {}
+
+
+def scenario(name):
+    """Register a benchmark under ``name``."""
+    def register(func):
+        SCENARIOS[name] = func
+        return func
+    return register
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of ``samples`` (seconds)."""
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def report(stdout, label, samples):
+    """Write p50/p95/mean latency in milliseconds for ``samples``."""
+    stdout.write(
+        f"{label}: n={len(samples)} "
+        f"p50={percentile(samples, 50) * 1000:.2f}ms "
+        f"p95={percentile(samples, 95) * 1000:.2f}ms "
+        f"mean={statistics.fmean(samples) * 1000:.2f}ms"
+    )
+
+
+def timed(func, repeat):
+    """Call ``func`` ``repeat`` times and return the wall time of each call."""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def seed_listings(count, host=None, batch_size=5000):
+    """Bulk insert ``count`` bare listings owned by ``host``."""
+    host = host or User.objects.create(username=f"bench_host_{time.time_ns()}")
+    Listing.objects.bulk_create(
+        (
+            Listing(
+                title=f"Listing {i}",
+                description="Benchmark listing",
+                location=f"City {i % 50}",
+                price_per_night=50 + i % 150,
+                host=host,
+            )
+            for i in range(count)
+        ),
+        batch_size=batch_size,
+    )
+    return list(Listing.objects.filter(host=host).values_list('pk', flat=True))
+
+
+@scenario('availability')
+def availability(stdout, size=100_000, repeat=200):
+    """Latency of GET /api/listings/available/ over ``size`` seeded bookings."""
+    rng = random.Random(42)
+    guest = User.objects.create(username="bench_guest")
+    listing_ids = seed_listings(max(1, size // 100))
+    prices = dict(Listing.objects.values_list('pk', 'price_per_night'))
+    start = date.today()
+
+    def stays():
+        per_listing = -(-size // len(listing_ids))
+        made = 0
+        for listing_id in listing_ids:
+            day = start + timedelta(days=rng.randint(0, 3))
+            for _ in range(per_listing):
+                if made == size:
+                    return
+                nights = rng.randint(1, 5)
+                yield Booking(
+                    listing_id=listing_id, guest=guest,
+                    check_in=day, check_out=day + timedelta(days=nights),
+                    total_price=prices[listing_id] * nights,
+                )
+                day += timedelta(days=nights + rng.randint(0, 4))
+                made += 1
+
+    Booking.objects.bulk_create(stays(), batch_size=5000)
+    stdout.write(f"seeded {len(listing_ids)} listings / {Booking.objects.count()} bookings")
+
+    client = APIClient()
+    horizon = (Booking.objects.order_by('-check_out').values_list('check_out', flat=True).first() - start).days
+
+    def search():
+        check_in = start + timedelta(days=rng.randint(0, horizon))
+        check_out = check_in + timedelta(days=rng.randint(1, 7))
+        response = client.get('/api/listings/available/', {
+            'check_in': check_in.isoformat(), 'check_out': check_out.isoformat(),
+        })
+        assert response.status_code == 200, response.content
+
+    report(stdout, "availability search", timed(search, repeat))
+
+
+# Times an attempt that lost a lock race is run again before it counts as locked out
+LOCK_RETRIES = 20
+
+
+def book_concurrently(listing_ids, guest, threads=16, attempts=50, seed=0):
+    """
+    Race ``threads`` writers booking random stays on ``listing_ids``.
+
+    Every attempt goes through ``Booking.objects.reserve`` in its own
+    transaction. SQLite ignores SELECT ... FOR UPDATE, so there writers
+    collide on the database (a table, for shared-cache in-memory test
+    databases) instead and the loser gets a "locked" error; such attempts
+    are run again, up to LOCK_RETRIES times, as are MySQL's deadlocks.
+    Returns ``(created, conflicts, locked_out, elapsed_seconds)``.
+    """
+    start = date.today()
+
+    def book(listing, check_in, check_out):
+        with transaction.atomic():
+            Booking.objects.reserve(listing, check_in, check_out)
+            Booking.objects.create(
+                listing_id=listing.pk, guest=guest, check_in=check_in, check_out=check_out,
+            )
+
+    def worker(n):
+        rng = random.Random(seed + n)
+        created = conflicts = locked_out = 0
+        try:
+            for _ in range(attempts):
+                listing = Listing(pk=rng.choice(listing_ids))
+                check_in = start + timedelta(days=rng.randint(0, 60))
+                check_out = check_in + timedelta(days=rng.randint(1, 5))
+                for retry in range(LOCK_RETRIES + 1):
+                    try:
+                        book(listing, check_in, check_out)
+                        created += 1
+                    except BookingConflict:
+                        conflicts += 1
+                    except OperationalError as exc:
+                        if 'lock' not in str(exc).lower():
+                            raise
+                        if retry < LOCK_RETRIES:
+                            time.sleep(rng.uniform(0, 0.005) * (retry + 1))
+                            continue
+                        locked_out += 1
+                    break
+        finally:
+            connection.close()
+        return created, conflicts, locked_out
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(worker, range(threads)))
+    elapsed = time.perf_counter() - started
+    created, conflicts, locked_out = (sum(column) for column in zip(*results))
+    return created, conflicts, locked_out, elapsed
+
+
+def count_double_bookings():
+    """Number of bookings that share a night with another booking of the same listing."""
+    clash = Booking.objects.filter(listing=OuterRef('listing')).exclude(pk=OuterRef('pk')).filter(
+        check_in__lt=OuterRef('check_out'), check_out__gt=OuterRef('check_in'),
+    )
+    return Booking.objects.filter(Exists(clash)).count()
+
+
+@scenario('booking_stress')
+def booking_stress(stdout, size=100, repeat=50, threads=16):
+    """Concurrent booking throughput on one hot listing vs ``size`` listings."""
+    guest = User.objects.create(username="bench_guest")
+    hot = seed_listings(1)
+    spread = seed_listings(size)
+    for label, listing_ids in (("one listing", hot), (f"{size} listings", spread)):
+        created, conflicts, locked_out, elapsed = book_concurrently(listing_ids, guest, threads, repeat)
+        stdout.write(
+            f"{label}: threads={threads} attempts={threads * repeat} created={created} "
+            f"conflicts={conflicts} locked_out={locked_out} bookings/sec={created / elapsed:.1f} "
+            f"attempts/sec={threads * repeat / elapsed:.1f}"
+        )
+    stdout.write(f"double bookings detected: {count_double_bookings()}")
+
+
+@scenario('pagination')
+def pagination(stdout, size=1_000_000, repeat=50, page_size=20):
+    """Latency and peak memory of cursor page 1 vs page 1000 over ``size`` listings."""
+    seed_listings(size)
+    stdout.write(f"seeded {Listing.objects.count()} listings")
+    client = APIClient()
+    first = f'/api/listings/?page_size={page_size}'
+
+    url = first
+    for _ in range(999):
+        url = client.get(url).data['next']
+    deep = url
+
+    for label, target in (("cursor page 1", first), ("cursor page 1000", deep)):
+        report(stdout, label, timed(lambda: client.get(target), repeat))
+        tracemalloc.start()
+        client.get(target)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        stdout.write(f"{label}: peak memory {peak / 1024:.1f} KiB")
+
+    newest = Listing.objects.order_by('-created_at', '-id')
+    offset = 999 * page_size
+    report(stdout, "OFFSET page 1000 (ORM only)", timed(lambda: list(newest[offset:offset + page_size]), repeat))
+
+
+@scenario('seed')
+def seed(stdout, size=1_000_000, repeat=1, workers=4):
+    """Rows/sec of the bulk ``seed`` command for ``size`` bookings."""
+    for _ in range(repeat):
+        call_command(
+            'seed', users=1000, listings=max(1, size // 100), bookings=size,
+            reviews=size // 10, payments=size // 2, workers=workers, seed=42, stdout=stdout,
+        )
+
+
+@scenario('chapa_pool')
+def chapa_pool(stdout, size=0, repeat=500):
+    """Pooled ChapaClient vs a fresh ``requests.get`` per call, against the local stub."""
+    with StubChapaServer() as stub:
+        client = ChapaClient(stub.base_url, "bench-key")
+        report(stdout, "pooled session", timed(lambda: client.verify("tx-bench"), repeat))
+        pooled_connections = stub.connections
+        url = f"{stub.base_url}/transaction/verify/tx-bench"
+        report(stdout, "unpooled requests.get", timed(lambda: requests.get(url, timeout=10), repeat))
+        client.close()
+    stdout.write(f"TCP connections: pooled={pooled_connections} unpooled={stub.connections - pooled_connections}")
+
+
+@scenario('payment_async')
+def payment_async(stdout, size=0, repeat=80, workers=8, gateway_delay=0.5):
+    """
+    Initiation throughput of ``workers`` web threads against a slow gateway,
+    sync vs async. Async hands the Chapa call to a simulated Celery pool of
+    the same size, so end-to-end completion is reported too.
+    """
+    guest = User.objects.create(username="bench_guest", email="guest@example.com")
+    listing_ids = seed_listings(1)
+
+    def bookings(count, offset):
+        return [
+            Booking.objects.create(
+                listing_id=listing_ids[0], guest=guest,
+                check_in=date.today() + timedelta(days=offset + 2 * i),
+                check_out=date.today() + timedelta(days=offset + 2 * i + 1),
+            ).pk
+            for i in range(count)
+        ]
+
+    def run(booking_ids, async_mode):
+        def worker(chunk):
+            client = APIClient()
+            client.force_authenticate(guest)
+            try:
+                for booking_id in chunk:
+                    response = client.post('/api/payments/initiate/', {
+                        'booking_id': booking_id, 'async': async_mode,
+                    }, format='json')
+                    assert response.status_code in (201, 202), response.data
+            finally:
+                connection.close()
+
+        chunks = [booking_ids[i::workers] for i in range(workers)]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as web:
+            list(web.map(worker, chunks))
+        return time.perf_counter() - started
+
+    with StubChapaServer(delay=gateway_delay) as stub, override_settings(CHAPA_BASE_URL=stub.base_url):
+        elapsed = run(bookings(repeat, 0), False)
+        stdout.write(f"sync: {repeat} requests in {elapsed:.2f}s ({repeat / elapsed:.1f} req/s)")
+
+        celery_pool = ThreadPoolExecutor(max_workers=workers)
+        queue = lambda *args: celery_pool.submit(initiate_chapa_payment.apply, args=args)
+        with mock.patch.object(initiate_chapa_payment, 'delay', side_effect=queue):
+            started = time.perf_counter()
+            elapsed = run(bookings(repeat, 2 * repeat), True)
+            stdout.write(f"async: {repeat} requests in {elapsed:.2f}s ({repeat / elapsed:.1f} req/s)")
+            celery_pool.shutdown(wait=True)
+            total = time.perf_counter() - started
+        ready = Payment.objects.exclude(checkout_url='').count() - repeat
+        stdout.write(f"async: {ready} checkout URLs ready after {total:.2f}s (gateway delay {gateway_delay}s)")
+
+
+@scenario('webhook_replay')
+def webhook_replay(stdout, size=200, repeat=20, threads=8):
+    """Callback latency for ``size`` payments each delivered ``repeat`` times by ``threads`` senders."""
+    guest = User.objects.create(username="bench_guest")
+    listing_id = seed_listings(1)[0]
+    start = date.today()
+    Booking.objects.bulk_create(
+        Booking(listing_id=listing_id, guest=guest, total_price=100,
+                check_in=start + timedelta(days=2 * i), check_out=start + timedelta(days=2 * i + 1))
+        for i in range(size)
+    )
+    Payment.objects.bulk_create(
+        Payment(booking_id=booking_id, amount=100, transaction_id=f"replay-{booking_id}")
+        for booking_id in Booking.objects.values_list('pk', flat=True)
+    )
+    deliveries = [f"replay-{pk}" for pk in Booking.objects.values_list('pk', flat=True)] * repeat
+    random.Random(7).shuffle(deliveries)
+
+    def sender(chunk):
+        client = APIClient()
+        samples = []
+        try:
+            for tx_ref in chunk:
+                started = time.perf_counter()
+                response = client.post('/api/payments/callback/', {'tx_ref': tx_ref, 'status': 'success'})
+                samples.append((response.data['status'], time.perf_counter() - started))
+        finally:
+            connection.close()
+        return samples
+
+    with mock.patch('listings.views.send_payment_confirmation_email') as send_email:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            samples = [s for chunk in pool.map(sender, [deliveries[i::threads] for i in range(threads)]) for s in chunk]
+        elapsed = time.perf_counter() - started
+
+    report(stdout, "first delivery", [t for kind, t in samples if kind == 'received'])
+    report(stdout, "replayed delivery", [t for kind, t in samples if kind == 'duplicate'])
+    stdout.write(
+        f"{len(deliveries)} deliveries in {elapsed:.2f}s ({len(deliveries) / elapsed:.0f}/s); "
+        f"settled={Payment.objects.filter(status='Success').count()} emails queued={send_email.delay.call_count}"
+    )
+
+
+@scenario('email_batch')
+def email_batch(stdout, size=2000, repeat=1, batch=100):
+    """Confirmation emails/sec sent one by one versus in batches of ``batch``."""
+    guest = User.objects.create(username="bench_guest", email="guest@example.com")
+    listing_id = seed_listings(1)[0]
+    start = date.today()
+    Booking.objects.bulk_create(
+        Booking(listing_id=listing_id, guest=guest, total_price=100,
+                check_in=start + timedelta(days=2 * i), check_out=start + timedelta(days=2 * i + 1))
+        for i in range(size)
+    )
+    Payment.objects.bulk_create(
+        Payment(booking_id=booking_id, amount=100, transaction_id=f"mail-{booking_id}", status='Success')
+        for booking_id in Booking.objects.values_list('pk', flat=True)
+    )
+    items = [(mail.PAYMENT, pk) for pk in Payment.objects.values_list('pk', flat=True)]
+
+    def one_by_one():
+        # What the tasks used to do: a lookup and a fresh connection per message
+        for item in items:
+            mail.send_batch(mail.load_messages([item]))
+
+    def batched():
+        # What the tasks do: store each confirmation, then flush the batches
+        for kind, pk in items:
+            mail.queue(kind, pk)
+        mail.flush(batch)
+
+    with tempfile.TemporaryDirectory() as directory:
+        backends = {
+            'locmem': {'EMAIL_BACKEND': 'django.core.mail.backends.locmem.EmailBackend'},
+            'file': {'EMAIL_BACKEND': 'django.core.mail.backends.filebased.EmailBackend', 'EMAIL_FILE_PATH': directory},
+        }
+        for backend, overrides in backends.items():
+            for label, send in (("one by one", one_by_one), (f"batches of {batch}", batched)):
+                with override_settings(**overrides):
+                    outbox.outbox = []
+                    with CaptureQueriesContext(connection) as queries:
+                        elapsed = min(timed(send, repeat))
+                stdout.write(
+                    f"{backend} {label}: {size} emails in {elapsed:.2f}s "
+                    f"({size / elapsed:,.0f}/s, {len(queries) // repeat} queries)"
+                )
+
+
+def drain_queue(app, queue, expected, **worker_options):
+    """
+    Run an in-process worker on ``queue`` until ``expected`` tasks finished;
+    returns tasks/sec. The solo pool stands in for one prefork child (the
+    thread pool stalls on the memory transport whenever its prefetch is full).
+    """
+    lock = threading.Lock()
+    finished = threading.Event()
+    stamps = {'first': None, 'last': None, 'done': 0}
+
+    def started(**kwargs):
+        with lock:
+            stamps['first'] = stamps['first'] or time.perf_counter()
+
+    def done(**kwargs):
+        with lock:
+            stamps['done'] += 1
+            stamps['last'] = time.perf_counter()
+            if stamps['done'] == expected:
+                finished.set()
+
+    task_prerun.connect(started, weak=False)
+    task_postrun.connect(done, weak=False)
+    try:
+        with start_worker(app, pool='solo', perform_ping_check=False, queues=[queue], **worker_options):
+            finished.wait(600)
+    finally:
+        task_prerun.disconnect(started)
+        task_postrun.disconnect(done)
+    return stamps['done'] / (stamps['last'] - stamps['first'])
+
+
+@scenario('celery_throughput')
+def celery_throughput(stdout, size=500, repeat=1):
+    """Tasks/sec of one worker process per queue, through an in-memory broker."""
+    guest = User.objects.create(username="bench_guest", email="guest@example.com")
+    listing_id = seed_listings(1)[0]
+    start = date.today()
+    Booking.objects.bulk_create(
+        Booking(listing_id=listing_id, guest=guest, total_price=100,
+                check_in=start + timedelta(days=2 * i), check_out=start + timedelta(days=2 * i + 1))
+        for i in range(size)
+    )
+    Payment.objects.bulk_create(
+        Payment(booking_id=booking_id, amount=100, transaction_id=f"celery-{booking_id}")
+        for booking_id in Booking.objects.values_list('pk', flat=True)
+    )
+    payments = list(Payment.objects.values_list('pk', 'transaction_id'))
+
+    queues = {
+        'email': lambda: [send_payment_confirmation_email.delay(pk) for pk, _ in payments],
+        'payments': lambda: [initiate_chapa_payment.delay(pk, {'tx_ref': tx_ref}) for pk, tx_ref in payments],
+    }
+    # Rate limits are off: the embedded worker only services their timer
+    # every couple of seconds, which would swamp the measurement
+    profiles = [("prefetch 1", 1), ("prefetch 16", 16)]
+
+    app = current_app._get_current_object()
+    # Settings loaded from Django keep their CELERY_ prefix in app.conf
+    overrides = {
+        'CELERY_BROKER_URL': 'memory://',
+        'CELERY_TASK_ALWAYS_EAGER': False,
+        # The memory transport polls; the default interval would dominate the timings
+        'CELERY_BROKER_TRANSPORT_OPTIONS': {'polling_interval': 0.001},
+    }
+    previous = {key: app.conf[key] for key in overrides}
+    app.conf.update(overrides)
+    try:
+        # Full batches are sent by the task that fills them; the scheduled
+        # flushes of the rest are due after the run and left to mail.flush()
+        with StubChapaServer() as stub, override_settings(CHAPA_BASE_URL=stub.base_url, EMAIL_BATCH_WINDOW=600):
+            for queue, publish in queues.items():
+                for label, prefetch in profiles:
+                    Payment.objects.update(checkout_url='')
+                    publish()
+                    rate = drain_queue(app, queue, size, prefetch_multiplier=prefetch, disable_rate_limits=True)
+                    stdout.write(f"{queue} queue, {label}: {rate:,.0f} tasks/s")
+    finally:
+        app.conf.update(previous)
+    mail.flush()
+    stdout.write(
+        f"{len(outbox.outbox)} emails sent, "
+        f"{Payment.objects.exclude(checkout_url='').count()} checkout URLs in the last payments run"
+    )
+
+
+@scenario('reconcile')
+def reconcile(stdout, size=2000, repeat=1, gateway_delay=0.02):
+    """Stale payments verified per second against a stub Chapa at various parallelism levels."""
+    guest = User.objects.create(username="bench_guest", email="guest@example.com")
+    listing_id = seed_listings(1)[0]
+    start = date.today()
+    Booking.objects.bulk_create(
+        Booking(listing_id=listing_id, guest=guest, total_price=100,
+                check_in=start + timedelta(days=2 * i), check_out=start + timedelta(days=2 * i + 1))
+        for i in range(size)
+    )
+    Payment.objects.bulk_create(
+        Payment(booking_id=booking_id, amount=100, transaction_id=f"stale-{booking_id}")
+        for booking_id in Booking.objects.values_list('pk', flat=True)
+    )
+    Payment.objects.update(created_at=timezone.now() - timedelta(days=1))
+
+    with StubChapaServer(delay=gateway_delay) as stub, mock.patch('listings.tasks.send_confirmation_batch'):
+        # A quarter of them never completed at Chapa
+        stub.statuses.update({f"stale-{pk}": 'pending' for pk in Payment.objects.values_list('booking_id', flat=True)[::4]})
+        for workers in (1, 8, 32):
+            with override_settings(CHAPA_BASE_URL=stub.base_url, CHAPA_POOL_SIZE=workers):
+                stats = Reconciliation(workers=workers, dry_run=True).run()
+            stdout.write(
+                f"dry run, {workers} workers: {stats['scanned']} payments in {stats['elapsed']:.2f}s "
+                f"({stats['scanned'] / stats['elapsed']:,.0f}/s)"
+            )
+        with override_settings(CHAPA_BASE_URL=stub.base_url, CHAPA_POOL_SIZE=32), \
+                CaptureQueriesContext(connection) as queries:
+            stats = Reconciliation(workers=32).run()
+    stdout.write(
+        f"applied, 32 workers: {stats['updated']} settled, {stats['unresolved']} still pending "
+        f"in {stats['elapsed']:.2f}s ({stats['chunks']} chunks, {len(queries)} queries)"
+    )
+
+
+@scenario('instrumentation')
+def instrumentation(stdout, size=1000, repeat=2000):
+    """Latency with and without RequestMetricsMiddleware on cached and uncached listing reads."""
+    seed_listings(size)
+    middleware = 'listings.middleware.RequestMetricsMiddleware'
+    clients = {}
+    with modify_settings(MIDDLEWARE={'remove': [middleware]}):
+        clients['off'] = APIClient()
+        clients['off'].get('/api/listings/')
+    clients['on'] = APIClient()
+    clients['on'].get('/api/listings/')
+
+    def uncached(client):
+        cache.clear()
+        return client.get('/api/listings/?page_size=50')
+
+    def cached(client):
+        return client.get('/api/listings/?page_size=50')
+
+    for label, request in (("uncached list", uncached), ("cached list", cached)):
+        samples = {'on': [], 'off': []}
+        # Interleave the two so drift in the machine affects both alike
+        for _ in range(repeat // 10):
+            for mode in ('off', 'on'):
+                samples[mode] += timed(lambda: request(clients[mode]), 10)
+        for mode in ('off', 'on'):
+            report(stdout, f"{label}, metrics {mode}", samples[mode])
+        on, off = statistics.median(samples['on']), statistics.median(samples['off'])
+        stdout.write(f"{label}: overhead {(on - off) * 1e6:.0f}us per request ({(on / off - 1) * 100:+.1f}% at p50)")
+
+
+@scenario('search')
+def search(stdout, size=1_000_000, repeat=50):
+    """Latency of GET /api/listings/search/ over ``size`` seeded listings."""
+    call_command('seed', users=10, listings=size, seed=42, stdout=StringIO())
+    stdout.write(f"seeded {Listing.objects.count()} listings ({connection.vendor})")
+    if connection.vendor != 'mysql':
+        started = time.perf_counter()
+        index = listing_search.get_index()
+        stdout.write(
+            f"inverted index: {len(index)} documents, {len(index.postings)} terms, "
+            f"built in {time.perf_counter() - started:.1f}s"
+        )
+
+    city = Listing.objects.values_list('location', flat=True).first()
+    queries = {
+        "one common term": {'q': "cozy"},
+        "two terms": {'q': "sunny cottage"},
+        "terms + price range": {'q': "sunny cottage", 'min_price': 50, 'max_price': 120},
+        "terms + price + location": {'q': "sunny cottage", 'min_price': 50, 'max_price': 120, 'location': city},
+        "term + deep page": {'q': "cozy", 'offset': 1000},
+    }
+    client = APIClient()
+    for label, params in queries.items():
+        response = client.get('/api/listings/search/', params)
+        with CaptureQueriesContext(connection) as queries_run:
+            samples = timed(lambda: client.get('/api/listings/search/', params), repeat)
+        report(stdout, f"{label} ({response.data['count']} matches, {len(queries_run) // repeat} queries)", samples)
+
+
+def scan_within(latitude, longitude, radius_km):
+    """Baseline for ``geo``: haversine over every row in SQL, no pruning."""
+    half_dphi = Radians(F('latitude') - latitude) / 2
+    half_dlambda = Radians(F('longitude') - longitude) / 2
+    a = Power(Sin(half_dphi), 2) + Cos(Radians(F('latitude'))) * math.cos(math.radians(latitude)) * Power(Sin(half_dlambda), 2)
+    return list(
+        Listing.objects.annotate(distance=2 * geo.EARTH_RADIUS_KM * ASin(Sqrt(a)))
+        .filter(distance__lte=radius_km).order_by('distance', 'pk').values_list('pk', flat=True)
+    )
+
+
+@scenario('geo')
+def geo_search(stdout, size=100_000, repeat=50, radius_km=20):
+    """Nearby search through the geocell index vs a full-table distance scan."""
+    call_command('seed', users=10, listings=size, seed=42, stdout=StringIO())
+    points = list(Listing.objects.order_by('?').values_list('latitude', 'longitude')[:repeat])
+    stdout.write(f"seeded {Listing.objects.count()} listings, {len(points)} query points, radius {radius_km} km")
+
+    for latitude, longitude in points[:5]:
+        indexed = geo.nearby(Listing.objects.all(), latitude, longitude, radius_km, limit=size)
+        assert [listing.pk for listing in indexed.listings] == scan_within(latitude, longitude, radius_km)
+
+    def run(search):
+        samples = []
+        for latitude, longitude in points:
+            started = time.perf_counter()
+            search(latitude, longitude)
+            samples.append(time.perf_counter() - started)
+        return samples
+
+    matches = statistics.mean(
+        geo.nearby(Listing.objects.all(), lat, lng, radius_km).count for lat, lng in points
+    )
+    report(stdout, f"geocell prune + haversine (avg {matches:.0f} matches)",
+           run(lambda lat, lng: geo.nearby(Listing.objects.all(), lat, lng, radius_km)))
+    report(stdout, "full-table haversine scan", run(lambda lat, lng: scan_within(lat, lng, radius_km)))
+
+
+def booked_from_bookings(listing_id, first):
+    """Baseline for ``calendar``: a month's booked nights from the bookings table."""
+    days = (first.replace(day=28) + timedelta(days=4)).replace(day=1) - first
+    booked = [False] * days.days
+    for check_in, check_out in Booking.objects.filter(listing_id=listing_id).overlapping(first, first + days).values_list('check_in', 'check_out'):
+        for day in range(max((check_in - first).days, 0), min((check_out - first).days, len(booked))):
+            booked[day] = True
+    return booked
+
+
+@scenario('calendar')
+def calendar(stdout, size=1_000_000, repeat=200, listings=1000):
+    """Month lookups from the occupancy bitmap vs the bookings table, ``size`` bookings."""
+    call_command('seed', users=100, listings=listings, bookings=size, seed=42, stdout=stdout)
+    origin, nights = occupancy.horizon()
+    stored = ListingCalendar.objects.values_list('nights', flat=True)
+    stdout.write(
+        f"{stored.count()} calendars over {nights} nights: {len(stored[0])} bytes of bitmap per listing "
+        f"({len(stored[0]) * stored.count() / 1024:.0f} KiB in total)"
+    )
+
+    rng = random.Random(0)
+    listing_ids = list(Listing.objects.values_list('pk', flat=True))
+    first = origin
+    checks = [(rng.choice(listing_ids), first) for _ in range(20)]
+    for listing_id, month in checks:
+        assert occupancy.booked_nights(listing_id, month.year, month.month) == booked_from_bookings(listing_id, month)
+
+    picks = iter(rng.choice(listing_ids) for _ in range(repeat * 2))
+    report(stdout, "bitmap month lookup", timed(
+        lambda: occupancy.booked_nights(next(picks), first.year, first.month), repeat,
+    ))
+    report(stdout, "bookings-table month lookup", timed(lambda: booked_from_bookings(next(picks), first), repeat))
+
+    client = APIClient()
+    report(stdout, "GET /api/listings/{id}/calendar/", timed(
+        lambda: client.get(f'/api/listings/{rng.choice(listing_ids)}/calendar/'), repeat,
+    ))
+
+    guest = User.objects.first()
+    ahead = iter(range(10_000))
+
+    def book():
+        check_in = origin + timedelta(days=600 + next(ahead) % 100)
+        with transaction.atomic():
+            Booking.objects.create(
+                listing_id=rng.choice(listing_ids), guest=guest, check_in=check_in, check_out=check_in + timedelta(days=1),
+            )
+    report(stdout, "booking insert incl. calendar sync", timed(book, repeat))
+
+
+@scenario('bulk_import')
+def bulk_import(stdout, size=2000, repeat=1, listings=200):
+    """``size`` bookings and listings created by single POSTs vs one bulk POST."""
+    guest = User.objects.create_user(username="bulk_guest")
+    client = APIClient()
+    client.force_authenticate(guest)
+    listing_ids = seed_listings(listings, host=guest)
+    start = timezone.localdate().replace(day=1)
+
+    def stays(offset):
+        # Back-to-back one-night stays spread over the listings, none overlapping
+        for i in range(size):
+            check_in = start + timedelta(days=offset + i // listings)
+            yield {'listing': listing_ids[i % listings], 'check_in': check_in.isoformat(),
+                   'check_out': (check_in + timedelta(days=1)).isoformat()}
+
+    def listing_items(prefix):
+        return [{'title': f"{prefix} {i}", 'description': "Imported", 'location': "Nairobi", 'price_per_night': 90}
+                for i in range(size)]
+
+    with mock.patch('listings.views.send_booking_confirmation_email'), mock.patch('listings.bulk.send_confirmation_batch'):
+        for label, single_items, bulk_items, url in (
+            ("listings", listing_items("Single"), listing_items("Bulk"), '/api/listings/'),
+            ("bookings", list(stays(0)), list(stays(size // listings + 1)), '/api/bookings/'),
+        ):
+            started = time.perf_counter()
+            for item in single_items:
+                assert client.post(url, item, format='json').status_code == 201
+            single = time.perf_counter() - started
+
+            body = "\n".join(json.dumps(item) for item in bulk_items)
+            started = time.perf_counter()
+            response = client.post(f'{url}bulk/', body, content_type='application/x-ndjson')
+            batched = time.perf_counter() - started
+            assert response.status_code == 201, response.data
+
+            stdout.write(
+                f"{size} {label}: single POSTs {single:.2f}s ({size / single:,.0f}/s), "
+                f"bulk NDJSON {batched:.2f}s ({size / batched:,.0f}/s), {single / batched:.1f}x faster"
+            )
+
+
+def peak_memory(func):
+    """(result, seconds, peak traced bytes) of calling ``func``."""
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        result = func()
+        return result, time.perf_counter() - started, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@scenario('export')
+def export_rows(stdout, size=1_000_000, repeat=1):
+    """Peak memory of the streaming bookings export at growing row counts, vs serializing a list."""
+    client = APIClient()
+    client.force_authenticate(User.objects.create_user(username="finance", is_staff=True))
+    until = (timezone.now() + timedelta(days=1)).isoformat()
+
+    def stream():
+        response = client.get('/api/exports/bookings/', {'until': until})
+        return sum(piece.count(b'\n') for piece in response.streaming_content) - 1
+
+    rows = 10_000
+    while rows <= size:
+        call_command('seed', users=100, listings=max(1, rows // 100), bookings=rows, seed=42, stdout=StringIO())
+        exported, elapsed, peak = peak_memory(stream)
+        assert exported == rows, exported
+        stdout.write(
+            f"{rows} bookings streamed as CSV: peak {peak / 2**20:.1f} MiB, {elapsed:.1f}s "
+            f"({rows / elapsed:,.0f} rows/s under tracemalloc)"
+        )
+        if rows <= 100_000:
+            _, elapsed, peak = peak_memory(lambda: BookingSerializer(Booking.objects.all(), many=True).data)
+            stdout.write(f"{rows} bookings through BookingSerializer(many=True): peak {peak / 2**20:.1f} MiB, {elapsed:.1f}s")
+        rows *= 10
+
+
+@scenario('list_serialization')
+def list_serialization(stdout, size=10_000, repeat=5):
+    """
+    Rows/s of list bodies: ModelSerializer + JSONRenderer vs FieldPlan +
+    FastJSONRenderer, including the query and on rows already fetched.
+    """
+    rows = 1000
+    while rows <= size:
+        call_command('seed', users=100, listings=rows, bookings=rows, seed=42, stdout=StringIO())
+        for serializer_class, queryset in (
+            (ListingSerializer, Listing.objects.order_by('-created_at', '-id')),
+            (BookingSerializer, Booking.objects.order_by('-created_at', '-id')),
+        ):
+            plan = FieldPlan.compile(serializer_class())
+            instances, values = list(queryset), list(plan.rows(queryset))
+            bodies = {}
+
+            def serializer(objects):
+                bodies['serializer'] = JSONRenderer().render(serializer_class(objects, many=True).data)
+
+            def field_plan(tuples):
+                bodies['plan'] = FastJSONRenderer().render(plan.render(tuples))
+
+            for label, source, loaded in (("with query", queryset, None), ("fetched", instances, values)):
+                slow = min(timed(lambda: serializer(source), repeat))
+                fast = min(timed(lambda: field_plan(plan.rows(queryset) if loaded is None else loaded), repeat))
+                assert bodies['serializer'] == bodies['plan'], f"{serializer_class.__name__} bodies differ"
+                stdout.write(
+                    f"{rows} rows {label}: {serializer_class.__name__} {rows / slow:,.0f} rows/s, "
+                    f"FieldPlan {rows / fast:,.0f} rows/s ({slow / fast:.1f}x)"
+                )
+        rows *= 10
+
+
+def price_night_by_night(schedule, check_in, check_out):
+    """Reference for Schedule.nightly_total: look up every night's rule."""
+    total = Decimal(0)
+    night = check_in
+    while night < check_out:
+        total += next(
+            (
+                price for start, end, weekdays, price in schedule.rules
+                if (start is None or start <= night) and (end is None or night < end) and weekdays >> night.weekday() & 1
+            ),
+            schedule.base_price,
+        )
+        night += timedelta(days=1)
+    return total
+
+
+@scenario('quotes')
+def quotes(stdout, size=2000, repeat=5):
+    """
+    Quotes/s for 1- and 90-night stays: computed from the segment sum, the
+    same quote summed night by night, and memoized.
+    """
+    rng = random.Random(42)
+    listing = Listing.objects.get(pk=seed_listings(1)[0])
+    today = date.today()
+    PricingRule.objects.create(listing=listing, weekdays=PricingRule.WEEKEND, price_per_night=120)
+    for season in range(4):
+        start = today + timedelta(days=90 * season + 30)
+        PricingRule.objects.create(
+            listing=listing, start_date=start, end_date=start + timedelta(days=20), price_per_night=80 + 20 * season,
+            priority=1,
+        )
+    StayDiscount.objects.create(listing=listing, min_nights=7, percent=5)
+    StayDiscount.objects.create(listing=listing, min_nights=28, percent=15)
+    listing.refresh_from_db()
+    schedule = pricing.load_schedules([listing])[listing.pk]
+
+    for nights in (1, 90):
+        stays = [today + timedelta(days=rng.randint(0, 365)) for _ in range(size)]
+        stays = [(check_in, check_in + timedelta(days=nights)) for check_in in stays]
+        for check_in, check_out in stays[:100]:
+            assert schedule.nightly_total(check_in, check_out) == price_night_by_night(schedule, check_in, check_out)
+
+        def computed():
+            for check_in, check_out in stays:
+                schedule.quote(listing.pk, check_in, check_out)
+
+        def night_by_night():
+            with mock.patch.object(schedule, 'nightly_total', partial(price_night_by_night, schedule)):
+                computed()
+
+        def memoized():
+            for check_in, check_out in stays:
+                pricing.quote(listing, check_in, check_out)
+
+        pricing.clear_caches()
+        memoized()
+        for label, func in (("computed", computed), ("night by night", night_by_night), ("memoized", memoized)):
+            best = min(timed(func, repeat))
+            stdout.write(f"{nights}-night stays, {label}: {size / best:,.0f} quotes/s")
+
+
+def analytics_per_listing(host, start, end):
+    """Baseline for ``host_analytics``: each listing's figures from its own rows, three queries per listing."""
+    after = end + timedelta(days=1)
+    results = {}
+    for listing in Listing.objects.filter(host=host):
+        nights = bookings = lead = 0
+        revenue = Decimal(0)
+        for booking in listing.bookings.overlapping(start, after):
+            nights += (min(booking.check_out, after) - max(booking.check_in, start)).days
+            if start <= booking.check_in <= end:
+                bookings += 1
+                lead += (booking.check_in - timezone.localdate(booking.created_at)).days
+        for payment in Payment.objects.filter(
+            booking__listing=listing, booking__check_in__gte=start, booking__check_in__lte=end, status='Success',
+        ):
+            revenue += payment.amount
+        ratings = [
+            review.rating for review in listing.reviews.all()
+            if start <= timezone.localdate(review.created_at) <= end
+        ]
+        results[listing.pk] = (nights, bookings, lead, revenue, len(ratings), sum(ratings))
+    return results
+
+
+@scenario('host_analytics')
+def host_analytics(stdout, size=50_000, repeat=20, listings=500):
+    """
+    Host analytics over ``size`` bookings of one host's ``listings``
+    listings: queries and latency of the live and rollup reports, and of
+    computing the same figures listing by listing.
+    """
+    rng = random.Random(42)
+    host = User.objects.create(username="bench_analytics_host")
+    guests = [User.objects.create(username=f"bench_analytics_guest_{i}") for i in range(50)]
+    listing_ids = seed_listings(listings, host)
+    today = timezone.localdate()
+    first = today - timedelta(days=ANALYTICS_PAST_DAYS)
+
+    # Stays of 1 to 4 nights in 5-night slots, from ANALYTICS_PAST_DAYS ago to a year ahead
+    slots = (ANALYTICS_PAST_DAYS + 365) // 5
+    bookings = []
+    for listing_id in listing_ids:
+        for slot in rng.sample(range(slots), min(slots, size // listings)):
+            check_in = first + timedelta(days=slot * 5)
+            nights = rng.randint(1, 4)
+            bookings.append(Booking(
+                listing_id=listing_id, guest=rng.choice(guests), check_in=check_in,
+                check_out=check_in + timedelta(days=nights), total_price=100 * nights,
+            ))
+    Booking.objects.bulk_create(bookings, batch_size=5000)
+    Booking.objects.update(created_at=timezone.now() - timedelta(days=ANALYTICS_PAST_DAYS + 30))
+    Payment.objects.bulk_create(
+        (
+            Payment(booking_id=pk, amount=amount, status='Success' if rng.random() < 0.7 else 'Failed')
+            for pk, amount in Booking.objects.values_list('pk', 'total_price').iterator()
+        ),
+        batch_size=5000,
+    )
+    Review.objects.bulk_create(
+        (
+            Review(listing_id=listing_id, guest=guest, rating=rng.randint(1, 5))
+            for listing_id in listing_ids for guest in rng.sample(guests, 10)
+        ),
+        batch_size=5000,
+    )
+    stdout.write(f"{len(listing_ids)} listings, {len(bookings)} bookings over {slots * 5} days")
+
+    started = time.perf_counter()
+    with override_settings(ANALYTICS_ROLLUP_PAST_DAYS=ANALYTICS_PAST_DAYS, ANALYTICS_ROLLUP_FUTURE_DAYS=365):
+        rows = analytics.refresh_rollup()
+    stdout.write(f"rollup refresh: {rows} rows in {time.perf_counter() - started:.2f}s")
+
+    client = APIClient()
+    client.force_authenticate(host)
+    windows = (
+        ("30 days by day", today - timedelta(days=29), today, 'day'),
+        ("365 days by month", today - timedelta(days=364), today, 'month'),
+    )
+    for label, start, end, interval in windows:
+        live = analytics.Report(host, start, end, interval).load(analytics.LIVE).as_dict()
+        rollup = analytics.Report(host, start, end, interval).load(analytics.ROLLUP).as_dict()
+        assert {**rollup, 'source': analytics.LIVE, 'refreshed_at': None} == live
+        expected = analytics_per_listing(host, start, end)
+        figures = {row['id']: (row['nights_booked'], row['bookings'], row['reviews']) for row in live['listings']}
+        assert figures == {pk: (row[0], row[1], row[4]) for pk, row in expected.items()}
+
+        for source in (analytics.LIVE, analytics.ROLLUP):
+            url = f'/api/analytics/host/?start={start}&end={end}&interval={interval}&source={source}'
+            with CaptureQueriesContext(connection) as queries:
+                client.get(url)
+            report(stdout, f"{label}, {source} ({len(queries)} queries)", timed(lambda: client.get(url), repeat))
+        with CaptureQueriesContext(connection) as queries:
+            analytics_per_listing(host, start, end)
+        report(stdout, f"{label}, per listing ({len(queries)} queries)", timed(
+            lambda: analytics_per_listing(host, start, end), max(1, repeat // 10),
+        ))
@@ -0,0 +1,199 @@
+"""
+Bulk creation of listings and bookings, for channel-manager imports.
+
+An import validates every item with the regular serializer through
+BulkListSerializer, inserts the valid ones with bulk_create in batches of
+BULK_IMPORT_BATCH_SIZE inside one transaction, and reports a result per
+item. The query count depends on the number of batches, not of items.
+
+bulk_create skips model signals and save(), so an import does itself
+what they would have done: derive geocells, quote the bookings, rebuild
+the calendars of the booked listings and retire cached listing responses.
+"""
+
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, models, transaction
+
+from . import cache, geo, mail, occupancy, pricing
+from .models import Booking, Listing
+from .serializers import BookingSerializer, BulkListSerializer, InvalidItem, ListingSerializer
+from .tasks import send_confirmation_batch
+
+CREATED = 'created'
+INVALID = 'invalid'
+CONFLICT = 'conflict'
+
+# Listings per query when loading the bookings a batch could clash with
+LISTING_CHUNK = 500
+
+
+class ImportResult:
+    def __init__(self, results):
+        self.results = results
+
+    @property
+    def created(self):
+        return sum(1 for result in self.results if result['status'] == CREATED)
+
+    @property
+    def failed(self):
+        return len(self.results) - self.created
+
+
+def validate(serializer_class, items, context):
+    """
+    Validate ``items`` with ``serializer_class``; returns a BulkListSerializer.
+
+    Raises ValidationError only when ``items`` as a whole is unusable
+    (not a list, empty or too long); item errors are kept per item.
+    """
+    serializer = BulkListSerializer(
+        child=serializer_class(context=context), data=items, context=context,
+        allow_empty=False, max_length=settings.BULK_IMPORT_MAX_ITEMS,
+    )
+    serializer.is_valid(raise_exception=True)
+    return serializer
+
+
+def _split(validated):
+    """Per-item results with the invalid items filled in, plus the (index, attrs) of the rest."""
+    results, valid = [], []
+    for index, attrs in enumerate(validated):
+        if isinstance(attrs, InvalidItem):
+            results.append({'index': index, 'status': INVALID, 'errors': attrs.errors})
+        else:
+            results.append(None)
+            valid.append((index, attrs))
+    return results, valid
+
+
+def import_listings(items, context, host):
+    """
+    Create listings hosted by ``host``.
+
+    On backends that can't return primary keys from a multi-row INSERT
+    (MySQL) the created items carry no ``id``.
+    """
+    results, valid = _split(validate(ListingSerializer, items, context).validated_data)
+    listings = [
+        Listing(**attrs, host=host, geocell=geo.cell_for(attrs.get('latitude'), attrs.get('longitude')))
+        for _, attrs in valid
+    ]
+    if listings:
+        with transaction.atomic():
+            Listing.objects.bulk_create(listings, batch_size=settings.BULK_IMPORT_BATCH_SIZE)
+            transaction.on_commit(cache.invalidate_all)
+            transaction.on_commit(cache.invalidate_search)
+    for (index, _), listing in zip(valid, listings):
+        results[index] = {'index': index, 'status': CREATED, 'id': listing.pk}
+    return ImportResult(results)
+
+
+class Occupied:
+    """
+    Disjoint [check_in, check_out) stays of one listing, sorted, for
+    overlap checks by binary search.
+    """
+
+    def __init__(self, stays):
+        self.starts, self.ends = [], []
+        for check_in, check_out in sorted(stays):
+            if self.ends and check_in < self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], check_out)
+            else:
+                self.starts.append(check_in)
+                self.ends.append(check_out)
+
+    def clashes(self, check_in, check_out):
+        # The last stay starting before check_out has the latest end of those
+        before = bisect_left(self.starts, check_out)
+        return before > 0 and self.ends[before - 1] > check_in
+
+    def add(self, check_in, check_out):
+        position = bisect_left(self.starts, check_in)
+        self.starts.insert(position, check_in)
+        self.ends.insert(position, check_out)
+
+
+def occupied(windows):
+    """
+    Existing stays that could clash with the import, by listing.
+
+    ``windows`` maps a listing id to the (earliest check_in, latest
+    check_out) it is being booked for; one query per LISTING_CHUNK listings.
+    """
+    stays = defaultdict(list)
+    listing_ids = sorted(windows)
+    for start in range(0, len(listing_ids), LISTING_CHUNK):
+        window = models.Q()
+        for listing_id in listing_ids[start:start + LISTING_CHUNK]:
+            low, high = windows[listing_id]
+            window |= models.Q(listing_id=listing_id, check_in__lt=high, check_out__gt=low)
+        for listing_id, check_in, check_out in Booking.objects.filter(window).values_list(
+            'listing_id', 'check_in', 'check_out',
+        ):
+            stays[listing_id].append((check_in, check_out))
+    return {listing_id: Occupied(stays[listing_id]) for listing_id in listing_ids}
+
+
+def import_bookings(items, context, guest):
+    """
+    Create bookings for ``guest``.
+
+    Items that overlap an existing booking, or an earlier item of the same
+    import, are reported as conflicts. Like Booking.objects.reserve, the
+    import holds the booked listings' rows locked until it commits.
+    """
+    results, valid = _split(validate(BookingSerializer, items, context).validated_data)
+    windows = {}
+    for _, attrs in valid:
+        low, high = windows.get(attrs['listing'].pk, (attrs['check_in'], attrs['check_out']))
+        windows[attrs['listing'].pk] = (min(low, attrs['check_in']), max(high, attrs['check_out']))
+
+    with transaction.atomic():
+        # In pk order, so two imports touching the same listings can't deadlock
+        list(Listing.objects.select_for_update().filter(pk__in=windows).order_by('pk').values_list('pk'))
+        taken = occupied(windows)
+        accepted = []
+        for index, attrs in valid:
+            nights = taken[attrs['listing'].pk]
+            if nights.clashes(attrs['check_in'], attrs['check_out']):
+                results[index] = {
+                    'index': index, 'status': CONFLICT,
+                    'errors': {'non_field_errors': ["The listing is already booked for some of these nights."]},
+                }
+            else:
+                nights.add(attrs['check_in'], attrs['check_out'])
+                accepted.append((index, Booking(**attrs, guest=guest)))
+
+        bookings = [booking for _, booking in accepted]
+        pricing.prime({booking.listing.pk: booking.listing for booking in bookings}.values())
+        for booking in bookings:
+            quote = pricing.quote(booking.listing, booking.check_in, booking.check_out)
+            booking.total_price, booking.currency = quote.total, quote.currency
+        if bookings:
+            Booking.objects.bulk_create(bookings, batch_size=settings.BULK_IMPORT_BATCH_SIZE)
+            if not connection.features.can_return_rows_from_bulk_insert:
+                _load_pks(bookings)
+            occupancy.rebuild(sorted({booking.listing_id for booking in bookings}))
+            confirmations = [[mail.BOOKING, booking.pk] for booking in bookings]
+            transaction.on_commit(cache.invalidate_all)
+            transaction.on_commit(lambda: send_confirmation_batch.delay(confirmations))
+
+    for index, booking in accepted:
+        results[index] = {'index': index, 'status': CREATED, 'id': booking.pk}
+    return ImportResult(results)
+
+
+def _load_pks(bookings):
+    """Fill in pks bulk_create couldn't return; accepted stays never overlap, so (listing, check_in) is unique."""
+    by_stay = {(booking.listing_id, booking.check_in): booking for booking in bookings}
+    for start in range(0, len(bookings), LISTING_CHUNK):
+        stays = models.Q()
+        for booking in bookings[start:start + LISTING_CHUNK]:
+            stays |= models.Q(listing_id=booking.listing_id, check_in=booking.check_in)
+        for pk, listing_id, check_in in Booking.objects.filter(stays).values_list('pk', 'listing_id', 'check_in'):
+            by_stay[listing_id, check_in].pk = pk
@@ -0,0 +1,111 @@
+"""
+Read-through cache for listing responses.
+
+Every listing, plus the listing collection as a whole, has a version token
+in the cache. Cached responses and ETags are keyed by that token, so a
+write only has to replace the token: old entries are never addressed again
+and expire on their own.
+"""
+
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework import status
+from rest_framework.response import Response
+
+from . import routers
+
+LIST_SCOPE = 'list'
+ALL_SCOPE = 'all'
+# Versions the in-process search index rather than cached responses
+SEARCH_SCOPE = 'search'
+STATS = ('hits', 'misses', 'not_modified')
+
+
+def get_version(scope):
+    """Current version token for ``scope`` (a listing pk or LIST_SCOPE)."""
+    key = f'listings:version:{scope}'
+    version = cache.get(key)
+    if version is None:
+        # A timestamp instead of a counter so an evicted token is never reissued
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(scope):
+    cache.set(f'listings:version:{scope}', time.time_ns(), timeout=None)
+
+
+def invalidate_listing(listing_id):
+    """Retire cached detail and list responses that may include ``listing_id``."""
+    bump_version(listing_id)
+    bump_version(LIST_SCOPE)
+
+
+def invalidate_search():
+    """Make every process rebuild its search index on the next query."""
+    bump_version(SEARCH_SCOPE)
+
+
+def invalidate_all():
+    """Retire every cached listing response, e.g. after a bulk write that bypasses signals."""
+    bump_version(ALL_SCOPE)
+
+
+def record(stat):
+    key = f'listings:stats:{stat}'
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Evicted between add() and incr(); losing one sample is fine
+        pass
+
+
+def get_stats():
+    counts = cache.get_many([f'listings:stats:{stat}' for stat in STATS])
+    stats = {stat: counts.get(f'listings:stats:{stat}', 0) for stat in STATS}
+    served = stats['hits'] + stats['not_modified']
+    total = served + stats['misses']
+    stats['hit_ratio'] = served / total if total else 0.0
+    return stats
+
+
+def reset_stats():
+    cache.delete_many([f'listings:stats:{stat}' for stat in STATS])
+
+
+def cached_response(request, scope, build):
+    """
+    Serve the data returned by ``build()`` through the cache.
+
+    The ETag is derived from the scope version and the request URL, so a
+    matching If-None-Match is answered with 304 before anything is loaded
+    or serialized. Responses read from a replica within REPLICA_STICKY_SECONDS
+    of the version's write are served but neither cached nor tagged.
+    """
+    versions = (get_version(ALL_SCOPE), get_version(scope))
+    version = '.'.join(map(str, versions))
+    digest = hashlib.md5(f'{scope}:{version}:{request.get_full_path()}'.encode()).hexdigest()
+    etag = f'"{digest}"'
+
+    if etag in request.headers.get('If-None-Match', ''):
+        record('not_modified')
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+    key = f'listings:response:{digest}'
+    data = cache.get(key)
+    if data is None:
+        record('misses')
+        data = build()
+        if routers.on_replica() and time.time_ns() - max(versions) < settings.REPLICA_STICKY_SECONDS * 10**9:
+            # The replica may not have the write behind the version yet; keep
+            # what it returned out of the cache and away from the ETag
+            return Response(data)
+        cache.set(key, data, timeout=settings.LISTING_CACHE_TIMEOUT)
+    else:
+        record('hits')
+    return Response(data, headers={'ETag': etag})
@@ -0,0 +1,179 @@
+"""
+HTTP client for the Chapa payment gateway.
+
+One pooled ``requests.Session`` per process keeps TCP/TLS connections to
+Chapa alive between payments. Every call has bounded connect/read timeouts,
+idempotent calls are retried with jittered exponential backoff, and a
+circuit breaker fails fast while the gateway keeps erroring.
+"""
+
+import random
+import threading
+import time
+
+import requests
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+
+# Gateway responses worth retrying on an idempotent call
+RETRY_STATUSES = {502, 503, 504}
+
+
+class ChapaError(Exception):
+    """
+    Chapa could not be reached or kept answering with a server error.
+    """
+
+
+class CircuitOpenError(ChapaError):
+    """
+    Raised without calling Chapa while the circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Opens after ``failure_threshold`` consecutive failures and rejects calls
+    for ``reset_timeout`` seconds. After that a single trial call is let
+    through; success closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if self.clock() - self._opened_at < self.reset_timeout:
+                return 'open'
+            return 'half-open'
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if self.clock() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError("Chapa circuit breaker is open")
+            # Half-open: this caller is the trial; restart the timer so others keep failing fast
+            self._opened_at = self.clock()
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._opened_at = self.clock()
+
+
+class ChapaClient:
+    """
+    Thin wrapper over the Chapa REST API.
+
+    Methods return the ``requests.Response`` for any answer below 500 so
+    callers keep handling Chapa's own 4xx errors; transport failures and
+    5xx answers raise ChapaError.
+    """
+
+    def __init__(self, base_url, secret_key, connect_timeout=3.05, read_timeout=10.0,
+                 max_retries=3, backoff=0.2, pool_size=10, breaker=None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f'Bearer {secret_key}'
+        # Retries are handled in _request so they also feed the circuit breaker
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def initialize(self, payload):
+        """Start a transaction. Not idempotent, so never retried."""
+        return self._request('POST', '/transaction/initialize', retries=0, json=payload)
+
+    def verify(self, tx_ref):
+        """Look up a transaction by reference. Safe to retry."""
+        return self._request('GET', f'/transaction/verify/{tx_ref}', retries=self.max_retries)
+
+    def close(self):
+        self.session.close()
+
+    def _request(self, method, path, retries, **kwargs):
+        url = f'{self.base_url}{path}'
+        for attempt in range(retries + 1):
+            self.breaker.before_call()
+            retryable = True
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except requests.RequestException as exc:
+                error = ChapaError(f"Chapa {method} {path} failed: {exc}")
+            else:
+                if response.status_code < 500:
+                    self.breaker.record_success()
+                    return response
+                error = ChapaError(f"Chapa {method} {path} returned {response.status_code}")
+                retryable = response.status_code in RETRY_STATUSES
+            finally:
+                metrics.record_http(time.perf_counter() - started)
+            self.breaker.record_failure()
+            if attempt == retries or not retryable:
+                raise error
+            # Full jitter keeps many workers from retrying in lockstep
+            time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """The process-wide client, built from the CHAPA_* settings on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = ChapaClient(
+                    base_url=settings.CHAPA_BASE_URL,
+                    secret_key=settings.CHAPA_SECRET_KEY,
+                    connect_timeout=settings.CHAPA_CONNECT_TIMEOUT,
+                    read_timeout=settings.CHAPA_READ_TIMEOUT,
+                    max_retries=settings.CHAPA_MAX_RETRIES,
+                    backoff=settings.CHAPA_RETRY_BACKOFF,
+                    pool_size=settings.CHAPA_POOL_SIZE,
+                    breaker=CircuitBreaker(
+                        settings.CHAPA_BREAKER_THRESHOLD, settings.CHAPA_BREAKER_RESET_TIMEOUT,
+                    ),
+                )
+    return _client
+
+
+def reset_client():
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+
+
+@receiver(setting_changed)
+def reset_client_on_setting_change(setting, **kwargs):
+    if setting.startswith('CHAPA_'):
+        reset_client()
@@ -0,0 +1,117 @@
+"""
+A local stand-in for the Chapa API, used by tests and benchmarks.
+
+    with StubChapaServer(delay=0.05) as stub:
+        client = ChapaClient(stub.base_url, "test-key")
+"""
+
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients testing their timeouts hang up mid-response on purpose
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class StubChapaServer:
+    """
+    Serves ``/transaction/initialize`` and ``/transaction/verify/<tx_ref>``.
+
+    ``delay`` slows every answer down, ``fail_next`` makes the next N
+    requests answer ``fail_status``, and ``statuses`` maps a tx_ref to the
+    transaction status verify reports (``default_status`` otherwise).
+    """
+
+    def __init__(self, delay=0.0, fail_next=0, fail_status=503, default_status='success'):
+        self.delay = delay
+        self.fail_next = fail_next
+        self.fail_status = fail_status
+        self.default_status = default_status
+        self.statuses = {}
+        self.requests = []
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}'
+
+    def __enter__(self):
+        self._server = _Server(('127.0.0.1', 0), self._handler_class())
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _respond(self, method, path, body):
+        with self._lock:
+            self.requests.append((method, path))
+            if self.fail_next:
+                self.fail_next -= 1
+                return self.fail_status, {'status': 'failed', 'message': 'Stub failure'}
+        if self.delay:
+            time.sleep(self.delay)
+
+        if method == 'POST' and path == '/transaction/initialize':
+            tx_ref = body.get('tx_ref')
+            return 200, {
+                'status': 'success',
+                'message': 'Hosted Link',
+                'data': {'checkout_url': f'https://checkout.chapa.test/{tx_ref}'},
+            }
+        if method == 'GET' and path.startswith('/transaction/verify/'):
+            tx_ref = path.rsplit('/', 1)[-1]
+            status = self.statuses.get(tx_ref, self.default_status)
+            return 200, {
+                'status': 'success',
+                'message': 'Payment details',
+                'data': {'tx_ref': tx_ref, 'status': status},
+            }
+        return 404, {'status': 'failed', 'message': 'Not found'}
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # HTTP/1.1 so clients can keep the connection alive; without
+            # TCP_NODELAY the split header/body writes stall on delayed ACKs
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with stub._lock:
+                    stub.connections += 1
+
+            def do_GET(self):
+                self._reply(*stub._respond('GET', self.path, {}))
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length) or b'{}')
+                self._reply(*stub._respond('POST', self.path, body))
+
+            def _reply(self, status, payload):
+                content = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,114 @@
+"""
+Radius search over listing coordinates without a spatial database.
+
+The globe is cut into a fixed grid of CELL_DEGREES x CELL_DEGREES cells,
+numbered row by row from the south-west corner, and every listing stores
+the number of the cell it falls in (``Listing.geocell``, indexed). Cells of
+one row are consecutive numbers, so the cells covering a circle come out as
+one ``geocell BETWEEN`` range per grid row. Those ranges prune the table to
+a few cells' worth of candidates; the exact haversine distance then decides
+which of them are really inside the radius.
+"""
+
+import math
+
+EARTH_RADIUS_KM = 6371.0088
+
+# About 11 km north-south; a 20 km radius touches a handful of rows
+CELL_DEGREES = 0.1
+ROWS = round(180 / CELL_DEGREES)
+COLUMNS = round(360 / CELL_DEGREES)
+
+
+def _row(latitude):
+    return min(max(int((latitude + 90) / CELL_DEGREES), 0), ROWS - 1)
+
+
+def _column(longitude):
+    return min(max(int((longitude + 180) / CELL_DEGREES), 0), COLUMNS - 1)
+
+
+def cell_for(latitude, longitude):
+    """Grid cell of a point, or None when either coordinate is missing."""
+    if latitude is None or longitude is None:
+        return None
+    return _row(latitude) * COLUMNS + _column(longitude)
+
+
+def haversine_km(latitude1, longitude1, latitude2, longitude2):
+    """Great-circle distance between two points, in kilometres."""
+    phi1, phi2 = math.radians(latitude1), math.radians(latitude2)
+    half_dphi = (phi2 - phi1) / 2
+    half_dlambda = math.radians(longitude2 - longitude1) / 2
+    a = math.sin(half_dphi) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(half_dlambda) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """
+    Smallest latitude range and longitude ranges enclosing the circle.
+
+    Returns ((south, north), [(west, east), ...]); there are two longitude
+    ranges when the circle crosses the antimeridian, and one spanning the
+    globe when it reaches a pole.
+    """
+    angle = radius_km / EARTH_RADIUS_KM
+    spread = math.degrees(angle)
+    south, north = latitude - spread, latitude + spread
+    if south <= -90 or north >= 90:
+        return (max(south, -90.0), min(north, 90.0)), [(-180.0, 180.0)]
+
+    ratio = math.sin(angle) / math.cos(math.radians(latitude))
+    if ratio >= 1:
+        return (south, north), [(-180.0, 180.0)]
+    spread = math.degrees(math.asin(ratio))
+    west, east = longitude - spread, longitude + spread
+    if west < -180:
+        return (south, north), [(west + 360, 180.0), (-180.0, east)]
+    if east > 180:
+        return (south, north), [(west, 180.0), (-180.0, east - 360)]
+    return (south, north), [(west, east)]
+
+
+def cell_ranges(latitude, longitude, radius_km):
+    """Inclusive (first, last) geocell ranges covering the circle, merged where adjacent."""
+    (south, north), spans = bounding_box(latitude, longitude, radius_km)
+    columns = sorted((_column(west), _column(east)) for west, east in spans)
+    ranges = []
+    for row in range(_row(south), _row(north) + 1):
+        for first, last in columns:
+            low, high = row * COLUMNS + first, row * COLUMNS + last
+            if ranges and ranges[-1][1] + 1 >= low:
+                ranges[-1] = (ranges[-1][0], high)
+            else:
+                ranges.append((low, high))
+    return ranges
+
+
+class NearbyResult:
+    def __init__(self, listings, distances, count):
+        self.listings = listings
+        self.distances = distances
+        self.count = count
+
+
+def nearby(queryset, latitude, longitude, radius_km, offset=0, limit=20):
+    """
+    Listings of ``queryset`` within ``radius_km`` of the point, nearest first.
+
+    One query fetches the coordinates of the candidates in the covering
+    cells and a second loads the requested page.
+    """
+    candidates = queryset.near(latitude, longitude, radius_km).order_by().values_list('pk', 'latitude', 'longitude')
+    hits = []
+    for pk, candidate_latitude, candidate_longitude in candidates:
+        distance = haversine_km(latitude, longitude, candidate_latitude, candidate_longitude)
+        if distance <= radius_km:
+            hits.append((distance, pk))
+    hits.sort()
+    page = hits[offset:offset + limit]
+    loaded = queryset.in_bulk([pk for _, pk in page]) if page else {}
+    found = [(loaded[pk], distance) for distance, pk in page if pk in loaded]
+    return NearbyResult(
+        [listing for listing, _ in found], [distance for _, distance in found], len(hits),
+    )
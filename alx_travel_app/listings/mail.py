@@ -0,0 +1,185 @@
+"""
+Batched delivery of booking and payment confirmation emails.
+
+The confirmation tasks store their booking/payment id as a
+PendingConfirmation row instead of sending right away, so a confirmation
+survives a worker that dies before its batch goes out. ``flush`` sends the
+waiting rows once EMAIL_BATCH_SIZE of them are there or EMAIL_BATCH_WINDOW
+seconds after the first one arrived (see listings.tasks): the rows are
+loaded with one query per kind, rendered, and sent over a single backend
+connection. Messages that fail are retried on a fresh connection, then
+handed to the send_confirmation_batch task, which keeps retrying them with
+exponential backoff.
+"""
+
+import logging
+import time
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+
+from .models import Booking, Payment, PendingConfirmation
+
+logger = logging.getLogger(__name__)
+
+BOOKING = 'booking'
+PAYMENT = 'payment'
+
+
+def render_booking(booking):
+    guest = booking.guest
+    return EmailMessage(
+        f'Booking Confirmation - Booking #{booking.id}',
+        f"""Dear {guest.first_name or guest.username},
+
+Your booking has been successfully created!
+
+Booking Details:
+- Booking ID: {booking.id}
+- Listing: {booking.listing.title}
+- Check-in: {booking.check_in}
+- Check-out: {booking.check_out}
+
+We look forward to hosting you!
+""",
+        settings.DEFAULT_FROM_EMAIL,
+        [guest.email],
+    )
+
+
+def render_payment(payment):
+    booking = payment.booking
+    guest = booking.guest
+    return EmailMessage(
+        f'Payment Confirmation - Booking #{booking.id}',
+        f"""Dear {guest.first_name or guest.username},
+
+Your payment has been successfully processed!
+
+Booking Details:
+- Booking ID: {booking.id}
+- Listing: {booking.listing.title}
+- Amount: {payment.currency} {payment.amount}
+- Transaction ID: {payment.transaction_id}
+- Check-in: {booking.check_in}
+- Check-out: {booking.check_out}
+
+Thank you for your booking!
+""",
+        settings.DEFAULT_FROM_EMAIL,
+        [guest.email],
+    )
+
+
+def load_messages(items):
+    """
+    Render the confirmations for ``items``, a sequence of (kind, pk) pairs.
+
+    Each kind is fetched in a single query. Rows that no longer exist and
+    guests without an email address are skipped.
+    """
+    items = list(dict.fromkeys((kind, int(pk)) for kind, pk in items))
+    bookings = Booking.objects.select_related('guest', 'listing').in_bulk(
+        [pk for kind, pk in items if kind == BOOKING]
+    )
+    payments = Payment.objects.select_related('booking__guest', 'booking__listing').in_bulk(
+        [pk for kind, pk in items if kind == PAYMENT]
+    )
+
+    messages = []
+    for kind, pk in items:
+        if kind == BOOKING:
+            booking = bookings.get(pk)
+            message = booking and booking.guest.email and render_booking(booking)
+        else:
+            payment = payments.get(pk)
+            message = payment and payment.booking.guest.email and render_payment(payment)
+        if message:
+            message.confirmation = (kind, pk)
+            messages.append(message)
+        else:
+            logger.warning("Skipping %s confirmation %s: row or recipient missing", kind, pk)
+    return messages
+
+
+def send_batch(messages, max_retries=None, backoff=None):
+    """
+    Send ``messages`` over one backend connection per attempt.
+
+    Each message is handed to ``send_messages`` on its own so a failure only
+    costs that message a retry. Returns the messages still unsent after
+    ``max_retries`` further attempts.
+    """
+    max_retries = settings.EMAIL_BATCH_MAX_RETRIES if max_retries is None else max_retries
+    backoff = settings.EMAIL_BATCH_RETRY_BACKOFF if backoff is None else backoff
+
+    pending = list(messages)
+    for attempt in range(max_retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        failed = []
+        backend = get_connection(fail_silently=False)
+        try:
+            backend.open()
+        except Exception:
+            logger.exception("Could not open the email connection")
+            failed = pending
+        else:
+            try:
+                for message in pending:
+                    try:
+                        backend.send_messages([message])
+                    except Exception:
+                        logger.warning("Sending %r failed (attempt %d)", message.subject, attempt + 1, exc_info=True)
+                        failed.append(message)
+            finally:
+                backend.close()
+        pending = failed
+        if not pending:
+            break
+
+    for message in pending:
+        logger.error("Giving up on %r to %s", message.subject, ", ".join(message.to))
+    return pending
+
+
+def deliver(items):
+    """
+    Load, render and send the confirmations for (kind, pk) ``items``.
+    Returns the items that could not be sent.
+    """
+    return [message.confirmation for message in send_batch(load_messages(items))]
+
+
+def queue(kind, pk):
+    """Keep the (kind, pk) confirmation until a flush sends it; returns how many are waiting."""
+    PendingConfirmation.objects.bulk_create([PendingConfirmation(kind=kind, object_id=pk)], ignore_conflicts=True)
+    return PendingConfirmation.objects.count()
+
+
+def flush(batch_size=None):
+    """
+    Send the waiting confirmations, oldest first, ``batch_size`` at a time.
+
+    Each batch is locked, sent and deleted in one transaction: a flush that
+    dies halfway leaves its batch for the next one (at worst sending some of
+    it twice), and concurrent flushes skip each other's batches. What still
+    fails is handed to send_confirmation_batch. Returns the number handled.
+    """
+    from .tasks import send_confirmation_batch
+    batch_size = batch_size or settings.EMAIL_BATCH_SIZE
+    handled = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                PendingConfirmation.objects.select_for_update(skip_locked=True).order_by('pk')[:batch_size]
+                .values_list('pk', 'kind', 'object_id')
+            )
+            if not batch:
+                return handled
+            unsent = deliver([(kind, object_id) for _, kind, object_id in batch])
+            if unsent:
+                send_confirmation_batch.delay(unsent)
+            PendingConfirmation.objects.filter(pk__in=[pk for pk, _, _ in batch]).delete()
+        handled += len(batch)
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from listings.benchmarks import SCENARIOS
+
+
+class Command(BaseCommand):
+    help = "Run a listings benchmark scenario against a throwaway test database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("scenario", choices=sorted(SCENARIOS))
+        parser.add_argument("--size", type=int, help="Number of rows to seed (scenario default if omitted)")
+        parser.add_argument("--repeat", type=int, help="Number of timed iterations (scenario default if omitted)")
+
+    def handle(self, *args, **options):
+        kwargs = {
+            key: options[key] for key in ("size", "repeat") if options[key] is not None
+        }
+        old_name = connection.settings_dict["NAME"]
+        setup_test_environment()
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            SCENARIOS[options["scenario"]](self.stdout, **kwargs)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+
+from django.core.management.base import BaseCommand
+from listings import cache
+
+
+class Command(BaseCommand):
+    help = "Show the listing response cache hit ratio"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reset", action="store_true", help="Zero the counters after printing them")
+
+    def handle(self, *args, **options):
+        stats = cache.get_stats()
+        self.stdout.write(
+            f"hits={stats['hits']} not_modified={stats['not_modified']} "
+            f"misses={stats['misses']} hit_ratio={stats['hit_ratio']:.2%}"
+        )
+        if options["reset"]:
+            cache.reset_stats()
+            self.stdout.write(self.style.SUCCESS("Counters reset."))
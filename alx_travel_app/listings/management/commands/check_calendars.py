@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max, Min
+from listings import occupancy
+from listings.models import Listing
+
+
+class Command(BaseCommand):
+    help = "Compare the listing occupancy calendars with the bookings table"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fix", action="store_true", help="Rebuild the calendars that disagree")
+        parser.add_argument("--batch-size", type=int, default=5000, help="Listings checked per query")
+
+    def handle(self, *args, **options):
+        bounds = Listing.objects.aggregate(low=Min("pk"), high=Max("pk"))
+        if bounds["low"] is None:
+            self.stdout.write("No listings to check.")
+            return
+
+        batch_size = options["batch_size"]
+        totals = {"checked": 0, "mismatched": 0, "outdated": 0, "missing": 0}
+        for start in range(bounds["low"], bounds["high"] + 1, batch_size):
+            listing_ids = list(
+                Listing.objects.filter(pk__gte=start, pk__lt=start + batch_size).values_list("pk", flat=True)
+            )
+            if not listing_ids:
+                continue
+            result = occupancy.check(listing_ids)
+            totals["checked"] += len(listing_ids)
+            for kind, found in result.items():
+                totals[kind] += len(found)
+            for pk in result["mismatched"]:
+                self.stdout.write(f"listing {pk}: calendar disagrees with its bookings")
+            if options["fix"]:
+                stale = result["mismatched"] + result["outdated"] + result["missing"]
+                if stale:
+                    with transaction.atomic():
+                        occupancy.rebuild(stale)
+
+        summary = (
+            f"{totals['checked']} calendars checked: {totals['mismatched']} mismatched, "
+            f"{totals['outdated']} outdated, {totals['missing']} missing"
+        )
+        if totals["mismatched"] and not options["fix"]:
+            raise CommandError(f"{summary}. Run with --fix to rebuild them.")
+        verb = " (rebuilt)" if options["fix"] else ""
+        self.stdout.write(self.style.SUCCESS(f"✅ {summary}{verb}."))
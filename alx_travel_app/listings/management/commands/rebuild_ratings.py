@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, Min
+from listings import cache
+from listings.models import Listing
+
+
+class Command(BaseCommand):
+    help = "Recompute listing review_count/rating_sum from the reviews table"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000, help="Listings updated per transaction")
+
+    def handle(self, *args, **options):
+        bounds = Listing.objects.aggregate(low=Min("pk"), high=Max("pk"))
+        if bounds["low"] is None:
+            self.stdout.write("No listings to rebuild.")
+            return
+
+        batch_size = options["batch_size"]
+        touched = 0
+        for start in range(bounds["low"], bounds["high"] + 1, batch_size):
+            with transaction.atomic():
+                touched += Listing.objects.filter(
+                    pk__gte=start, pk__lt=start + batch_size,
+                ).rebuild_rating_aggregates()
+
+        cache.invalidate_all()
+        self.stdout.write(self.style.SUCCESS(f"✅ Rebuilt rating aggregates for {touched} listings."))
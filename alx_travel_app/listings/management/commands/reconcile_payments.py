@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from listings.reconcile import Reconciliation
+
+
+class Command(BaseCommand):
+    help = "Verify stale Pending payments with Chapa and settle the ones it has resolved"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Ask Chapa but don't change any payment")
+        parser.add_argument("--older-than", type=int, help="Minutes a payment must have been Pending")
+        parser.add_argument("--chunk-size", type=int, help="Payments verified per chunk")
+        parser.add_argument("--workers", type=int, help="Concurrent requests to Chapa")
+
+    def handle(self, *args, **options):
+        older_than = options["older_than"]
+        run = Reconciliation(
+            older_than=timedelta(minutes=older_than) if older_than is not None else None,
+            chunk_size=options["chunk_size"],
+            workers=options["workers"],
+            dry_run=options["dry_run"],
+            progress=self.progress,
+        )
+        stats = run.run()
+        verb = "Would settle" if options["dry_run"] else "Settled"
+        settled = stats["success"] + stats["failed"] if options["dry_run"] else stats["updated"]
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ {verb} {settled} of {stats['scanned']} stale payments in {stats['elapsed']:.1f}s "
+            f"({stats['unresolved']} still pending at Chapa, {stats['errors']} errors)."
+        ))
+
+    def progress(self, stats):
+        rate = stats["scanned"] / stats["elapsed"] if stats["elapsed"] else 0
+        self.stdout.write(
+            f"chunk {stats['chunks']}: scanned={stats['scanned']} ({rate:,.0f}/s) "
+            f"success={stats['success']} failed={stats['failed']} "
+            f"unresolved={stats['unresolved']} errors={stats['errors']}"
+        )
@@ -1,36 +1,270 @@
 #!/usr/bin/env python3
 
-from django.core.management.base import BaseCommand
-from listings.models import Listing
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management import call_command
 from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import connection, connections, transaction
+from listings import cache, geo
+from listings.models import (
+    Listing, ListingCalendar, ListingDailyStats, Booking, PricingRule, Review, Payment, StayDiscount,
+)
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
 from faker import Faker
+import django
 import random
+import time
 
 User = get_user_model()
-fake = Faker()
+
+# Rows generated per worker task; bounds the memory a single task holds
+TASK_ROWS = 50_000
+
+
+def _rng(seed, *parts):
+    """Deterministic RNG for one unit of work, independent of scheduling order."""
+    return random.Random(":".join(str(part) for part in (seed, *parts)))
+
+
+def _init_worker():
+    django.setup()
+
+
+def _split(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _insert_listings(seed, task, count, host_ids, pools, batch_size):
+    rng = _rng(seed, "listings", task)
+    # Separate stream so adding coordinates left the seeded text unchanged
+    scatter = _rng(seed, "coordinates", task)
+
+    def rows():
+        for _ in range(count):
+            city = rng.choice(pools['cities'])
+            latitude, longitude = _scatter(scatter, *pools['centres'][city])
+            yield Listing(
+                title=f"{rng.choice(pools['adjectives'])} {rng.choice(pools['nouns'])} in {city}",
+                description=rng.choice(pools['descriptions']),
+                location=city,
+                price_per_night=rng.randint(30, 200),
+                host_id=rng.choice(host_ids),
+                latitude=latitude,
+                longitude=longitude,
+                # bulk_create skips Listing.save(), which normally derives this
+                geocell=geo.cell_for(latitude, longitude),
+            )
+
+    with transaction.atomic():
+        Listing.objects.bulk_create(rows(), batch_size=batch_size)
+    return count
+
+
+def _scatter(rng, latitude, longitude, spread=0.15):
+    """A point around (latitude, longitude), mostly within ~30 km."""
+    latitude = min(max(rng.gauss(latitude, spread), -90.0), 90.0)
+    longitude = (rng.gauss(longitude, spread) + 180) % 360 - 180
+    return round(latitude, 6), round(longitude, 6)
+
+
+def _insert_bookings(seed, task, stays, guest_ids, batch_size):
+    """``stays`` is a list of (listing_id, count); each listing's stays never overlap."""
+    rng = _rng(seed, "bookings", task)
+    today = date.today()
+    # Seeded listings have no pricing rules, so a stay costs nights times the base price
+    prices = dict(Listing.objects.filter(
+        pk__gte=stays[0][0], pk__lte=stays[-1][0],
+    ).values_list('pk', 'price_per_night'))
+
+    def rows():
+        for listing_id, count in stays:
+            day = today + timedelta(days=rng.randint(-365, 30))
+            for _ in range(count):
+                nights = rng.randint(1, 7)
+                yield Booking(
+                    listing_id=listing_id, guest_id=rng.choice(guest_ids),
+                    check_in=day, check_out=day + timedelta(days=nights),
+                    total_price=prices[listing_id] * nights,
+                )
+                day += timedelta(days=nights + rng.randint(0, 10))
+
+    with transaction.atomic():
+        Booking.objects.bulk_create(rows(), batch_size=batch_size)
+    return sum(count for _, count in stays)
+
+
+def _insert_reviews(seed, task, reviews, guest_ids, pools, batch_size):
+    """``reviews`` is a list of (listing_id, count) with count <= len(guest_ids)."""
+    rng = _rng(seed, "reviews", task)
+    rows = (
+        Review(
+            listing_id=listing_id, guest_id=guest_id,
+            rating=rng.choices((1, 2, 3, 4, 5), weights=(1, 2, 5, 10, 8))[0],
+            comment=rng.choice(pools['comments']),
+        )
+        for listing_id, count in reviews
+        for guest_id in rng.sample(guest_ids, count)
+    )
+    with transaction.atomic():
+        Review.objects.bulk_create(rows, batch_size=batch_size)
+    return sum(count for _, count in reviews)
+
+
+def _insert_payments(seed, task, low, high, batch_size):
+    """One payment for every booking with low <= pk <= high."""
+    rng = _rng(seed, "payments", task)
+    bookings = Booking.objects.filter(pk__gte=low, pk__lte=high).values_list('pk', 'total_price', 'currency')
+    rows = [
+        Payment(
+            booking_id=booking_id,
+            amount=total_price,
+            currency=currency,
+            transaction_id=f"seed_{booking_id}",
+            status=rng.choices(('Success', 'Pending', 'Failed'), weights=(85, 10, 5))[0],
+        )
+        for booking_id, total_price, currency in bookings.iterator(chunk_size=batch_size)
+    ]
+    with transaction.atomic():
+        Payment.objects.bulk_create(rows, batch_size=batch_size)
+    return len(rows)
+
+
+def _spread(total, buckets):
+    """Split ``total`` as evenly as possible over ``buckets``."""
+    base, extra = divmod(total, buckets)
+    return [base + (1 if i < extra else 0) for i in range(buckets)]
 
 
 class Command(BaseCommand):
-    help = "Seed the database with sample listings"
+    help = "Seed the database with sample users, listings, bookings, reviews and payments"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=10, help="Guest/host accounts to create")
+        parser.add_argument("--listings", type=int, default=10)
+        parser.add_argument("--bookings", type=int, default=0, help="Spread evenly over listings, never overlapping")
+        parser.add_argument("--reviews", type=int, default=0, help="At most one per (listing, user)")
+        parser.add_argument("--payments", type=int, default=0, help="At most one per booking")
+        parser.add_argument("--batch-size", type=int, default=5000, help="Rows per INSERT")
+        parser.add_argument("--workers", type=int, default=1, help="Processes generating rows in parallel")
+        parser.add_argument(
+            "--seed", type=int, default=None,
+            help="Make the generated rows reproducible (primary keys too when --workers is 1)",
+        )
 
     def handle(self, *args, **options):
+        users, listings = options["users"], options["listings"]
+        bookings, reviews, payments = options["bookings"], options["reviews"], options["payments"]
+        if bookings and not listings:
+            raise CommandError("--bookings needs at least one listing.")
+        if reviews > listings * users:
+            raise CommandError("--reviews cannot exceed --listings x --users (one review per guest per listing).")
+        if payments > bookings:
+            raise CommandError("--payments cannot exceed --bookings (one payment per booking).")
+        if (bookings or reviews) and not users:
+            raise CommandError("--bookings and --reviews need at least one user.")
+
+        self.seed = options["seed"] if options["seed"] is not None else random.randrange(2**32)
+        self.batch_size = options["batch_size"]
+        self.workers = options["workers"]
+        self.stdout.write(f"Seeding with --seed {self.seed}")
+
         # Create host user if not exists
         host, created = User.objects.get_or_create(username="demo_host")
         if created:
             host.set_password("password123")
             host.save()
 
-        # Clear old data
-        Listing.objects.all().delete()
-
-        # Create sample listings
-        for _ in range(10):
-            Listing.objects.create(
-                title=fake.sentence(nb_words=4),
-                description=fake.paragraph(nb_sentences=3),
-                location=fake.city(),
-                price_per_night=random.randint(30, 200),
-                host=host,
-            )
+        self.clear()
+        user_ids = self.create_users(users)
+        pools = self.build_pools()
+
+        self.run_phase("listings", _insert_listings, [
+            (task, count, [host.pk] + user_ids, pools, self.batch_size)
+            for task, count in enumerate(_spread(listings, max(1, -(-listings // TASK_ROWS))))
+        ])
+        listing_ids = list(Listing.objects.order_by("pk").values_list("pk", flat=True))
+
+        if bookings:
+            per_listing = list(zip(listing_ids, _spread(bookings, len(listing_ids))))
+            group = max(1, TASK_ROWS // max(1, bookings // len(listing_ids)))
+            self.run_phase("bookings", _insert_bookings, [
+                (task, stays, user_ids, self.batch_size)
+                for task, stays in enumerate(_split(per_listing, group))
+            ])
+            # bulk_create skips the Booking signals that keep these in sync
+            call_command("rebuild_calendars", stdout=self.stdout)
+
+        if reviews:
+            per_listing = [(pk, n) for pk, n in zip(listing_ids, _spread(reviews, len(listing_ids))) if n]
+            group = max(1, TASK_ROWS // max(1, reviews // len(listing_ids)))
+            self.run_phase("reviews", _insert_reviews, [
+                (task, chunk, user_ids, pools, self.batch_size)
+                for task, chunk in enumerate(_split(per_listing, group))
+            ])
+            # bulk_create skips the Review signals that maintain these
+            call_command("rebuild_ratings", stdout=self.stdout)
+
+        if payments:
+            booking_ids = list(Booking.objects.order_by("pk").values_list("pk", flat=True)[:payments])
+            self.run_phase("payments", _insert_payments, [
+                (task, chunk[0], chunk[-1], self.batch_size)
+                for task, chunk in enumerate(_split(booking_ids, TASK_ROWS))
+            ])
+
+        cache.invalidate_all()
+        self.stdout.write(self.style.SUCCESS("✅ Successfully seeded the database."))
+
+    def clear(self):
+        """Empty the listings tables with plain DELETEs; the ORM would load every row to send signals."""
+        with connection.cursor() as cursor:
+            for model in (Payment, Review, Booking, ListingCalendar, ListingDailyStats, PricingRule, StayDiscount, Listing):
+                cursor.execute(f"DELETE FROM {connection.ops.quote_name(model._meta.db_table)}")
+        User.objects.filter(username__startswith="seed_user_").delete()
+
+    def create_users(self, count):
+        password = make_password("password123")
+        started = time.perf_counter()
+        User.objects.bulk_create(
+            (
+                User(username=f"seed_user_{i}", email=f"seed_user_{i}@example.com", password=password)
+                for i in range(count)
+            ),
+            batch_size=self.batch_size,
+        )
+        self.report("users", count, time.perf_counter() - started)
+        return list(
+            User.objects.filter(username__startswith="seed_user_").order_by("pk").values_list("pk", flat=True)
+        )
+
+    def build_pools(self):
+        """Small pools of Faker text; picking from them is much faster than calling Faker per row."""
+        fake = Faker()
+        fake.seed_instance(self.seed)
+        cities = [fake.city() for _ in range(200)]
+        # Faker's cities are made up, so place each one somewhere habitable
+        places = _rng(self.seed, "cities")
+        return {
+            'cities': cities,
+            'centres': {city: (places.uniform(-50, 60), places.uniform(-180, 180)) for city in cities},
+            'adjectives': ["Cozy", "Sunny", "Modern", "Quiet", "Spacious", "Charming", "Rustic", "Bright"],
+            'nouns': ["Apartment", "Cottage", "Loft", "Villa", "Studio", "Cabin", "Bungalow", "Suite"],
+            'descriptions': [fake.paragraph(nb_sentences=3) for _ in range(100)],
+            'comments': [fake.sentence(nb_words=10) for _ in range(100)],
+        }
+
+    def run_phase(self, name, func, tasks):
+        started = time.perf_counter()
+        if self.workers > 1 and len(tasks) > 1:
+            # Children must open their own connections rather than share the parent's socket
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker) as pool:
+                futures = [pool.submit(func, self.seed, *task) for task in tasks]
+                rows = sum(future.result() for future in futures)
+        else:
+            rows = sum(func(self.seed, *task) for task in tasks)
+        self.report(name, rows, time.perf_counter() - started)
 
-        self.stdout.write(self.style.SUCCESS("✅ Successfully seeded listings."))
+    def report(self, name, rows, elapsed):
+        rate = rows / elapsed if elapsed else 0
+        self.stdout.write(f"{name}: {rows} rows in {elapsed:.1f}s ({rate:,.0f} rows/sec)")
@@ -0,0 +1,169 @@
+"""
+In-process request metrics.
+
+RequestMetricsMiddleware opens a RequestTimings for every request; the
+database wrapper, the Chapa client and the serializers add their share to
+it. When the response leaves, the totals are observed into histograms
+labelled by view and method, and rendered for Prometheus by ``exposition``.
+
+Histograms live in process memory, so every worker process reports its own
+series; scrape each process (or sum them) rather than a load balancer.
+"""
+
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds in seconds, and in queries for the query-count histogram
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+
+METRICS = {
+    'http_request_duration_seconds': ("Wall time spent handling the request", DURATION_BUCKETS),
+    'db_query_duration_seconds': ("Time spent in database queries per request", DURATION_BUCKETS),
+    'db_queries_per_request': ("Database queries issued per request", COUNT_BUCKETS),
+    'outbound_http_duration_seconds': ("Time spent waiting on outbound HTTP calls per request", DURATION_BUCKETS),
+    'serializer_duration_seconds': ("Time spent in DRF serializers per request", DURATION_BUCKETS),
+}
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+
+def observe(name, labels, value):
+    """Record ``value`` in the ``name`` histogram for ``labels`` (a tuple of pairs)."""
+    key = (name, labels)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = _histograms.setdefault(key, Histogram(METRICS[name][1]))
+    histogram.observe(value)
+
+
+def reset():
+    with _histograms_lock:
+        _histograms.clear()
+
+
+def _format_labels(labels, **extra):
+    pairs = [*labels, *extra.items()]
+    inner = ','.join('{}="{}"'.format(key, str(value).replace('\\', r'\\').replace('"', r'\"')) for key, value in pairs)
+    return '{' + inner + '}' if inner else ''
+
+
+def _format_bound(bound):
+    return repr(float(bound)) if isinstance(bound, float) else str(bound)
+
+
+def exposition():
+    """All histograms in the Prometheus text format (version 0.0.4)."""
+    with _histograms_lock:
+        series = sorted(_histograms.items())
+    lines = []
+    for name, (help_text, _) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        for (series_name, labels), histogram in series:
+            if series_name != name:
+                continue
+            counts, total = histogram.snapshot()
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(labels, le=_format_bound(bound))} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'{name}_bucket{_format_labels(labels, le="+Inf")} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+class RequestTimings:
+    """What one request spent, in seconds, by component."""
+
+    __slots__ = ('started', 'db_queries', 'db', 'http', 'serializer', 'serializing')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_queries = 0
+        self.db = 0.0
+        self.http = 0.0
+        self.serializer = 0.0
+        self.serializing = False
+
+    def __call__(self, execute, sql, params, many, context):
+        # connection.execute_wrapper hook
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db += time.perf_counter() - started
+            self.db_queries += 1
+
+    def server_timing(self, total):
+        return (
+            f'app;dur={total * 1000:.1f}, '
+            f'db;dur={self.db * 1000:.1f};desc="{self.db_queries} queries", '
+            f'http;dur={self.http * 1000:.1f}, '
+            f'ser;dur={self.serializer * 1000:.1f}'
+        )
+
+    def observe(self, labels, total):
+        observe('http_request_duration_seconds', labels, total)
+        observe('db_query_duration_seconds', labels, self.db)
+        observe('db_queries_per_request', labels, self.db_queries)
+        observe('outbound_http_duration_seconds', labels, self.http)
+        observe('serializer_duration_seconds', labels, self.serializer)
+
+
+_current = contextvars.ContextVar('request_timings', default=None)
+
+
+def current():
+    """The RequestTimings of the request being handled, if any."""
+    return _current.get()
+
+
+def start():
+    timings = RequestTimings()
+    return timings, _current.set(timings)
+
+
+def finish(token):
+    _current.reset(token)
+
+
+def record_http(seconds):
+    """Charge an outbound HTTP call to the current request."""
+    timings = _current.get()
+    if timings is not None:
+        timings.http += seconds
+
+
+def record_serializer(seconds):
+    """Charge serialization done outside a DRF serializer to the current request."""
+    timings = _current.get()
+    if timings is not None:
+        timings.serializer += seconds
@@ -0,0 +1,62 @@
+import time
+
+from django.db import connections
+
+from . import metrics, routers
+
+
+class RequestMetricsMiddleware:
+    """
+    Times every request and breaks the time down into database, outbound
+    HTTP and serializer work. The totals go into the per-view histograms of
+    ``listings.metrics`` and out in a Server-Timing header.
+
+    Place it first in MIDDLEWARE so the wall time covers the whole stack.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timings, token = metrics.start()
+        # What connection.execute_wrapper() does, without a context manager per database
+        databases = connections.all()
+        for connection in databases:
+            connection.execute_wrappers.append(timings)
+        try:
+            response = self.get_response(request)
+        finally:
+            for connection in databases:
+                connection.execute_wrappers.remove(timings)
+            metrics.finish(token)
+        total = time.perf_counter() - timings.started
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unresolved'
+        timings.observe((('view', view), ('method', request.method)), total)
+        response['Server-Timing'] = timings.server_timing(total)
+        return response
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Lets GET and HEAD requests read from a replica (see ``listings.routers``)
+    and keeps clients that wrote on the primary for REPLICA_STICKY_SECONDS.
+    Views that must see the latest rows set ``replica_reads = False``.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with routers.routing() as state:
+            request.routing = state
+            response = self.get_response(request)
+        if state.wrote:
+            routers.stick(response)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view = getattr(view_func, 'cls', view_func)
+        if request.method in ('GET', 'HEAD') and getattr(view, 'replica_reads', True) and not routers.sticky(request):
+            request.routing.use_replica()
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.4 on 2026-10-18 06:10
+
+from django.db import migrations
+
+INDEX = 'listing_fulltext_idx'
+
+
+def add_fulltext_index(apps, schema_editor):
+    # Only MySQL has FULLTEXT; other backends search through listings.search.InvertedIndex
+    if schema_editor.connection.vendor != 'mysql':
+        return
+    schema_editor.execute(
+        f'ALTER TABLE listings_listing ADD FULLTEXT INDEX {INDEX} (title, description, location)'
+    )
+
+
+def drop_fulltext_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'mysql':
+        return
+    schema_editor.execute(f'ALTER TABLE listings_listing DROP INDEX {INDEX}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('listings', '0006_payment_callback_idempotency'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_fulltext_index, drop_fulltext_index),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.4 on 2026-10-18 06:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('listings', '0008_listing_coordinates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ListingCalendar',
+            fields=[
+                ('listing', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='calendar', serialize=False, to='listings.listing')),
+                ('origin', models.DateField()),
+                ('nights', models.BinaryField()),
+            ],
+        ),
+    ]
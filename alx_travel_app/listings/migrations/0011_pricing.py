@@ -0,0 +1,84 @@
+# Generated by Django 5.2.4 on 2026-10-18 07:01
+
+import django.core.validators
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_booking_totals(apps, schema_editor):
+    # Existing stays at the nightly rate they were booked under
+    Booking = apps.get_model('listings', 'Booking')
+    stays = Booking.objects.filter(total_price__isnull=True).values_list(
+        'pk', 'check_in', 'check_out', 'listing__price_per_night',
+    ).order_by('pk')
+    batch = []
+    for pk, check_in, check_out, price in stays.iterator(chunk_size=2000):
+        batch.append(Booking(pk=pk, total_price=price * (check_out - check_in).days))
+        if len(batch) == 2000:
+            Booking.objects.bulk_update(batch, ['total_price'])
+            batch = []
+    Booking.objects.bulk_update(batch, ['total_price'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('listings', '0010_payment_updated_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='booking',
+            name='currency',
+            field=models.CharField(default='ETB', max_length=3),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='total_price',
+            field=models.DecimalField(decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='listing',
+            name='currency',
+            field=models.CharField(default='ETB', max_length=3),
+        ),
+        migrations.AddField(
+            model_name='listing',
+            name='pricing_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.CreateModel(
+            name='PricingRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(blank=True, max_length=100)),
+                ('start_date', models.DateField(blank=True, null=True)),
+                ('end_date', models.DateField(blank=True, null=True)),
+                ('weekdays', models.PositiveSmallIntegerField(default=127, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(127)])),
+                ('price_per_night', models.DecimalField(decimal_places=2, max_digits=10, validators=[django.core.validators.MinValueValidator(0)])),
+                ('priority', models.SmallIntegerField(default=0)),
+                ('listing', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pricing_rules', to='listings.listing')),
+            ],
+            options={
+                'constraints': [models.CheckConstraint(condition=models.Q(('start_date__isnull', True), ('end_date__isnull', True), ('end_date__gte', models.F('start_date')), _connector='OR'), name='pricing_rule_end_after_start')],
+            },
+        ),
+        migrations.CreateModel(
+            name='StayDiscount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('min_nights', models.PositiveSmallIntegerField(validators=[django.core.validators.MinValueValidator(1)])),
+                ('percent', models.DecimalField(decimal_places=2, max_digits=5, validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(100)])),
+                ('listing', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stay_discounts', to='listings.listing')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('listing', 'min_nights'), name='stay_discount_once')],
+            },
+        ),
+        migrations.RunPython(backfill_booking_totals, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='booking',
+            name='total_price',
+            field=models.DecimalField(decimal_places=2, max_digits=10),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.4 on 2026-10-18 07:38
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('listings', '0013_payment_status_idx'),
+    ]
+
+    operations = [
+        # The replacement first, so status filters are never left without an index
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['status', 'id'], name='payment_status_id_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='payment',
+            name='payment_status_idx',
+        ),
+        migrations.AlterField(
+            model_name='booking',
+            name='listing',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='bookings', to='listings.listing'),
+        ),
+        migrations.AlterField(
+            model_name='listingdailystats',
+            name='listing',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='listings.listing'),
+        ),
+        migrations.AlterField(
+            model_name='review',
+            name='listing',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='reviews', to='listings.listing'),
+        ),
+        migrations.AlterField(
+            model_name='staydiscount',
+            name='listing',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='stay_discounts', to='listings.listing'),
+        ),
+    ]
@@ -1,8 +1,76 @@
-from django.db import models
+from django.core.validators import MaxValueValidator, MinValueValidator
+from django.db import models, transaction
+from django.db.models.functions import Coalesce, NullIf
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 
+from . import geo
+
 User = get_user_model()
 
+
+class ListingQuerySet(models.QuerySet):
+    def available_between(self, check_in, check_out):
+        """Listings with no booking overlapping the [check_in, check_out) stay."""
+        overlapping = Booking.objects.filter(listing=models.OuterRef('pk')).overlapping(check_in, check_out)
+        return self.exclude(models.Exists(overlapping))
+
+    def near(self, latitude, longitude, radius_km):
+        """
+        Listings in the grid cells and bounding box around the circle.
+
+        A superset of the listings within ``radius_km``; see listings.geo
+        for the exact distance check.
+        """
+        cells = models.Q()
+        for first, last in geo.cell_ranges(latitude, longitude, radius_km):
+            cells |= models.Q(geocell__range=(first, last))
+        (south, north), spans = geo.bounding_box(latitude, longitude, radius_km)
+        box = models.Q()
+        for west, east in spans:
+            box |= models.Q(longitude__range=(west, east))
+        return self.filter(cells, box, latitude__range=(south, north))
+
+    def rebuild_rating_aggregates(self):
+        """
+        Recompute review_count/rating_sum from the reviews table in one UPDATE.
+
+        Returns the number of listings touched.
+        """
+        reviews = Review.objects.filter(listing=models.OuterRef('pk')).order_by().values('listing')
+        return self.update(
+            review_count=Coalesce(models.Subquery(reviews.annotate(n=models.Count('pk')).values('n')), 0),
+            rating_sum=Coalesce(models.Subquery(reviews.annotate(total=models.Sum('rating')).values('total')), 0),
+        )
+
+
+class BookingConflict(Exception):
+    """
+    Raised when a stay overlaps an existing booking on the same listing.
+    """
+
+
+class BookingQuerySet(models.QuerySet):
+    def overlapping(self, check_in, check_out):
+        """Bookings sharing at least one night with the [check_in, check_out) stay."""
+        return self.filter(check_in__lt=check_out, check_out__gt=check_in)
+
+    def reserve(self, listing, check_in, check_out, exclude=None):
+        """
+        Lock ``listing`` and raise BookingConflict if the stay is already taken.
+
+        Must run inside ``transaction.atomic()``. The lock is the listing row
+        itself, held until commit, so concurrent writers for the same listing
+        queue up while writers for other listings proceed in parallel.
+        """
+        list(Listing.objects.select_for_update().filter(pk=listing.pk).values_list('pk'))
+        clashes = self.filter(listing=listing).overlapping(check_in, check_out)
+        if exclude is not None:
+            clashes = clashes.exclude(pk=exclude.pk)
+        if clashes.exists():
+            raise BookingConflict(f"Listing {listing.pk} is already booked between {check_in} and {check_out}")
+
+
 class Listing(models.Model):
     """
     A place that can be booked.
@@ -11,8 +79,43 @@ class Listing(models.Model):
     description = models.TextField()
     location = models.CharField(max_length=255)
     price_per_night = models.DecimalField(max_digits=10, decimal_places=2)
+    currency = models.CharField(max_length=3, default="ETB")
+    # Bumped by every PricingRule/StayDiscount write; keys memoized quotes, see listings.pricing
+    pricing_version = models.PositiveIntegerField(default=0, editable=False)
     host = models.ForeignKey(User, on_delete=models.CASCADE, related_name='listings')
+    latitude = models.FloatField(
+        null=True, blank=True, validators=[MinValueValidator(-90), MaxValueValidator(90)],
+    )
+    longitude = models.FloatField(
+        null=True, blank=True, validators=[MinValueValidator(-180), MaxValueValidator(180)],
+    )
+    # Derived from the coordinates in save(); see listings.geo
+    geocell = models.PositiveIntegerField(null=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Maintained incrementally from Review writes; see listings.signals
+    review_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_avg = models.GeneratedField(
+        expression=Coalesce(models.F('rating_sum') * 1.0 / NullIf(models.F('review_count'), 0), 0.0),
+        output_field=models.FloatField(),
+        db_persist=True,
+    )
+
+    objects = ListingQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='listing_created_idx'),
+            models.Index(fields=['rating_avg', 'id'], name='listing_rating_idx'),
+            models.Index(fields=['geocell'], name='listing_geocell_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.geocell = geo.cell_for(self.latitude, self.longitude)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'latitude', 'longitude'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'geocell'}
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.title
@@ -22,26 +125,130 @@ class Booking(models.Model):
     """
     A booking made by a user for a listing.
     """
-    listing = models.ForeignKey(Listing, on_delete=models.CASCADE, related_name='bookings')
+    # Indexed as the leading column of booking_listing_dates_idx
+    listing = models.ForeignKey(Listing, on_delete=models.CASCADE, related_name='bookings', db_index=False)
     guest = models.ForeignKey(User, on_delete=models.CASCADE, related_name='bookings')
     check_in = models.DateField()
     check_out = models.DateField()
+    # Quoted when the stay is first saved and whenever it changes; see listings.pricing
+    total_price = models.DecimalField(max_digits=10, decimal_places=2)
+    currency = models.CharField(max_length=3, default="ETB")
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = BookingQuerySet.as_manager()
 
     class Meta:
         constraints = [
             models.CheckConstraint(check=models.Q(check_out__gt=models.F('check_in')), name='check_out_after_check_in')
         ]
+        indexes = [
+            # Serves the per-listing date-range overlap probe behind availability search.
+            models.Index(fields=['listing', 'check_in', 'check_out'], name='booking_listing_dates_idx'),
+            models.Index(fields=['created_at', 'id'], name='booking_created_idx'),
+            # Keyset order of incremental finance exports; edits re-price a stay
+            models.Index(fields=['updated_at', 'id'], name='booking_updated_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember which nights the listing calendar currently holds for this booking
+        instance._occupied = tuple(instance.__dict__.get(name) for name in ('listing_id', 'check_in', 'check_out'))
+        return instance
+
+    def save(self, *args, **kwargs):
+        stay = (self.listing_id, self.check_in, self.check_out)
+        if self.total_price is None or getattr(self, '_occupied', stay) != stay:
+            from . import pricing
+            quote = pricing.quote(self.listing, self.check_in, self.check_out)
+            self.total_price, self.currency = quote.total, quote.currency
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'total_price', 'currency'}
+        # Keep the booking row and the listing calendar in one transaction
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.guest} booked {self.listing} from {self.check_in} to {self.check_out}"
 
 
+class ListingCalendar(models.Model):
+    """
+    Occupancy bitmap of a listing: bit ``i`` of ``nights`` is set when the
+    night of ``origin + i days`` is booked. Derived from bookings; see
+    listings.occupancy.
+    """
+    listing = models.OneToOneField(Listing, on_delete=models.CASCADE, primary_key=True, related_name='calendar')
+    origin = models.DateField()
+    nights = models.BinaryField()
+
+    def __str__(self):
+        return f"Calendar of listing {self.listing_id} from {self.origin}"
+
+
+class PricingRule(models.Model):
+    """
+    A nightly price that replaces a listing's price_per_night on the nights
+    it covers: those from start_date to end_date (both inclusive, either
+    may be open) that fall on one of ``weekdays``. Where rules overlap the
+    highest priority wins; see listings.pricing.
+    """
+    # Bit i of ``weekdays`` is set for nights starting on date.weekday() == i
+    EVERY_DAY = 0b1111111
+    WEEKEND = 0b0110000  # Friday and Saturday nights
+
+    listing = models.ForeignKey(Listing, on_delete=models.CASCADE, related_name='pricing_rules')
+    name = models.CharField(max_length=100, blank=True)
+    start_date = models.DateField(null=True, blank=True)
+    end_date = models.DateField(null=True, blank=True)
+    weekdays = models.PositiveSmallIntegerField(
+        default=EVERY_DAY, validators=[MinValueValidator(1), MaxValueValidator(EVERY_DAY)],
+    )
+    price_per_night = models.DecimalField(max_digits=10, decimal_places=2, validators=[MinValueValidator(0)])
+    priority = models.SmallIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                check=models.Q(start_date__isnull=True) | models.Q(end_date__isnull=True)
+                | models.Q(end_date__gte=models.F('start_date')),
+                name='pricing_rule_end_after_start',
+            ),
+        ]
+
+    def __str__(self):
+        return self.name or f"{self.listing} at {self.price_per_night}"
+
+
+class StayDiscount(models.Model):
+    """
+    A percentage off the nightly total of stays of at least ``min_nights``;
+    a stay gets the largest discount it qualifies for.
+    """
+    # Indexed as the leading column of stay_discount_once
+    listing = models.ForeignKey(Listing, on_delete=models.CASCADE, related_name='stay_discounts', db_index=False)
+    min_nights = models.PositiveSmallIntegerField(validators=[MinValueValidator(1)])
+    percent = models.DecimalField(
+        max_digits=5, decimal_places=2, validators=[MinValueValidator(0), MaxValueValidator(100)],
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['listing', 'min_nights'], name='stay_discount_once'),
+        ]
+
+    def __str__(self):
+        return f"{self.percent}% off {self.min_nights}+ nights at {self.listing}"
+
+
 class Review(models.Model):
     """
     A review given by a guest for a listing.
     """
-    listing = models.ForeignKey(Listing, on_delete=models.CASCADE, related_name='reviews')
+    # Indexed as the leading column of the (listing, guest) unique index
+    listing = models.ForeignKey(Listing, on_delete=models.CASCADE, related_name='reviews', db_index=False)
     guest = models.ForeignKey(User, on_delete=models.CASCADE, related_name='reviews')
     rating = models.PositiveSmallIntegerField()  # 1 to 5
     comment = models.TextField(blank=True)
@@ -50,9 +257,63 @@ class Review(models.Model):
     class Meta:
         unique_together = ('listing', 'guest')
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember what the listing aggregates currently count for this review
+        instance._counted = (instance.__dict__.get('listing_id'), instance.__dict__.get('rating'))
+        return instance
+
+    def save(self, *args, **kwargs):
+        # Keep the review row and the listing aggregates in one transaction
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+
     def __str__(self):
         return f"{self.guest} rated {self.listing} {self.rating}/5"
 
+
+class ListingDailyStats(models.Model):
+    """
+    One day of a listing's bookings, payments and reviews, summed for host
+    analytics. Rows are rebuilt by listings.analytics.refresh_rollup and
+    only exist for days with some activity.
+    """
+    # Indexed as the leading column of listing_daily_stats_once
+    listing = models.ForeignKey(Listing, on_delete=models.CASCADE, related_name='daily_stats', db_index=False)
+    day = models.DateField()
+    # Bookings count under the currency they were quoted in, reviews under the listing's
+    currency = models.CharField(max_length=3)
+    # Bookings holding the night that starts on ``day``
+    nights_booked = models.PositiveIntegerField(default=0)
+    # Bookings checking in on ``day``, their summed lead time and Success payments
+    bookings = models.PositiveIntegerField(default=0)
+    lead_days = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    # Reviews written on ``day`` in TIME_ZONE
+    reviews = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['listing', 'day', 'currency'], name='listing_daily_stats_once'),
+        ]
+
+    def __str__(self):
+        return f"Stats of listing {self.listing_id} on {self.day}"
+
+class PaymentQuerySet(models.QuerySet):
+    def settle(self, status):
+        """
+        Move the Pending payments in this queryset to ``status``.
+
+        A conditional UPDATE ... WHERE status='Pending', so concurrent or
+        replayed callers race safely; the return value is how many rows
+        actually changed, and side effects should fire only when it's > 0.
+        """
+        return self.filter(status='Pending').update(status=status, updated_at=timezone.now())
+
+
 class Payment(models.Model):
     STATUS_CHOICES = [
         ('Pending', 'Pending'),
@@ -63,10 +324,62 @@ class Payment(models.Model):
     booking = models.OneToOneField(Booking, on_delete=models.CASCADE)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     currency = models.CharField(max_length=3, default="ETB")
-    transaction_id = models.CharField(max_length=100, blank=True, null=True)
+    transaction_id = models.CharField(max_length=100, blank=True, null=True, unique=True)
+    checkout_url = models.URLField(max_length=500, blank=True)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='Pending')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = PaymentQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Keyset order of incremental finance exports
+            models.Index(fields=['updated_at', 'id'], name='payment_updated_idx'),
+            # Status filters in pk order: the admin's, and the stale Pending walk of reconciliation
+            models.Index(fields=['status', 'id'], name='payment_status_id_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.booking.guest.username} - {self.amount} - {self.status}"
+
+
+class PaymentEvent(models.Model):
+    """
+    Ledger of processed Chapa callbacks; a replay of the same
+    (tx_ref, status) pair is recognised and ignored.
+    """
+    tx_ref = models.CharField(max_length=100)
+    status = models.CharField(max_length=10, choices=Payment.STATUS_CHOICES)
+    received_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['tx_ref', 'status'], name='payment_event_once'),
+        ]
+
+    def __str__(self):
+        return f"{self.tx_ref} -> {self.status}"
+
+class PendingConfirmation(models.Model):
+    """
+    A booking or payment confirmation email waiting for its batch. The row
+    outlives worker restarts and goes once the email was sent or handed to
+    a retrying task (see listings.mail).
+    """
+    KIND_CHOICES = [
+        ('booking', 'Booking'),
+        ('payment', 'Payment'),
+    ]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    object_id = models.PositiveBigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'object_id'], name='pending_confirmation_once'),
+        ]
+
     def __str__(self):
-        return f"{self.booking.user.username} - {self.amount} - {self.status}"
\ No newline at end of file
+        return f"{self.kind} confirmation {self.object_id}"
@@ -0,0 +1,162 @@
+"""
+Materialized occupancy calendars.
+
+Every listing can have a ListingCalendar row: a bitmap with one bit per
+night from the first of the current month over
+LISTING_CALENDAR_HORIZON_DAYS nights (92 bytes for two years). Booking
+writes update it in their own transaction (see listings.signals), so a
+month of occupancy is one primary-key read instead of a scan of the
+listing's bookings.
+
+Rows are built lazily: a missing row, or one whose origin is an earlier
+month, is rebuilt from the bookings table by the next write or read that
+needs it. ``rebuild_calendars`` builds them in bulk and
+``check_calendars`` compares them with the bookings.
+"""
+
+import calendar
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Booking, Listing, ListingCalendar
+
+
+class OutsideHorizon(Exception):
+    """
+    Raised when asked about nights the calendars do not cover.
+    """
+
+
+def horizon():
+    """(first night, number of nights) that calendars cover today."""
+    return timezone.localdate().replace(day=1), settings.LISTING_CALENDAR_HORIZON_DAYS
+
+
+def _span(origin, nights, check_in, check_out):
+    """Mask of the [check_in, check_out) nights that fall inside the calendar."""
+    start = max((check_in - origin).days, 0)
+    end = min((check_out - origin).days, nights)
+    if end <= start:
+        return 0
+    return ((1 << (end - start)) - 1) << start
+
+
+def encode(bits, nights):
+    return bits.to_bytes((nights + 7) // 8, 'little')
+
+
+def decode(raw):
+    return int.from_bytes(raw, 'little')
+
+
+def _is_current(row_origin, raw, origin, nights):
+    return row_origin == origin and len(raw) == (nights + 7) // 8
+
+
+def build(listing_ids, origin, nights):
+    """Bitmaps of ``listing_ids`` computed from their bookings, in one query."""
+    bitmaps = dict.fromkeys(listing_ids, 0)
+    stays = Booking.objects.filter(listing_id__in=listing_ids).overlapping(
+        origin, origin + timedelta(days=nights),
+    ).order_by().values_list('listing_id', 'check_in', 'check_out')
+    for listing_id, check_in, check_out in stays.iterator(chunk_size=10000):
+        bitmaps[listing_id] |= _span(origin, nights, check_in, check_out)
+    return bitmaps
+
+
+def rebuild(listing_ids):
+    """Recompute and store the calendars of existing ``listing_ids``; returns the bitmaps."""
+    origin, nights = horizon()
+    bitmaps = build(listing_ids, origin, nights)
+    # MySQL upserts on any unique key and rejects an explicit conflict target
+    target = {'unique_fields': ['listing']} if connection.features.supports_update_conflicts_with_target else {}
+    ListingCalendar.objects.bulk_create(
+        [ListingCalendar(listing_id=pk, origin=origin, nights=encode(bits, nights)) for pk, bits in bitmaps.items()],
+        update_conflicts=True, update_fields=['origin', 'nights'], **target,
+    )
+    return bitmaps
+
+
+def sync(listing_id, booked=None, freed=None, create=True):
+    """
+    Apply a booking write to one listing's calendar.
+
+    ``booked`` is a (check_in, check_out) stay that is now taken. ``freed``
+    is one that may no longer be; its nights are re-read from the bookings
+    table, since another booking may still hold some of them. Runs inside
+    the writer's transaction and locks the calendar row until commit. With
+    ``create=False`` a missing or outdated row is left for the next reader
+    to rebuild, which keeps cascading deletes from re-creating it.
+    """
+    origin, nights = horizon()
+    row = ListingCalendar.objects.select_for_update().filter(listing_id=listing_id).first()
+    if row is None or not _is_current(row.origin, row.nights, origin, nights):
+        if create:
+            # Serialise with other writers of this listing, as Booking.objects.reserve does
+            list(Listing.objects.select_for_update().filter(pk=listing_id).values_list('pk'))
+            rebuild([listing_id])
+        return
+
+    bits = decode(row.nights)
+    if freed is not None:
+        mask = _span(origin, nights, *freed)
+        if mask:
+            bits &= ~mask
+            holders = Booking.objects.filter(listing_id=listing_id).overlapping(*freed).values_list('check_in', 'check_out')
+            for check_in, check_out in holders:
+                bits |= _span(origin, nights, check_in, check_out) & mask
+    if booked is not None:
+        bits |= _span(origin, nights, *booked)
+    ListingCalendar.objects.filter(listing_id=listing_id).update(nights=encode(bits, nights))
+
+
+def booked_nights(listing_id, year, month):
+    """
+    Whether each night of the month is booked, as a list of booleans, or
+    None when the listing does not exist.
+    """
+    origin, nights = horizon()
+    first = date(year, month, 1)
+    days = calendar.monthrange(year, month)[1]
+    start = (first - origin).days
+    if start < 0 or start + days > nights:
+        raise OutsideHorizon(f"Calendars cover {origin} to {origin + timedelta(days=nights - 1)}")
+
+    row = ListingCalendar.objects.filter(listing_id=listing_id).values_list('origin', 'nights').first()
+    if row is not None and _is_current(*row, origin, nights):
+        bits = decode(row[1])
+    else:
+        if not Listing.objects.filter(pk=listing_id).exists():
+            return None
+        with transaction.atomic():
+            bits = rebuild([listing_id])[listing_id]
+    bits >>= start
+    return [bool(bits >> day & 1) for day in range(days)]
+
+
+def check(listing_ids):
+    """
+    Compare the stored calendars of ``listing_ids`` with their bookings.
+
+    Returns a dict of listing id lists: ``mismatched`` rows disagree with
+    the bookings, ``outdated`` rows (and ``missing`` ones) would be rebuilt
+    on next use anyway.
+    """
+    origin, nights = horizon()
+    stored = {
+        pk: (row_origin, raw) for pk, row_origin, raw in
+        ListingCalendar.objects.filter(listing_id__in=listing_ids).values_list('listing_id', 'origin', 'nights')
+    }
+    expected = build(listing_ids, origin, nights)
+    result = {'mismatched': [], 'outdated': [], 'missing': []}
+    for pk in listing_ids:
+        if pk not in stored:
+            result['missing'].append(pk)
+        elif not _is_current(*stored[pk], origin, nights):
+            result['outdated'].append(pk)
+        elif decode(stored[pk][1]) != expected[pk]:
+            result['mismatched'].append(pk)
+    return result
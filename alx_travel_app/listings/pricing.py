@@ -0,0 +1,169 @@
+"""
+Stay quotes.
+
+A night costs the listing's price_per_night unless a PricingRule covers
+it, in which case the rule with the highest priority sets the price. The
+largest StayDiscount the stay is long enough for then comes off the sum.
+
+Quotes don't walk the stay night by night. The rules' start and end dates
+cut the stay into segments in which the same rules apply, and within a
+segment each weekday occurs a number of times that follows from the
+segment's length. A quote costs O(rules) whatever the number of nights.
+
+Each process memoizes loaded schedules and computed quotes in LRU caches
+keyed by the listing's pricing: its pricing_version (bumped by every rule
+or discount write, see listings.signals), base price and currency. A
+change makes the old entries unreachable and they age out.
+"""
+
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.conf import settings
+
+from .models import PricingRule, StayDiscount
+
+CENTS = Decimal('0.01')
+
+
+class LRUCache:
+    """A thread-safe least-recently-used mapping with hit and miss counts."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_or_set(self, key, compute):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+        value = compute()
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return value
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+
+schedules = LRUCache(settings.PRICING_SCHEDULE_CACHE_SIZE)
+quotes = LRUCache(settings.PRICING_QUOTE_CACHE_SIZE)
+
+
+def clear_caches():
+    schedules.clear()
+    quotes.clear()
+
+
+class Quote:
+    def __init__(self, listing_id, check_in, check_out, currency, subtotal, discount):
+        self.listing_id = listing_id
+        self.check_in = check_in
+        self.check_out = check_out
+        self.nights = (check_out - check_in).days
+        self.currency = currency
+        self.subtotal = subtotal
+        self.discount = discount
+        self.total = subtotal - discount
+
+
+class Schedule:
+    """A listing's prices: base price, currency, rules and stay discounts."""
+
+    def __init__(self, base_price, currency, rules=(), discounts=()):
+        self.base_price = Decimal(base_price)
+        self.currency = currency
+        # (first night, night after the last or None, weekdays, price), highest precedence first
+        self.rules = list(rules)
+        # (min_nights, percent), longest stays first
+        self.discounts = sorted(discounts, reverse=True)
+
+    def nightly_total(self, check_in, check_out):
+        """Sum of the prices of the nights [check_in, check_out)."""
+        cuts = {check_in, check_out}
+        for start, end, _, _ in self.rules:
+            cuts.update(cut for cut in (start, end) if cut is not None and check_in < cut < check_out)
+        cuts = sorted(cuts)
+
+        total = Decimal(0)
+        for first, last in zip(cuts, cuts[1:]):
+            active = [
+                (weekdays, price) for start, end, weekdays, price in self.rules
+                if (start is None or start <= first) and (end is None or first < end)
+            ]
+            # The segment's nights start on each weekday ``weeks`` times, plus once
+            # more for the first ``extra`` weekdays from its first night
+            weeks, extra = divmod((last - first).days, 7)
+            for offset in range(7 if weeks else extra):
+                weekday = (first.weekday() + offset) % 7
+                price = next((price for weekdays, price in active if weekdays >> weekday & 1), self.base_price)
+                total += price * (weeks + (offset < extra))
+        return total
+
+    def discount_percent(self, nights):
+        return next((percent for min_nights, percent in self.discounts if nights >= min_nights), Decimal(0))
+
+    def quote(self, listing_id, check_in, check_out):
+        subtotal = self.nightly_total(check_in, check_out).quantize(CENTS, ROUND_HALF_UP)
+        percent = self.discount_percent((check_out - check_in).days)
+        discount = (subtotal * percent / 100).quantize(CENTS, ROUND_HALF_UP)
+        return Quote(listing_id, check_in, check_out, self.currency, subtotal, discount)
+
+
+def _pricing_key(listing):
+    return (listing.pk, listing.pricing_version, listing.price_per_night, listing.currency)
+
+
+def _rule_row(start, end, weekdays, price):
+    return (start, end + timedelta(days=1) if end is not None else None, weekdays, price)
+
+
+def load_schedules(listings):
+    """Schedules of ``listings`` by pk, with two queries for all of them."""
+    rules, discounts = {}, {}
+    listing_ids = [listing.pk for listing in listings]
+    for listing_id, *row in PricingRule.objects.filter(listing_id__in=listing_ids).order_by(
+        'listing_id', '-priority', '-pk',
+    ).values_list('listing_id', 'start_date', 'end_date', 'weekdays', 'price_per_night'):
+        rules.setdefault(listing_id, []).append(_rule_row(*row))
+    for listing_id, min_nights, percent in StayDiscount.objects.filter(listing_id__in=listing_ids).values_list(
+        'listing_id', 'min_nights', 'percent',
+    ):
+        discounts.setdefault(listing_id, []).append((min_nights, percent))
+    return {
+        listing.pk: Schedule(
+            listing.price_per_night, listing.currency, rules.get(listing.pk, ()), discounts.get(listing.pk, ()),
+        )
+        for listing in listings
+    }
+
+
+def prime(listings):
+    """Load the schedules of ``listings`` that aren't cached yet, in one go."""
+    missing = {_pricing_key(listing): listing for listing in listings if _pricing_key(listing) not in schedules}
+    if missing:
+        loaded = load_schedules(list(missing.values()))
+        for key, listing in missing.items():
+            schedules.get_or_set(key, lambda: loaded[listing.pk])
+
+
+def quote(listing, check_in, check_out):
+    """The Quote for staying at ``listing`` over the nights [check_in, check_out)."""
+    key = _pricing_key(listing)
+    schedule = schedules.get_or_set(key, lambda: load_schedules([listing])[listing.pk])
+    return quotes.get_or_set((*key, check_in, check_out), lambda: schedule.quote(listing.pk, check_in, check_out))
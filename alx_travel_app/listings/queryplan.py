@@ -0,0 +1,110 @@
+"""
+Query plan checks for tests.
+
+``full_scans`` asks the database how it would run a captured statement
+and returns the tables it would read row by row from start to end.
+``check`` does so for every statement of a CaptureQueriesContext and
+keeps the scans of tables holding at least ``min_rows`` rows: on small
+tables a scan is often the cheapest plan, on large ones it is the bug.
+
+SQLite's EXPLAIN QUERY PLAN and MySQL's EXPLAIN are understood. Reading
+a table or index from one end counts (SQLite's SCAN, MySQL's ALL and
+index types) unless the statement has a LIMIT and needs no sort: that is
+how an ORDER BY ... LIMIT page is read, and it stops after the page.
+"""
+
+import re
+
+from django.db import connections
+
+SUPPORTED_VENDORS = ('sqlite', 'mysql')
+
+# Only these statements have plans; savepoints, INSERTs and the like don't
+EXPLAINABLE = re.compile(r'\s*(SELECT|UPDATE|DELETE|WITH)\b', re.IGNORECASE)
+
+# Django quotes table names and aliases subqueries and self-joins as U0, T3, ...
+TABLE_ALIAS = re.compile(r'(?:FROM|JOIN)\s+[`"](\w+)[`"](?:\s+(?:AS\s+)?[`"]?([A-Z]\d+)\b)?')
+
+SQLITE_SCAN = re.compile(r'SCAN (\w+)(?: AS (\w+))?')
+
+LIMITED = re.compile(r'\bLIMIT \d+(?: OFFSET \d+)?\s*$', re.IGNORECASE)
+
+
+class FullScan:
+    def __init__(self, table, rows, sql, plan):
+        self.table = table
+        self.rows = rows
+        self.sql = sql
+        self.plan = plan
+
+    def __repr__(self):
+        return f"<FullScan of {self.table}>"
+
+    def __str__(self):
+        plan = '\n    '.join(self.plan)
+        return f"Full scan of {self.table} ({self.rows} rows):\n  {self.sql}\n  plan:\n    {plan}"
+
+
+def aliases(sql):
+    """Table names by the names the statement refers to them with."""
+    names = {}
+    for table, alias in TABLE_ALIAS.findall(sql):
+        names[table] = table
+        if alias:
+            names[alias] = table
+    return names
+
+
+def _sqlite_plan(cursor, sql):
+    cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+    plan = [row[-1] for row in cursor.fetchall()]
+    if LIMITED.search(sql) and not any('TEMP B-TREE FOR ORDER BY' in detail for detail in plan):
+        return [], plan
+    scanned = []
+    for detail in plan:
+        match = SQLITE_SCAN.match(detail)
+        if match:
+            scanned.append(match.group(2) or match.group(1))
+    return scanned, plan
+
+
+def _mysql_plan(cursor, sql):
+    cursor.execute('EXPLAIN ' + sql)
+    columns = [column[0] for column in cursor.description]
+    rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    plan = [f"{row['table']}: type={row['type']} key={row['key']} rows={row['rows']} {row['Extra'] or ''}" for row in rows]
+    if LIMITED.search(sql) and not any('filesort' in (row['Extra'] or '') for row in rows):
+        return [], plan
+    return [row['table'] for row in rows if row['type'] in ('ALL', 'index')], plan
+
+
+def full_scans(sql, using='default'):
+    """(tables ``sql`` reads in full, the plan as text lines); ([], []) for statements without a plan."""
+    connection = connections[using]
+    if connection.vendor not in SUPPORTED_VENDORS:
+        raise NotImplementedError(f"No query plan support for {connection.vendor}")
+    if not EXPLAINABLE.match(sql):
+        return [], []
+    explain = _sqlite_plan if connection.vendor == 'sqlite' else _mysql_plan
+    with connection.cursor() as cursor:
+        scanned, plan = explain(cursor, sql)
+    names = aliases(sql)
+    tables = set(connection.introspection.table_names())
+    return [names.get(name, name) for name in scanned if names.get(name, name) in tables], plan
+
+
+def check(queries, min_rows, using='default'):
+    """FullScans of tables with at least ``min_rows`` rows among ``queries`` (CaptureQueriesContext items)."""
+    connection = connections[using]
+    counts = {}
+    found = []
+    for query in queries:
+        tables, plan = full_scans(query['sql'], using)
+        for table in tables:
+            if table not in counts:
+                with connection.cursor() as cursor:
+                    cursor.execute(f'SELECT COUNT(*) FROM {connection.ops.quote_name(table)}')
+                    counts[table] = cursor.fetchone()[0]
+            if counts[table] >= min_rows:
+                found.append(FullScan(table, counts[table], query['sql'], plan))
+    return found
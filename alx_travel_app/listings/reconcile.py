@@ -0,0 +1,130 @@
+"""
+Reconciliation of payments whose Chapa callback never arrived.
+
+Stale Pending payments are walked in primary-key order, one chunk at a
+time. Each chunk is verified against Chapa through a bounded thread pool,
+and the resolved statuses are written back with a single ``bulk_update``
+that only touches rows that are still Pending.
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import mail
+from .chapa import ChapaError, get_client
+from .models import Payment
+
+logger = logging.getLogger(__name__)
+
+# Chapa transaction statuses that settle a payment
+RESOLVED = {'success': 'Success', 'failed': 'Failed', 'cancelled': 'Failed'}
+
+
+def stale_payments(older_than):
+    """Pending payments created more than ``older_than`` ago that Chapa knows about."""
+    return Payment.objects.filter(
+        status='Pending', created_at__lt=timezone.now() - older_than,
+    ).exclude(transaction_id=None)
+
+
+def chapa_status(client, tx_ref):
+    """The Payment status Chapa reports for ``tx_ref``, or None while it is unresolved."""
+    response = client.verify(tx_ref)
+    if response.status_code != 200:
+        return None
+    return RESOLVED.get(response.json().get('data', {}).get('status'))
+
+
+class Reconciliation:
+    """
+    One reconciliation run. ``stats`` holds the progress counters, which are
+    logged after every chunk and passed to ``progress`` if given.
+    """
+
+    def __init__(self, older_than=None, chunk_size=None, workers=None, dry_run=False,
+                 client=None, progress=None):
+        if older_than is None:
+            older_than = timedelta(minutes=settings.PAYMENT_RECONCILE_AFTER_MINUTES)
+        self.older_than = older_than
+        self.chunk_size = chunk_size or settings.PAYMENT_RECONCILE_CHUNK_SIZE
+        self.workers = workers or settings.PAYMENT_RECONCILE_WORKERS
+        self.dry_run = dry_run
+        self.client = client or get_client()
+        self.progress = progress
+        self.stats = {
+            'chunks': 0, 'scanned': 0, 'success': 0, 'failed': 0,
+            'unresolved': 0, 'errors': 0, 'updated': 0, 'elapsed': 0.0,
+        }
+
+    def run(self):
+        started = time.perf_counter()
+        stale = stale_payments(self.older_than).order_by('pk').only('pk', 'transaction_id', 'status')
+        last_pk = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while True:
+                # Keyset pagination: each chunk starts after the last pk seen
+                chunk = list(stale.filter(pk__gt=last_pk)[:self.chunk_size])
+                if not chunk:
+                    break
+                last_pk = chunk[-1].pk
+                self.reconcile_chunk(chunk, pool)
+                self.stats['elapsed'] = time.perf_counter() - started
+                self.report()
+        self.stats['elapsed'] = time.perf_counter() - started
+        return self.stats
+
+    def reconcile_chunk(self, chunk, pool):
+        self.stats['chunks'] += 1
+        self.stats['scanned'] += len(chunk)
+        resolved = []
+        for payment, status in zip(chunk, pool.map(self.verify, chunk)):
+            if status in ('unresolved', 'errors'):
+                self.stats[status] += 1
+                continue
+            self.stats[status.lower()] += 1
+            payment.status = status
+            payment.updated_at = timezone.now()
+            resolved.append(payment)
+        if resolved and not self.dry_run:
+            self.stats['updated'] += self.apply(resolved)
+
+    def verify(self, payment):
+        """Runs on the pool; returns a Payment status or the stats counter to bump."""
+        try:
+            return chapa_status(self.client, payment.transaction_id) or 'unresolved'
+        except ChapaError as exc:
+            logger.warning("Could not verify %s: %s", payment.transaction_id, exc)
+            return 'errors'
+
+    def apply(self, resolved):
+        with transaction.atomic():
+            # A callback may have settled some of these while Chapa was being asked
+            still_pending = set(
+                Payment.objects.select_for_update()
+                .filter(pk__in=[payment.pk for payment in resolved], status='Pending')
+                .values_list('pk', flat=True)
+            )
+            resolved = [payment for payment in resolved if payment.pk in still_pending]
+            Payment.objects.bulk_update(resolved, ['status', 'updated_at'])
+            confirmations = [[mail.PAYMENT, payment.pk] for payment in resolved if payment.status == 'Success']
+            if confirmations:
+                from .tasks import send_confirmation_batch
+                transaction.on_commit(lambda: send_confirmation_batch.delay(confirmations))
+        return len(resolved)
+
+    def report(self):
+        stats = self.stats
+        rate = stats['scanned'] / stats['elapsed'] if stats['elapsed'] else 0
+        logger.info(
+            "Reconciled chunk %d%s: %d scanned (%.0f/s), %d success, %d failed, %d unresolved, %d errors",
+            stats['chunks'], " (dry run)" if self.dry_run else "", stats['scanned'], rate,
+            stats['success'], stats['failed'], stats['unresolved'], stats['errors'],
+        )
+        if self.progress:
+            self.progress(dict(stats))
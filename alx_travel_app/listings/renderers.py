@@ -0,0 +1,90 @@
+import json
+from collections import Counter
+
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils import encoders
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speed-up
+    orjson = None
+
+# Every float orjson writes differently contains one of these: small ones
+# start 0.0000 and the exponent of large ones is 16 to 308. Text can match
+# too, which only costs a look at the data.
+SUSPECT_FLOAT_MARKERS = (b'0.0000', b'e-', b'e1', b'e2', b'e3')
+
+# Each distinct unportable float costs two passes over the output
+MAX_FLOAT_REWRITES = 8
+
+_encoder = encoders.JSONEncoder()
+
+
+def _unportable_floats(data, found):
+    """
+    Count the floats in ``data`` that orjson writes differently from
+    json.dumps: it keeps small ones positional (0.00001 vs 1e-05) and drops
+    the exponent sign of large ones (1e16 vs 1e+16).
+    """
+    for value in data.values() if isinstance(data, dict) else data:
+        if isinstance(value, float):
+            if value and not 1e-4 <= abs(value) < 1e16:
+                found[value] += 1
+        elif isinstance(value, (dict, list, tuple)):
+            _unportable_floats(value, found)
+    return found
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer that encodes with orjson when it is installed.
+
+    The bytes are the same as JSONRenderer's: compact separators, UTF-8
+    rather than \\u escapes, U+2028/U+2029 escaped, floats as json.dumps
+    writes them and datetimes and other non-JSON types converted by DRF's
+    encoder. Whenever orjson can't guarantee that (indented output,
+    non-default settings or values it rejects) the stdlib renders instead.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        ret = self._orjson_render(data, accepted_media_type, renderer_context or {})
+        if ret is None:
+            return super().render(data, accepted_media_type, renderer_context)
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
+
+    def _orjson_render(self, data, accepted_media_type, renderer_context):
+        """orjson's rendering of ``data``, or None when it might differ from JSONRenderer's."""
+        if orjson is None or not isinstance(data, (dict, list)):
+            return None
+        if self.ensure_ascii or not (self.compact and self.strict):
+            return None
+        if self.get_indent(accepted_media_type, renderer_context) is not None:
+            return None
+
+        converted = []
+
+        def default(obj):
+            value = _encoder.default(obj)
+            converted.append(value)
+            return value
+
+        try:
+            ret = orjson.dumps(data, default=default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+        except TypeError:
+            return None
+        # The encoder's output (Decimal to float, iterables to lists) isn't checked below
+        if any(not isinstance(value, str) for value in converted):
+            return None
+
+        if not any(marker in ret for marker in SUSPECT_FLOAT_MARKERS):
+            return ret
+        unportable = _unportable_floats(data, Counter())
+        if len(unportable) > MAX_FLOAT_REWRITES:
+            return None
+        for value, count in unportable.items():
+            token = orjson.dumps(value)
+            # Only when every occurrence is this number; it could also be text in a string
+            if ret.count(token) != count:
+                return None
+            ret = ret.replace(token, json.dumps(value).encode())
+        return ret
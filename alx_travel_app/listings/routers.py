@@ -0,0 +1,102 @@
+"""
+Read replica routing.
+
+Every query goes to the primary (``default``) unless it runs inside a
+request that ReplicaRoutingMiddleware let read from a replica: a GET or
+HEAD whose client hasn't written lately, handled by a view that doesn't
+opt out with ``replica_reads = False``. Such a request reads from one of
+DATABASE_REPLICAS, picked once so that a page and its follow-up queries
+see the same snapshot.
+
+Replicas lag. A request moves back to the primary for good the moment
+it writes or locks (select_for_update and get_or_create are writes to
+the router), and while the primary holds a transaction open, so nothing
+is decided on replica rows and then written. A client that wrote is
+marked with a cookie and reads from the primary for REPLICA_STICKY_SECONDS,
+long enough to see its own writes once the replicas have them.
+"""
+
+import contextvars
+import random
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+STICKY_COOKIE = 'primary_until'
+
+
+class Routing:
+    """Where one request's queries go: ``replica`` (an alias or None) and whether it ``wrote``."""
+
+    def __init__(self):
+        self.replica = None
+        self.wrote = False
+
+    def use_replica(self):
+        if settings.DATABASE_REPLICAS:
+            self.replica = random.choice(settings.DATABASE_REPLICAS)
+
+
+_routing = contextvars.ContextVar('listings_routing', default=None)
+
+
+@contextmanager
+def routing():
+    """Route the queries of the enclosed block by a fresh Routing, which it yields."""
+    state = Routing()
+    token = _routing.set(state)
+    try:
+        yield state
+    finally:
+        _routing.reset(token)
+
+
+def on_replica():
+    """Whether the current request reads from a replica (outside of transactions)."""
+    state = _routing.get()
+    return state is not None and state.replica is not None and not state.wrote
+
+
+def sticky(request):
+    """Whether the client's primary_until cookie still holds it on the primary."""
+    try:
+        return float(request.COOKIES.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def stick(response):
+    """Keep the client on the primary for the next REPLICA_STICKY_SECONDS."""
+    window = settings.REPLICA_STICKY_SECONDS
+    response.set_cookie(
+        STICKY_COOKIE, f'{time.time() + window:.3f}', max_age=window,
+        secure=settings.SESSION_COOKIE_SECURE, httponly=True, samesite='Lax',
+    )
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if not on_replica():
+            return None
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            # Related rows come from where their instance came from
+            return None
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return _routing.get().replica
+
+    def db_for_write(self, model, **hints):
+        state = _routing.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the primary's rows
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
@@ -0,0 +1,243 @@
+"""
+Ranked, faceted listing search over title, description and location.
+
+On MySQL the query runs against listing_fulltext_idx with MATCH ... AGAINST
+in natural language mode. Other backends (SQLite in tests and development)
+fall back to InvertedIndex, a pure-Python BM25 index over the same columns
+that lives in process memory and is rebuilt after listings change.
+
+Both paths return one page of listings in relevance order plus the match
+count and facets, all derived from a single (location, price bucket) ->
+count table: the location facet ignores the location filter so clients can
+offer the other locations, the price facet honours every filter.
+"""
+
+import heapq
+import math
+import re
+import threading
+from array import array
+from collections import Counter, defaultdict
+
+from django.db import connection
+from django.db.models import Case, Count, FloatField, Func, IntegerField, Q, Value, When
+
+from . import cache
+from .models import Listing
+
+# (min, max) per price facet; max is exclusive and None means open-ended
+PRICE_BUCKETS = ((0, 50), (50, 100), (100, 200), (200, 500), (500, None))
+LOCATION_FACETS = 20
+
+# Mirror InnoDB's defaults so both backends match the same words
+MIN_TOKEN_LENGTH = 3
+STOPWORDS = frozenset(
+    "about are com for from how that the this was what when where who will with und www".split()
+)
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return [
+        token for token in TOKEN_RE.findall(text.lower())
+        if len(token) >= MIN_TOKEN_LENGTH and token not in STOPWORDS
+    ]
+
+
+def price_bucket(price):
+    for index, (low, high) in enumerate(PRICE_BUCKETS):
+        if high is None or price < high:
+            return index
+
+
+class SearchResult:
+    def __init__(self, listings, count, facets):
+        self.listings = listings
+        self.count = count
+        self.facets = facets
+
+
+def build_facets(rows, locations):
+    """Turn (location, bucket, count) rows into the match count and facet lists."""
+    by_location = Counter()
+    by_bucket = Counter()
+    total = 0
+    for location, bucket, count in rows:
+        by_location[location] += count
+        if not locations or location in locations:
+            by_bucket[bucket] += count
+            total += count
+    top_locations = sorted(by_location.items(), key=lambda item: (-item[1], item[0]))[:LOCATION_FACETS]
+    return total, {
+        'location': [{'value': location, 'count': count} for location, count in top_locations],
+        'price': [
+            {'min': low, 'max': high, 'count': by_bucket[index]}
+            for index, (low, high) in enumerate(PRICE_BUCKETS)
+        ],
+    }
+
+
+def search(query, min_price=None, max_price=None, locations=(), offset=0, limit=20, queryset=None):
+    """
+    Listings matching ``query``, best first.
+
+    ``queryset`` only decides how the page's rows are loaded (e.g. deferred
+    columns); matching always covers every listing.
+    """
+    queryset = Listing.objects.all() if queryset is None else queryset
+    backend = _fulltext_search if connection.vendor == 'mysql' else _index_search
+    return backend(query, min_price, max_price, set(locations), offset, limit, queryset)
+
+
+class Match(Func):
+    """MATCH (columns) AGAINST (query IN NATURAL LANGUAGE MODE), for MySQL."""
+    output_field = FloatField()
+
+    def __init__(self, *columns, query):
+        super().__init__(*columns, Value(query))
+
+    def as_sql(self, compiler, connection, **extra_context):
+        *columns, query = (compiler.compile(expression) for expression in self.get_source_expressions())
+        sql = 'MATCH ({}) AGAINST ({} IN NATURAL LANGUAGE MODE)'.format(
+            ', '.join(column_sql for column_sql, _ in columns), query[0],
+        )
+        return sql, (*(param for _, params in columns for param in params), *query[1])
+
+
+def _fulltext_search(query, min_price, max_price, locations, offset, limit, queryset):
+    relevance = Match('title', 'description', 'location', query=query)
+    price = Q()
+    if min_price is not None:
+        price &= Q(price_per_night__gte=min_price)
+    if max_price is not None:
+        price &= Q(price_per_night__lte=max_price)
+
+    page = queryset.annotate(relevance=relevance).filter(price, relevance__gt=0)
+    if locations:
+        page = page.filter(location__in=locations)
+    listings = list(page.order_by('-relevance', 'pk')[offset:offset + limit])
+
+    bucket = Case(
+        *(
+            When(Q(price_per_night__gte=low) & (Q(price_per_night__lt=high) if high else Q()), then=Value(index))
+            for index, (low, high) in enumerate(PRICE_BUCKETS)
+        ),
+        output_field=IntegerField(),
+    )
+    rows = (
+        Listing.objects.annotate(relevance=relevance).filter(price, relevance__gt=0)
+        .annotate(bucket=bucket).order_by().values('location', 'bucket')
+        .annotate(count=Count('pk')).values_list('location', 'bucket', 'count')
+    )
+    count, facets = build_facets(rows, locations)
+    return SearchResult(listings, count, facets)
+
+
+class InvertedIndex:
+    """
+    In-memory BM25 index for backends without full-text search.
+
+    Documents are numbered in load order. Each term maps to parallel arrays
+    of document numbers and term frequencies; price and location are kept
+    per document so filtering and faceting never touch the database.
+    """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, rows):
+        """``rows`` yields (pk, title, description, location, price_per_night)."""
+        self.pks = array('q')
+        self.prices = array('d')
+        self.places = array('I')
+        self.lengths = array('I')
+        self.location_names = []
+        self.postings = defaultdict(lambda: array('I'))
+        self.frequencies = defaultdict(lambda: array('H'))
+        codes = {}
+
+        for pk, title, description, location, price in rows:
+            document = len(self.pks)
+            tokens = tokenize(f'{title} {description} {location}')
+            for term, frequency in Counter(tokens).items():
+                self.postings[term].append(document)
+                self.frequencies[term].append(min(frequency, 0xFFFF))
+            if location not in codes:
+                codes[location] = len(self.location_names)
+                self.location_names.append(location)
+            self.pks.append(pk)
+            self.prices.append(float(price))
+            self.places.append(codes[location])
+            self.lengths.append(len(tokens))
+
+        self.codes = codes
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+
+    def __len__(self):
+        return len(self.pks)
+
+    def score(self, query):
+        """BM25 score of every document containing at least one query term."""
+        scores = defaultdict(float)
+        total = len(self.pks)
+        lengths, k1, b, average = self.lengths, self.K1, self.B, self.average_length
+        for term in set(tokenize(query)):
+            documents = self.postings.get(term)
+            if not documents:
+                continue
+            idf = math.log(1 + (total - len(documents) + 0.5) / (len(documents) + 0.5))
+            for document, frequency in zip(documents, self.frequencies[term]):
+                scores[document] += idf * frequency * (k1 + 1) / (
+                    frequency + k1 * (1 - b + b * lengths[document] / average)
+                )
+        return scores
+
+    def search(self, query, min_price, max_price, locations, offset, limit):
+        """Returns (pks of the requested page, (location, bucket, count) rows)."""
+        wanted = {self.codes[name] for name in locations if name in self.codes}
+        if locations and not wanted:
+            wanted = {-1}
+        cells = Counter()
+        ranked = []
+        for document, score in self.score(query).items():
+            price = self.prices[document]
+            if (min_price is not None and price < min_price) or (max_price is not None and price > max_price):
+                continue
+            place = self.places[document]
+            cells[place, price_bucket(price)] += 1
+            if not wanted or place in wanted:
+                ranked.append((-score, self.pks[document]))
+        page = [pk for _, pk in heapq.nsmallest(offset + limit, ranked)[offset:]]
+        rows = [(self.location_names[place], bucket, count) for (place, bucket), count in cells.items()]
+        return page, rows
+
+
+_index = None
+_index_version = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """The process-wide InvertedIndex, rebuilt when listings changed since it was built."""
+    global _index, _index_version
+    version = (cache.get_version(cache.ALL_SCOPE), cache.get_version(cache.SEARCH_SCOPE))
+    if _index_version != version:
+        with _index_lock:
+            if _index_version != version:
+                rows = Listing.objects.order_by().values_list(
+                    'pk', 'title', 'description', 'location', 'price_per_night',
+                ).iterator(chunk_size=10000)
+                _index, _index_version = InvertedIndex(rows), version
+    return _index
+
+
+def _index_search(query, min_price, max_price, locations, offset, limit, queryset):
+    page, rows = get_index().search(
+        query,
+        None if min_price is None else float(min_price),
+        None if max_price is None else float(max_price),
+        locations, offset, limit,
+    )
+    loaded = queryset.in_bulk(page)
+    count, facets = build_facets(rows, locations)
+    return SearchResult([loaded[pk] for pk in page if pk in loaded], count, facets)
@@ -1,10 +1,250 @@
 #!/usr/bin/env python3
 
+import time
+
+from datetime import date, timedelta
+from functools import partial
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ValidationError as DjangoValidationError
+from django.utils import timezone
+from django.utils.encoding import is_protected_type
 from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.settings import api_settings
+from . import analytics, metrics
 from .models import Listing, Booking, Payment
 
 
-class ListingSerializer(serializers.ModelSerializer):
+class TimedRepresentationMixin:
+    """
+    Charges the time spent in ``to_representation`` to the current request's
+    metrics. Nested serializers are counted once, by the outermost one.
+    """
+
+    def to_representation(self, instance):
+        timings = metrics.current()
+        if timings is None or timings.serializing:
+            return super().to_representation(instance)
+        timings.serializing = True
+        started = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            timings.serializer += time.perf_counter() - started
+            timings.serializing = False
+
+
+class SparseFieldsetMixin:
+    """
+    Lets read requests trim the response with ``?fields=id,title``.
+
+    Unknown names are ignored and an empty selection returns every field.
+    ``Meta.deferrable_fields`` lists heavy columns the view may leave out of
+    the SELECT when the client did not ask for them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        requested = self.requested_fields(self.context.get('request'))
+        if requested is not None:
+            for name in set(self.fields) - requested:
+                self.fields.pop(name)
+
+    @classmethod
+    def requested_fields(cls, request):
+        """Field names selected by ``?fields=``, or None for all of them."""
+        if request is None or request.method not in SAFE_METHODS:
+            return None
+        raw = request.query_params.get('fields')
+        if not raw:
+            return None
+        return {name.strip() for name in raw.split(',')} & set(cls.Meta.fields) or None
+
+    @classmethod
+    def deferred_fields(cls, request):
+        """Deferrable model fields the response will not read."""
+        requested = cls.requested_fields(request)
+        if requested is None:
+            return []
+        return [name for name in getattr(cls.Meta, 'deferrable_fields', ()) if name not in requested]
+
+
+def _utc_isoformat(value):
+    text = value.isoformat()
+    return text[:-6] + 'Z' if text.endswith('+00:00') else text
+
+
+def _model_field_value(model_field, value):
+    # ModelField.to_representation, given the value rather than the instance
+    if is_protected_type(value):
+        return value
+    return model_field.value_to_string(SimpleNamespace(**{model_field.attname: value}))
+
+
+def _decimal_string(field, value):
+    # Columns come back already quantized to the field's places, which makes DRF's quantize a no-op
+    if value.as_tuple().exponent == -field.decimal_places:
+        return format(value, 'f')
+    return field.to_representation(value)
+
+
+def _fast_converter(field):
+    """
+    What FieldPlan calls on a non-null database value of ``field``: None
+    when the value is already its representation, else a function.
+    """
+    if isinstance(field, (serializers.IntegerField, serializers.CharField, serializers.BooleanField, serializers.ReadOnlyField)):
+        return None
+    if isinstance(field, serializers.ModelField):
+        return partial(_model_field_value, field.model_field)
+    if isinstance(field, serializers.FloatField):
+        return float
+    if isinstance(field, serializers.DateTimeField) and not hasattr(field, 'timezone'):
+        output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+        # Aware UTC values from the database need no conversion when UTC is the current zone
+        if output_format and output_format.lower() == 'iso-8601' and str(field.default_timezone()) == 'UTC':
+            return _utc_isoformat
+    elif isinstance(field, serializers.DateField):
+        output_format = getattr(field, 'format', api_settings.DATE_FORMAT)
+        if output_format and output_format.lower() == 'iso-8601':
+            return date.isoformat
+    elif isinstance(field, serializers.DecimalField):
+        coerce_to_string = getattr(field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING)
+        if coerce_to_string and not (field.localize or field.normalize_output) and field.decimal_places is not None:
+            return partial(_decimal_string, field)
+    return field.to_representation
+
+
+class FieldPlan:
+    """
+    Precompiled ``to_representation`` for read-only list responses.
+
+    Compiled once from a (possibly trimmed) ModelSerializer, it reads
+    ``values_list`` rows instead of model instances and builds the dicts the
+    serializer would have built, field for field, with the per-field work
+    reduced to what the database values actually need.
+    """
+
+    def __init__(self, names, lookups, converters):
+        self.names = names
+        self.lookups = lookups
+        self.converted = [
+            (index, name, convert) for index, (name, convert) in enumerate(zip(names, converters))
+            if convert is not None
+        ]
+
+    @classmethod
+    def compile(cls, serializer):
+        """The plan for ``serializer``, or None if one of its fields can't be read from a column."""
+        model = serializer.Meta.model
+        names, lookups, converters = [], [], []
+        for name, field in serializer.fields.items():
+            if field.write_only:
+                continue
+            if isinstance(field, serializers.PrimaryKeyRelatedField):
+                if field.pk_field is not None:
+                    return None
+                converter = None
+            elif isinstance(field, (serializers.BaseSerializer, serializers.RelatedField, serializers.ManyRelatedField,
+                                    serializers.SerializerMethodField, serializers.HiddenField)):
+                return None
+            else:
+                converter = _fast_converter(field)
+            try:
+                model_field = model._meta.get_field(field.source)
+            except FieldDoesNotExist:
+                return None
+            if not model_field.concrete or model_field.many_to_many:
+                return None
+            names.append(name)
+            lookups.append(model_field.attname)
+            converters.append(converter)
+        return cls(names, lookups, converters)
+
+    def rows(self, queryset, *extra):
+        """Named rows of the plan's columns, plus ``extra`` columns (e.g. for cursor positions)."""
+        columns = list(self.lookups) + [name for name in extra if name not in self.lookups]
+        return queryset.values_list(*columns, named=True)
+
+    def render(self, rows):
+        names, converted = self.names, self.converted
+        data = []
+        for row in rows:
+            item = dict(zip(names, row))
+            for index, name, convert in converted:
+                value = row[index]
+                if value is not None:
+                    item[name] = convert(value)
+            data.append(item)
+        return data
+
+
+class InvalidItem:
+    """
+    Takes the place of an item's validated data in BulkListSerializer when
+    the item failed validation.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+
+
+class PrefetchedRelation:
+    """
+    Stands in for a PrimaryKeyRelatedField's queryset during bulk
+    validation, answering every ``get(pk=...)`` from one in_bulk query.
+    """
+
+    def __init__(self, queryset, values):
+        self.model = queryset.model
+        keys = set()
+        for value in values:
+            try:
+                keys.add(self.model._meta.pk.to_python(value))
+            except DjangoValidationError:
+                pass
+        self.objects = queryset.in_bulk(keys)
+
+    def get(self, pk):
+        try:
+            key = self.model._meta.pk.to_python(pk)
+        except DjangoValidationError as exc:
+            raise ValueError(pk) from exc
+        try:
+            return self.objects[key]
+        except (KeyError, TypeError):
+            raise self.model.DoesNotExist
+
+
+class BulkListSerializer(serializers.ListSerializer):
+    """
+    ``many=True`` validation that carries on past invalid items.
+
+    ``validated_data`` has one entry per item: its validated attributes, or
+    an InvalidItem holding its errors. Related objects are looked up with
+    one query per relation instead of one per item.
+    """
+
+    def to_internal_value(self, data):
+        if isinstance(data, list):
+            items = [item for item in data if isinstance(item, dict)]
+            for name, field in self.child.fields.items():
+                if isinstance(field, serializers.PrimaryKeyRelatedField) and not field.read_only:
+                    field.queryset = PrefetchedRelation(
+                        field.get_queryset(), [item[name] for item in items if name in item],
+                    )
+        return super().to_internal_value(data)
+
+    def run_child_validation(self, data):
+        try:
+            return super().run_child_validation(data)
+        except serializers.ValidationError as exc:
+            return InvalidItem(exc.detail)
+
+
+class ListingSerializer(TimedRepresentationMixin, SparseFieldsetMixin, serializers.ModelSerializer):
     """
     Serializer for Listing model.
     """
@@ -17,13 +257,26 @@ class ListingSerializer(serializers.ModelSerializer):
             'description',
             'location',
             'price_per_night',
+            'currency',
+            'latitude',
+            'longitude',
             'host',
             'created_at',
+            'review_count',
+            'rating_avg',
         ]
-        read_only_fields = ['id', 'host', 'created_at']
+        read_only_fields = ['id', 'host', 'created_at', 'review_count', 'rating_avg']
+        deferrable_fields = ['description']
 
+    def validate(self, attrs):
+        latitude = attrs.get('latitude', getattr(self.instance, 'latitude', None))
+        longitude = attrs.get('longitude', getattr(self.instance, 'longitude', None))
+        if (latitude is None) != (longitude is None):
+            raise serializers.ValidationError("latitude and longitude must be given together.")
+        return attrs
 
-class BookingSerializer(serializers.ModelSerializer):
+
+class BookingSerializer(TimedRepresentationMixin, SparseFieldsetMixin, serializers.ModelSerializer):
     """
     Serializer for Booking model.
     """
@@ -36,24 +289,126 @@ class BookingSerializer(serializers.ModelSerializer):
             'guest',
             'check_in',
             'check_out',
+            'total_price',
+            'currency',
             'created_at',
         ]
-        read_only_fields = ['id', 'guest', 'created_at']
+        read_only_fields = ['id', 'guest', 'total_price', 'currency', 'created_at']
+
+    def validate(self, attrs):
+        check_in = attrs.get('check_in', getattr(self.instance, 'check_in', None))
+        check_out = attrs.get('check_out', getattr(self.instance, 'check_out', None))
+        if check_in and check_out and check_out <= check_in:
+            raise serializers.ValidationError("check_out must be after check_in.")
+        return attrs
+
+
+class AvailabilityQuerySerializer(serializers.Serializer):
+    """
+    Validates the stay window for the listing availability search.
+    """
+    check_in = serializers.DateField()
+    check_out = serializers.DateField()
+
+    def validate(self, attrs):
+        if attrs['check_out'] <= attrs['check_in']:
+            raise serializers.ValidationError("check_out must be after check_in.")
+        return attrs
+
+
+class QuoteQuerySerializer(AvailabilityQuerySerializer):
+    """
+    Validates the stay of a listing quote.
+    """
+
+
+class SearchQuerySerializer(serializers.Serializer):
+    """
+    Validates the listing search parameters; ``location`` may be repeated.
+    """
+    q = serializers.CharField()
+    min_price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0, required=False)
+    max_price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0, required=False)
+    location = serializers.ListField(child=serializers.CharField(), required=False, default=list)
+    offset = serializers.IntegerField(min_value=0, default=0)
+    page_size = serializers.IntegerField(min_value=1, max_value=100, default=20)
+
+    def validate(self, attrs):
+        low, high = attrs.get('min_price'), attrs.get('max_price')
+        if low is not None and high is not None and high < low:
+            raise serializers.ValidationError("max_price must not be below min_price.")
+        return attrs
+
+
+class NearbyQuerySerializer(serializers.Serializer):
+    """
+    Validates the centre and radius of a nearby-listings search.
+    """
+    lat = serializers.FloatField(min_value=-90, max_value=90)
+    lng = serializers.FloatField(min_value=-180, max_value=180)
+    # Wider circles cover too many grid rows to prune usefully
+    radius_km = serializers.FloatField(min_value=0, max_value=500, default=10)
+    offset = serializers.IntegerField(min_value=0, default=0)
+    page_size = serializers.IntegerField(min_value=1, max_value=100, default=20)
+
+
+class CalendarQuerySerializer(serializers.Serializer):
+    """
+    Validates the month of a listing calendar request; defaults to the current month.
+    """
+    month = serializers.DateField(input_formats=['%Y-%m'], required=False)
+
+
+class ExportQuerySerializer(serializers.Serializer):
+    """
+    Validates the format and watermark window of a finance export.
+    """
+    output = serializers.ChoiceField(choices=['csv', 'ndjson'], default='csv')
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+
+    def validate(self, attrs):
+        since, until = attrs.get('since'), attrs.get('until')
+        if since is not None and until is not None and until < since:
+            raise serializers.ValidationError("until must not be before since.")
+        return attrs
+
+
+class AnalyticsQuerySerializer(serializers.Serializer):
+    """
+    Validates the window, interval and source of a host analytics report;
+    the window defaults to the 30 days up to today.
+    """
+    start = serializers.DateField(required=False)
+    end = serializers.DateField(required=False)
+    interval = serializers.ChoiceField(choices=analytics.INTERVALS, default='day')
+    source = serializers.ChoiceField(choices=[analytics.LIVE, analytics.ROLLUP], required=False)
+
+    def validate(self, attrs):
+        end = attrs.setdefault('end', timezone.localdate())
+        start = attrs.setdefault('start', end - timedelta(days=29))
+        if end < start:
+            raise serializers.ValidationError("end must not be before start.")
+        if (end - start).days >= settings.ANALYTICS_MAX_DAYS:
+            raise serializers.ValidationError(f"The window may cover at most {settings.ANALYTICS_MAX_DAYS} days.")
+        return attrs
+
 
-class PaymentSerializer(serializers.ModelSerializer):
+class PaymentSerializer(TimedRepresentationMixin, serializers.ModelSerializer):
     booking_details = serializers.SerializerMethodField()
     
     class Meta:
         model = Payment
         fields = [
             'id', 'booking', 'booking_details', 'amount', 
-            'status', 'transaction_id', 'created_at'
+            'status', 'transaction_id', 'checkout_url', 'created_at'
         ]
-        read_only_fields = ['id', 'transaction_id', 'created_at']
+        read_only_fields = ['id', 'transaction_id', 'checkout_url', 'created_at']
     
     def get_booking_details(self, obj):
+        # Callers must select_related('booking__guest') to keep this query-free
         return {
             'booking_id': str(obj.booking.id),
-            'user_email': obj.booking.user.email,
+            'user_email': obj.booking.guest.email,
             'total_price': str(obj.booking.total_price)
         }
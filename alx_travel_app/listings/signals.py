@@ -0,0 +1,79 @@
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import cache, occupancy
+from .models import Listing, Booking, PricingRule, Review, StayDiscount
+
+
+@receiver([post_save, post_delete], sender=Listing)
+def invalidate_listing_cache(sender, instance, **kwargs):
+    # After commit, so a concurrent read can't re-cache the old row under the new version.
+    # Bind the pk now: a delete has cleared instance.pk by the time the callback runs.
+    pk = instance.pk
+    transaction.on_commit(lambda: cache.invalidate_listing(pk))
+    transaction.on_commit(cache.invalidate_search)
+
+
+@receiver([post_save, post_delete], sender=Booking)
+@receiver([post_save, post_delete], sender=Review)
+def invalidate_parent_listing_cache(sender, instance, **kwargs):
+    listing_id = instance.listing_id
+    transaction.on_commit(lambda: cache.invalidate_listing(listing_id))
+
+
+def adjust_rating_aggregates(listing_id, count, rating):
+    """Shift a listing's review aggregates in SQL so concurrent writers never lose an update."""
+    Listing.objects.filter(pk=listing_id).update(
+        review_count=F('review_count') + count,
+        rating_sum=F('rating_sum') + rating,
+    )
+
+
+@receiver(post_save, sender=Review)
+def count_saved_review(sender, instance, created, **kwargs):
+    counted_listing, counted_rating = getattr(instance, '_counted', (None, None))
+    if created or counted_listing is None:
+        adjust_rating_aggregates(instance.listing_id, 1, instance.rating)
+    elif counted_listing != instance.listing_id:
+        adjust_rating_aggregates(counted_listing, -1, -counted_rating)
+        adjust_rating_aggregates(instance.listing_id, 1, instance.rating)
+    elif counted_rating != instance.rating:
+        adjust_rating_aggregates(instance.listing_id, 0, instance.rating - counted_rating)
+    instance._counted = (instance.listing_id, instance.rating)
+
+
+@receiver(post_delete, sender=Review)
+def uncount_deleted_review(sender, instance, **kwargs):
+    listing_id, rating = getattr(instance, '_counted', (instance.listing_id, instance.rating))
+    adjust_rating_aggregates(listing_id, -1, -rating)
+
+
+@receiver(post_save, sender=Booking)
+def occupy_booked_nights(sender, instance, created, **kwargs):
+    current = (instance.listing_id, instance.check_in, instance.check_out)
+    previous = getattr(instance, '_occupied', None)
+    if created or previous is None or previous[0] is None:
+        occupancy.sync(instance.listing_id, booked=current[1:])
+    elif previous[0] != instance.listing_id:
+        occupancy.sync(previous[0], freed=previous[1:], create=False)
+        occupancy.sync(instance.listing_id, booked=current[1:])
+    elif previous != current:
+        occupancy.sync(instance.listing_id, booked=current[1:], freed=previous[1:])
+    instance._occupied = current
+
+
+@receiver(post_delete, sender=Booking)
+def free_booked_nights(sender, instance, **kwargs):
+    listing_id, check_in, check_out = getattr(
+        instance, '_occupied', (instance.listing_id, instance.check_in, instance.check_out),
+    )
+    occupancy.sync(listing_id, freed=(check_in, check_out), create=False)
+
+
+@receiver([post_save, post_delete], sender=PricingRule)
+@receiver([post_save, post_delete], sender=StayDiscount)
+def bump_pricing_version(sender, instance, **kwargs):
+    # Memoized schedules and quotes are keyed by the version; see listings.pricing
+    Listing.objects.filter(pk=instance.listing_id).update(pricing_version=F('pricing_version') + 1)
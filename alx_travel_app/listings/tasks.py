@@ -1,71 +1,100 @@
+import random
+
 from celery import shared_task
-from django.core.mail import send_mail
 from django.conf import settings
-from .models import Payment, Booking
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.utils import timezone
+from . import analytics, mail
+from .reconcile import Reconciliation
+from .chapa import get_client, ChapaError
+from .models import Payment
+
+
+def backoff(retries, base=2.0, cap=600.0):
+    """Countdown before retry number ``retries`` + 1: exponential, capped, with full jitter."""
+    return random.uniform(0, min(cap, base * 2 ** retries))
+
+
+FLUSH_SCHEDULED = 'mail:flush:scheduled'
+
+
+def queue_confirmation(kind, pk):
+    """Store a confirmation, then send the batch if it is full or make sure a flush is on its way."""
+    window = settings.EMAIL_BATCH_WINDOW
+    if mail.queue(kind, pk) >= settings.EMAIL_BATCH_SIZE or window <= 0:
+        mail.flush()
+    elif cache.add(FLUSH_SCHEDULED, True, timeout=window):
+        send_pending_confirmations.apply_async(countdown=window)
+
 
 @shared_task
 def send_payment_confirmation_email(payment_id):
-    """Send confirmation email after successful payment"""
-    try:
-        payment = Payment.objects.get(id=payment_id)
-        booking = payment.booking
-        
-        subject = f'Payment Confirmation - Booking #{booking.id}'
-        message = f"""
-        Dear {booking.user.first_name},
-        
-        Your payment has been successfully processed!
-        
-        Booking Details:
-        - Booking ID: {booking.id}
-        - Amount: ETB {payment.amount}
-        - Transaction ID: {payment.transaction_id}
-        - Check-in: {booking.check_in_date}
-        - Check-out: {booking.check_out_date}
-        
-        Thank you for your booking!
-        """
-        
-        send_mail(
-            subject,
-            message,
-            settings.DEFAULT_FROM_EMAIL,
-            [booking.user.email],
-            fail_silently=False,
-        )
-        
-    except Exception as e:
-        print(f"Failed to send confirmation email: {e}")
-
-shared_task
+    """Send confirmation email after successful payment, batched with other confirmations"""
+    queue_confirmation(mail.PAYMENT, payment_id)
+
+
+@shared_task
 def send_booking_confirmation_email(booking_id: int) -> None:
-    """Send booking confirmation email when a new booking is created"""
+    """Send booking confirmation email when a new booking is created, batched with other confirmations"""
+    queue_confirmation(mail.BOOKING, booking_id)
+
+
+@shared_task(autoretry_for=(DatabaseError,), retry_backoff=True, max_retries=8)
+def send_pending_confirmations():
+    """Send the confirmations waiting for their batch (scheduled by the confirmation tasks, and by beat as a sweep)"""
+    return mail.flush()
+
+
+@shared_task(bind=True, autoretry_for=(DatabaseError,), retry_backoff=True, max_retries=8)
+def send_confirmation_batch(self, items):
+    """Send a batch of [kind, pk] confirmations over one connection, retrying the ones that failed"""
+    unsent = mail.deliver(items)
+    if unsent:
+        raise self.retry(args=(unsent,), countdown=backoff(self.request.retries, base=30))
+
+
+@shared_task(bind=True, max_retries=3)
+def initiate_chapa_payment(self, payment_id, payload):
+    """Start the Chapa transaction for a Pending payment off the request thread"""
+    # Only touch the payment if it still belongs to this attempt. Queryset
+    # updates skip auto_now, and the payments export follows updated_at
+    pending = Payment.objects.filter(pk=payment_id, transaction_id=payload['tx_ref'], status='Pending')
+    try:
+        response = get_client().initialize(payload)
+    except ChapaError as exc:
+        if self.request.retries >= self.max_retries:
+            pending.update(status='Failed', updated_at=timezone.now())
+            raise
+        # Chapa rejects a reused tx_ref, so a retry can't open a second transaction
+        raise self.retry(exc=exc, countdown=backoff(self.request.retries))
+
+    if response.status_code == 200:
+        pending.update(checkout_url=response.json()['data']['checkout_url'], updated_at=timezone.now())
+    else:
+        pending.update(status='Failed', updated_at=timezone.now())
+
+
+@shared_task
+def reconcile_pending_payments(dry_run=False):
+    """Settle stale Pending payments whose callback never arrived (scheduled by beat)"""
+    # A run that outlasts the beat interval must not overlap with the next one
+    lock = 'payments:reconcile:lock'
+    if not cache.add(lock, True, timeout=settings.PAYMENT_RECONCILE_INTERVAL * 60):
+        return None
+    try:
+        return Reconciliation(dry_run=dry_run).run()
+    finally:
+        cache.delete(lock)
+
+
+@shared_task
+def refresh_analytics_rollup():
+    """Rebuild the daily rollup behind large hosts' analytics (scheduled by beat)"""
+    lock = 'analytics:rollup:lock'
+    if not cache.add(lock, True, timeout=settings.ANALYTICS_ROLLUP_INTERVAL * 60):
+        return None
     try:
-        booking = Booking.objects.get(id=booking_id)
-
-        subject = f'Booking Confirmation - Booking #{booking.id}'
-        message = f"""
-        Dear {booking.user.first_name},
-
-        Your booking has been successfully created!
-
-        Booking Details:
-        - Booking ID: {booking.id}
-        - Hotel: {booking.hotel.name}
-        - Room: {booking.room.room_type}
-        - Check-in: {booking.check_in_date}
-        - Check-out: {booking.check_out_date}
-
-        We look forward to hosting you!
-        """
-
-        send_mail(
-            subject,
-            message,
-            settings.DEFAULT_FROM_EMAIL,
-            [booking.user.email],
-            fail_silently=False,
-        )
-
-    except Exception as e:
-        print(f"Failed to send booking confirmation email: {e}")
+        return analytics.refresh_rollup()
+    finally:
+        cache.delete(lock)
@@ -1,3 +1,1874 @@
-from django.test import TestCase
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+from datetime import date, timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core import mail as outbox
+from django.core.cache import cache
+from django.core.mail.backends.locmem import EmailBackend as LocmemBackend
+from django.core.management import call_command, CommandError
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.db.models import Sum
+from django.test import TestCase, TransactionTestCase, SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APITestCase, APITransactionTestCase
+
+from .benchmarks import book_concurrently, count_double_bookings
+from . import admin as django_admin
+from . import analytics
+from . import cache as listing_cache
+from . import geo
+from . import mail
+from . import metrics
+from . import occupancy
+from . import pricing
+from . import queryplan
+from . import routers
+from .chapa import ChapaClient, ChapaError, CircuitBreaker, CircuitOpenError
+from .chapa_stub import StubChapaServer
+from .models import (
+    Listing, ListingCalendar, ListingDailyStats, Booking, Payment, PaymentEvent, PendingConfirmation, PricingRule,
+    Review, StayDiscount,
+)
+from .export import EXPORTS
+from .reconcile import Reconciliation, stale_payments
+from .renderers import FastJSONRenderer
+from .serializers import FieldPlan
+from .tasks import (
+    initiate_chapa_payment, refresh_analytics_rollup, send_booking_confirmation_email, send_confirmation_batch,
+    send_payment_confirmation_email, send_pending_confirmations,
+)
+
+User = get_user_model()
+
+
+def make_listing(host, **overrides):
+    fields = {
+        'title': "Cabin",
+        'description': "A quiet cabin",
+        'location': "Nairobi",
+        'price_per_night': 100,
+        'host': host,
+    }
+    fields.update(overrides)
+    return Listing.objects.create(**fields)
+
+
+def make_booking(listing, guest, offset=0, nights=2):
+    check_in = date(2030, 1, 1) + timedelta(days=offset * (nights + 1))
+    return Booking.objects.create(
+        listing=listing, guest=guest, check_in=check_in, check_out=check_in + timedelta(days=nights),
+    )
+
+
+class QueryCountMixin:
+    """
+    Regression harness for N+1 queries: an endpoint must issue the same
+    number of queries no matter how many rows it returns.
+    """
+
+    def count_queries(self, url):
+        # Measure the uncached read path
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        return len(queries)
+
+    def assertConstantQueries(self, url, add_rows, grow_by=25):
+        before = self.count_queries(url)
+        add_rows(grow_by)
+        after = self.count_queries(url)
+        self.assertEqual(
+            before, after,
+            f"{url} went from {before} to {after} queries after adding {grow_by} rows",
+        )
+        return after
+
+
+class QueryPlanMixin:
+    """
+    Regression harness for missing indexes: the statements a block runs must
+    not read a table of ``min_rows`` rows or more in full.
+    """
+    min_rows = 500
+
+    def assertNoFullScans(self, func):
+        if connection.vendor not in queryplan.SUPPORTED_VENDORS:
+            self.skipTest(f"No query plan support for {connection.vendor}")
+        with CaptureQueriesContext(connection) as queries:
+            result = func()
+        scans = queryplan.check(queries.captured_queries, self.min_rows)
+        self.assertFalse(scans, '\n\n'.join(map(str, scans)))
+        return result
+
+
+REPLICA = 'replica'
+
+
+class ReplicaDatabaseMixin:
+    """
+    Adds a second SQLite database, ``replica``, for the class's tests.
+    Nothing copies the primary's writes to it, so it lags forever: it holds
+    only what a test ``replicate``s, until the test ends.
+
+    The test runner only sets up the databases in settings, so the replica
+    joins the class's ``databases`` once the runner is past that.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.replica_dir = tempfile.mkdtemp()
+        config = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(cls.replica_dir, 'replica.sqlite3')}
+        connections.settings[REPLICA] = connections.configure_settings({**connections.settings, REPLICA: config})[REPLICA]
+        cls.databases = {*cls.databases, REPLICA}
+        super().setUpClass()
+        call_command('migrate', database=REPLICA, verbosity=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections[REPLICA].close()
+        del connections[REPLICA]
+        del connections.settings[REPLICA]
+        shutil.rmtree(cls.replica_dir)
+
+    def replicate(self, *objects):
+        for obj in objects:
+            obj.save(using=REPLICA)
+
+
+class ListingAvailabilityTests(APITestCase):
+    def setUp(self):
+        self.host = User.objects.create_user(username="host", password="pw")
+        self.guest = User.objects.create_user(username="guest", password="pw")
+        self.start = date(2030, 1, 10)
+        self.booked = make_listing(self.host, title="Booked")
+        self.free = make_listing(self.host, title="Free")
+        Booking.objects.create(
+            listing=self.booked, guest=self.guest,
+            check_in=self.start, check_out=self.start + timedelta(days=3),
+        )
+
+    def search(self, check_in, check_out):
+        return self.client.get('/api/listings/available/', {
+            'check_in': check_in.isoformat(), 'check_out': check_out.isoformat(),
+        })
+
+    def titles(self, response):
+        return sorted(row['title'] for row in response.data['results'])
+
+    def test_overlapping_stay_excludes_listing(self):
+        response = self.search(self.start + timedelta(days=1), self.start + timedelta(days=5))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.titles(response), ["Free"])
+
+    def test_back_to_back_stays_do_not_overlap(self):
+        response = self.search(self.start + timedelta(days=3), self.start + timedelta(days=4))
+        self.assertEqual(self.titles(response), ["Booked", "Free"])
+        response = self.search(self.start - timedelta(days=2), self.start)
+        self.assertEqual(self.titles(response), ["Booked", "Free"])
+
+    def test_single_query(self):
+        with self.assertNumQueries(1):
+            self.search(self.start, self.start + timedelta(days=1))
+
+    def test_rejects_inverted_window(self):
+        response = self.search(self.start, self.start)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get('/api/listings/available/').status_code, 400)
+
+
+class BookingOverlapTests(APITestCase):
+    def setUp(self):
+        self.host = User.objects.create_user(username="host", password="pw")
+        self.guest = User.objects.create_user(username="guest", password="pw")
+        self.listing = make_listing(self.host)
+        self.client.force_authenticate(self.guest)
+        patcher = mock.patch('listings.views.send_booking_confirmation_email')
+        self.send_email = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def book(self, check_in, check_out):
+        return self.client.post('/api/bookings/', {
+            'listing': self.listing.pk, 'check_in': check_in, 'check_out': check_out,
+        })
+
+    def test_overlapping_stay_is_rejected(self):
+        self.assertEqual(self.book('2030-01-10', '2030-01-13').status_code, 201)
+        response = self.book('2030-01-12', '2030-01-15')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.book('2030-01-13', '2030-01-15').status_code, 201)
+        self.assertEqual(Booking.objects.count(), 2)
+        self.assertEqual(self.send_email.delay.call_count, 2)
+
+    def test_update_may_not_move_onto_another_stay(self):
+        self.book('2030-01-10', '2030-01-13')
+        second = self.book('2030-01-20', '2030-01-22').data['id']
+        response = self.client.patch(f'/api/bookings/{second}/', {'check_in': '2030-01-12'})
+        self.assertEqual(response.status_code, 409)
+        response = self.client.patch(f'/api/bookings/{second}/', {'check_in': '2030-01-19'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_inverted_dates_are_a_validation_error(self):
+        self.assertEqual(self.book('2030-01-10', '2030-01-10').status_code, 400)
+
+
+class ConcurrentBookingTests(TransactionTestCase):
+    def test_no_double_booking_under_concurrent_writers(self):
+        host = User.objects.create_user(username="host")
+        guest = User.objects.create_user(username="guest")
+        hot = [make_listing(host).pk]
+        spread = [make_listing(host).pk for _ in range(8)]
+        for listing_ids in (hot, spread):
+            created, conflicts, locked_out, _ = book_concurrently(listing_ids, guest, threads=8, attempts=15)
+            self.assertEqual(created + conflicts + locked_out, 8 * 15)
+            self.assertGreater(created, 0)
+        self.assertEqual(count_double_bookings(), 0)
+
+
+class ViewSetQueryCountTests(QueryCountMixin, APITestCase):
+    def setUp(self):
+        self.host = User.objects.create_user(username="host", password="pw")
+        self.guest = User.objects.create_user(username="guest", email="guest@example.com")
+        self.listing = make_listing(self.host)
+        self.client.force_authenticate(self.guest)
+        self.created = 0
+
+    def add_listings(self, count):
+        for _ in range(count):
+            make_listing(self.host)
+
+    def add_bookings(self, count):
+        for _ in range(count):
+            make_booking(self.listing, self.guest, offset=self.created)
+            self.created += 1
+
+    def add_payments(self, count):
+        for _ in range(count):
+            booking = make_booking(self.listing, self.guest, offset=self.created)
+            self.created += 1
+            Payment.objects.create(booking=booking, amount=200, transaction_id=f"tx-{booking.pk}")
+
+    def test_listing_endpoints(self):
+        self.assertConstantQueries('/api/listings/', self.add_listings)
+        self.assertConstantQueries(
+            '/api/listings/available/?check_in=2031-01-01&check_out=2031-01-03', self.add_listings,
+        )
+        with self.assertNumQueries(1):
+            self.client.get(f'/api/listings/{self.listing.pk}/')
+
+    def test_booking_endpoints(self):
+        self.assertConstantQueries('/api/bookings/', self.add_bookings)
+        booking = Booking.objects.first()
+        with self.assertNumQueries(1):
+            self.client.get(f'/api/bookings/{booking.pk}/')
+
+    def test_payment_endpoints(self):
+        self.assertConstantQueries('/api/payments/', self.add_payments)
+        payment = Payment.objects.first()
+        # A partial charge: the details still report what the booking was quoted
+        Payment.objects.filter(pk=payment.pk).update(amount=150)
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/api/payments/{payment.pk}/')
+        self.assertEqual(response.data['booking_details']['user_email'], "guest@example.com")
+        self.assertEqual(response.data['booking_details']['total_price'], "200.00")
+        with self.assertNumQueries(1):
+            self.client.get(f'/api/payments/{payment.pk}/status/')
+
+    def test_payments_are_scoped_to_the_guest(self):
+        self.add_payments(2)
+        self.client.force_authenticate(self.host)
+        self.assertEqual(self.client.get('/api/payments/').data, [])
+
+
+class PaginationAndFieldsetTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.host = User.objects.create_user(username="host", password="pw")
+        self.listings = [make_listing(self.host, title=f"Listing {i}") for i in range(5)]
+
+    def test_cursor_pages_walk_newest_first_without_gaps(self):
+        seen = []
+        url = '/api/listings/?page_size=2'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data['results']), 2)
+            seen.extend(row['id'] for row in response.data['results'])
+            url = response.data['next']
+        self.assertEqual(seen, [listing.pk for listing in reversed(self.listings)])
+
+    def test_cursor_walks_tied_values_by_keyset_both_ways(self):
+        # Every listing is unrated, so all of them tie on rating_avg
+        url = '/api/listings/?ordering=-rating_avg&page_size=2'
+        pages = []
+        with CaptureQueriesContext(connection) as queries:
+            while url:
+                response = self.client.get(url)
+                pages.append([row['id'] for row in response.data['results']])
+                url = response.data['next']
+        self.assertEqual(sum(pages, []), sorted(listing.pk for listing in self.listings)[::-1])
+        self.assertFalse([query['sql'] for query in queries if 'OFFSET' in query['sql']])
+
+        url = response.data['previous']
+        back = []
+        while url:
+            response = self.client.get(url)
+            back.insert(0, [row['id'] for row in response.data['results']])
+            url = response.data['previous']
+        self.assertEqual(back, pages[:-1])
+        self.assertEqual(self.client.get('/api/listings/?cursor=cD0xMjM%3D').status_code, 404)
+
+    def test_only_listings_and_bookings_are_paginated(self):
+        self.client.force_authenticate(self.host)
+        self.assertIn('next', self.client.get('/api/listings/').data)
+        self.assertIn('next', self.client.get('/api/bookings/').data)
+        self.assertEqual(self.client.get('/api/payments/').data, [])
+
+    def test_sparse_fieldset_skips_description_column(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/listings/?fields=id,title')
+        self.assertEqual(set(response.data['results'][0]), {'id', 'title'})
+        self.assertNotIn('description', queries[0]['sql'])
+
+    def test_unknown_fields_fall_back_to_everything(self):
+        response = self.client.get('/api/listings/?fields=nope')
+        self.assertIn('description', response.data['results'][0])
+
+    def test_fields_param_does_not_restrict_writes(self):
+        self.client.force_authenticate(self.host)
+        response = self.client.post('/api/listings/?fields=id', {
+            'title': "New", 'description': "d", 'location': "Mombasa", 'price_per_night': "80.00",
+        })
+        self.assertEqual(response.status_code, 201, response.data)
+
+
+class ListingCacheTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.host = User.objects.create_user(username="host", password="pw")
+        self.guest = User.objects.create_user(username="guest", password="pw")
+        self.listing = make_listing(self.host, title="Cabin")
+        self.url = f'/api/listings/{self.listing.pk}/'
+
+    def test_detail_and_list_are_served_from_cache(self):
+        for url in (self.url, '/api/listings/'):
+            with self.assertNumQueries(1):
+                self.client.get(url)
+            with self.assertNumQueries(0):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+
+    def test_if_none_match_returns_304_without_touching_the_database(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_listing_save_invalidates_detail_and_list(self):
+        etag = self.client.get(self.url)['ETag']
+        self.client.get('/api/listings/')
+        self.listing.title = "Lodge"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.listing.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['title'], "Lodge")
+        self.assertEqual(self.client.get('/api/listings/').data['results'][0]['title'], "Lodge")
+
+    def test_deleting_a_listing_in_a_transaction_invalidates_it(self):
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.client.get('/api/listings/')
+        # The callbacks run after the delete has cleared instance.pk, as in the admin
+        with self.captureOnCommitCallbacks(execute=True), transaction.atomic():
+            self.listing.delete()
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.assertEqual(self.client.get('/api/listings/').data['results'], [])
+
+    def test_cascading_a_host_delete_invalidates_their_listings(self):
+        make_booking(self.listing, self.guest)
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.host.delete()
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_booking_and_review_changes_invalidate_their_listing(self):
+        other = make_listing(self.host, title="Other")
+        for create in (
+            lambda: make_booking(self.listing, self.guest),
+            lambda: Review.objects.create(listing=self.listing, guest=self.guest, rating=5),
+        ):
+            before = listing_cache.get_version(self.listing.pk)
+            untouched = listing_cache.get_version(other.pk)
+            with self.captureOnCommitCallbacks(execute=True):
+                create()
+            self.assertNotEqual(listing_cache.get_version(self.listing.pk), before)
+            self.assertEqual(listing_cache.get_version(other.pk), untouched)
+
+    def test_stats_command_reports_hit_ratio(self):
+        self.client.get(self.url)
+        self.client.get(self.url)
+        self.client.get(self.url)
+        out = StringIO()
+        call_command('cache_stats', '--reset', stdout=out)
+        self.assertIn("hits=2", out.getvalue())
+        self.assertIn("hit_ratio=66.67%", out.getvalue())
+        self.assertEqual(listing_cache.get_stats()['misses'], 0)
+
+
+class RatingAggregateTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.host = User.objects.create_user(username="host", password="pw")
+        self.guests = [User.objects.create_user(username=f"guest{i}") for i in range(3)]
+        self.listing = make_listing(self.host, title="Rated")
+        self.unrated = make_listing(self.host, title="Unrated")
+
+    def aggregates(self):
+        self.listing.refresh_from_db()
+        return self.listing.review_count, self.listing.rating_sum, self.listing.rating_avg
+
+    def test_create_update_delete_adjust_the_aggregates(self):
+        first = Review.objects.create(listing=self.listing, guest=self.guests[0], rating=5)
+        Review.objects.create(listing=self.listing, guest=self.guests[1], rating=2)
+        self.assertEqual(self.aggregates(), (2, 7, 3.5))
+
+        review = Review.objects.get(pk=first.pk)
+        review.rating = 3
+        review.save()
+        self.assertEqual(self.aggregates(), (2, 5, 2.5))
+
+        review.delete()
+        self.assertEqual(self.aggregates(), (1, 2, 2.0))
+        Review.objects.all().delete()
+        self.assertEqual(self.aggregates(), (0, 0, 0.0))
+
+    def test_updates_are_increments_not_recomputes(self):
+        Review.objects.create(listing=self.listing, guest=self.guests[0], rating=4)
+        with CaptureQueriesContext(connection) as queries:
+            Review.objects.create(listing=self.listing, guest=self.guests[1], rating=4)
+        update = next(q['sql'] for q in queries if q['sql'].startswith('UPDATE'))
+        self.assertIn('"review_count" + 1', update.replace('`', '"'))
+        self.assertNotIn('COUNT(', update.upper())
+
+    def test_rebuild_command_repairs_drift(self):
+        Review.objects.create(listing=self.listing, guest=self.guests[0], rating=4)
+        Review.objects.create(listing=self.listing, guest=self.guests[1], rating=1)
+        Listing.objects.update(review_count=9, rating_sum=0)
+        call_command('rebuild_ratings', '--batch-size', '1', stdout=StringIO())
+        self.assertEqual(self.aggregates(), (2, 5, 2.5))
+        self.unrated.refresh_from_db()
+        self.assertEqual((self.unrated.review_count, self.unrated.rating_sum), (0, 0))
+
+    def test_sort_and_filter_by_rating(self):
+        Review.objects.create(listing=self.listing, guest=self.guests[0], rating=4)
+        response = self.client.get('/api/listings/?ordering=-rating_avg')
+        self.assertEqual([row['title'] for row in response.data['results']], ["Rated", "Unrated"])
+        self.assertEqual(response.data['results'][0]['rating_avg'], 4.0)
+        response = self.client.get('/api/listings/?min_rating=3.5')
+        self.assertEqual([row['title'] for row in response.data['results']], ["Rated"])
+        self.assertEqual(self.client.get('/api/listings/?min_rating=high').status_code, 400)
+
+
+class SeedCommandTests(TransactionTestCase):
+    def seed(self, **options):
+        options = {'users': 6, 'listings': 5, 'bookings': 60, 'reviews': 12, 'payments': 25,
+                   'batch_size': 7, 'seed': 7, **options}
+        call_command('seed', stdout=StringIO(), **options)
+
+    def snapshot(self):
+        return (
+            list(Listing.objects.order_by('pk').values_list('title', 'location', 'price_per_night', 'latitude', 'longitude')),
+            list(Booking.objects.order_by('pk').values_list('check_in', 'check_out')),
+            list(Review.objects.order_by('pk').values_list('rating', 'comment')),
+            list(Payment.objects.order_by('pk').values_list('amount', 'status')),
+        )
+
+    def test_seeds_requested_volumes_without_overlaps(self):
+        self.seed()
+        self.assertEqual(User.objects.filter(username__startswith="seed_user_").count(), 6)
+        self.assertEqual(Listing.objects.count(), 5)
+        self.assertEqual(Booking.objects.count(), 60)
+        self.assertEqual(Review.objects.count(), 12)
+        self.assertEqual(Payment.objects.count(), 25)
+        self.assertEqual(count_double_bookings(), 0)
+        for listing in Listing.objects.all():
+            ratings = list(listing.reviews.values_list('rating', flat=True))
+            self.assertEqual((listing.review_count, listing.rating_sum), (len(ratings), sum(ratings)))
+
+    def test_same_seed_gives_same_rows(self):
+        self.seed()
+        first = self.snapshot()
+        self.seed()
+        self.assertEqual(self.snapshot(), first)
+        self.seed(seed=8)
+        self.assertNotEqual(self.snapshot(), first)
+
+    def test_reseeding_clears_the_analytics_rollup(self):
+        self.seed()
+        self.assertTrue(analytics.refresh_rollup(date.today() - timedelta(days=400), date.today() + timedelta(days=400)))
+        self.seed()
+        self.assertFalse(ListingDailyStats.objects.exists())
+
+    def test_listings_get_coordinates_and_cells(self):
+        self.seed()
+        for latitude, longitude, geocell in Listing.objects.values_list('latitude', 'longitude', 'geocell'):
+            self.assertEqual(geocell, geo.cell_for(latitude, longitude))
+
+    def test_rejects_impossible_volumes(self):
+        with self.assertRaises(CommandError):
+            self.seed(reviews=31)
+        with self.assertRaises(CommandError):
+            self.seed(payments=61)
+
+
+class ChapaClientTests(SimpleTestCase):
+    def client_for(self, stub, **kwargs):
+        kwargs.setdefault('backoff', 0)
+        client = ChapaClient(stub.base_url, "test-key", **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def test_connections_are_reused(self):
+        with StubChapaServer() as stub:
+            client = self.client_for(stub)
+            for n in range(5):
+                self.assertEqual(client.verify(f"tx-{n}").json()['data']['status'], 'success')
+        self.assertEqual(stub.connections, 1)
+
+    def test_idempotent_calls_retry_through_transient_errors(self):
+        with StubChapaServer(fail_next=2) as stub:
+            response = self.client_for(stub, max_retries=2).verify("tx-1")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(stub.requests), 3)
+
+    def test_initialize_is_never_retried(self):
+        with StubChapaServer(fail_next=1) as stub:
+            with self.assertRaises(ChapaError):
+                self.client_for(stub, max_retries=3).initialize({'tx_ref': "tx-1"})
+        self.assertEqual(len(stub.requests), 1)
+
+    def test_read_timeout_is_bounded(self):
+        with StubChapaServer(delay=0.5) as stub:
+            with self.assertRaises(ChapaError):
+                self.client_for(stub, read_timeout=0.05, max_retries=0).verify("tx-1")
+
+    def test_circuit_breaker_fails_fast_then_recovers(self):
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=lambda: now[0])
+        with StubChapaServer(fail_next=2) as stub:
+            client = self.client_for(stub, max_retries=0, breaker=breaker)
+            for _ in range(2):
+                with self.assertRaises(ChapaError):
+                    client.verify("tx-1")
+            with self.assertRaises(CircuitOpenError):
+                client.verify("tx-1")
+            self.assertEqual(len(stub.requests), 2)
+
+            now[0] = 11
+            self.assertEqual(breaker.state, 'half-open')
+            self.assertEqual(client.verify("tx-1").status_code, 200)
+            self.assertEqual(breaker.state, 'closed')
+
+
+class PaymentGatewayViewTests(APITestCase):
+    def setUp(self):
+        self.stub = StubChapaServer().__enter__()
+        self.addCleanup(self.stub.__exit__, None, None, None)
+        settings_override = override_settings(CHAPA_BASE_URL=self.stub.base_url, CHAPA_RETRY_BACKOFF=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        host = User.objects.create_user(username="host")
+        self.guest = User.objects.create_user(username="guest", email="guest@example.com")
+        booking = make_booking(make_listing(host), self.guest)
+        self.payment = Payment.objects.create(booking=booking, amount=200, transaction_id="tx-1")
+        self.client.force_authenticate(self.guest)
+
+    @mock.patch('listings.views.send_payment_confirmation_email')
+    def test_verify_goes_through_the_client(self, send_email):
+        response = self.client.post('/api/payments/verify/', {'tx_ref': "tx-1"})
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(self.stub.requests, [('GET', '/transaction/verify/tx-1')])
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'Success')
+
+    def test_gateway_outage_is_a_503(self):
+        self.stub.fail_next = 10
+        response = self.client.post('/api/payments/verify/', {'tx_ref': "tx-1"})
+        self.assertEqual(response.status_code, 503)
+
+
+class AsyncPaymentInitiationTests(APITestCase):
+    def setUp(self):
+        self.stub = StubChapaServer().__enter__()
+        self.addCleanup(self.stub.__exit__, None, None, None)
+        settings_override = override_settings(CHAPA_BASE_URL=self.stub.base_url, CHAPA_RETRY_BACKOFF=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        host = User.objects.create_user(username="host")
+        self.guest = User.objects.create_user(username="guest", email="guest@example.com")
+        self.booking = make_booking(make_listing(host, price_per_night=100), self.guest, nights=3)
+        self.client.force_authenticate(self.guest)
+
+    def initiate(self, **data):
+        return self.client.post('/api/payments/initiate/', {'booking_id': self.booking.pk, **data}, format='json')
+
+    def test_sync_mode_returns_checkout_url(self):
+        response = self.initiate()
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(response.data['data']['amount'], "300.00")
+        self.assertTrue(response.data['data']['checkout_url'].startswith('https://checkout.chapa.test/'))
+
+    @mock.patch('listings.views.initiate_chapa_payment')
+    def test_async_mode_queues_the_gateway_call(self, task):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.initiate(**{'async': True})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(self.stub.requests, [])
+        payment = Payment.objects.get(booking=self.booking)
+        self.assertEqual((payment.status, payment.checkout_url), ('Pending', ''))
+        task.delay.assert_called_once()
+        self.assertEqual(task.delay.call_args.args[0], payment.pk)
+
+        status_url = response.data['data']['status_url']
+        self.assertTrue(status_url.endswith(f'/api/payments/{payment.pk}/status/'))
+        self.assertEqual(self.client.get(status_url).data['data']['status'], 'Pending')
+
+    @mock.patch('listings.views.initiate_chapa_payment')
+    def test_task_fills_in_the_checkout_url(self, task):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.initiate(**{'async': True})
+        payment_id, payload = task.delay.call_args.args
+        earlier = timezone.now() - timedelta(hours=1)
+        Payment.objects.filter(pk=payment_id).update(updated_at=earlier)
+        initiate_chapa_payment.apply(args=(payment_id, payload))
+        payment = Payment.objects.get(pk=payment_id)
+        self.assertEqual(payment.status, 'Pending')
+        self.assertEqual(payment.checkout_url, f"https://checkout.chapa.test/{payload['tx_ref']}")
+        # Seen by the next incremental export
+        self.assertGreater(payment.updated_at, earlier)
+
+    @mock.patch('listings.views.initiate_chapa_payment')
+    def test_task_gives_up_after_retries(self, task):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.initiate(**{'async': True})
+        payment_id, payload = task.delay.call_args.args
+        earlier = timezone.now() - timedelta(hours=1)
+        Payment.objects.filter(pk=payment_id).update(updated_at=earlier)
+        self.stub.fail_next = 100
+        initiate_chapa_payment.apply(args=(payment_id, payload))
+        payment = Payment.objects.get(pk=payment_id)
+        self.assertEqual(payment.status, 'Failed')
+        self.assertGreater(payment.updated_at, earlier)
+        self.assertEqual(len(self.stub.requests), initiate_chapa_payment.max_retries + 1)
+
+
+@mock.patch('listings.views.send_payment_confirmation_email')
+class PaymentCallbackTests(APITestCase):
+    def setUp(self):
+        host = User.objects.create_user(username="host")
+        guest = User.objects.create_user(username="guest")
+        self.payment = Payment.objects.create(
+            booking=make_booking(make_listing(host), guest), amount=200, transaction_id="tx-1",
+        )
+
+    def callback(self, tx_ref="tx-1", chapa_status='success'):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/api/payments/callback/', {'tx_ref': tx_ref, 'status': chapa_status})
+
+    def test_replays_settle_once_and_email_once(self, send_email):
+        for _ in range(5):
+            self.assertEqual(self.callback().status_code, 200)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'Success')
+        send_email.delay.assert_called_once_with(self.payment.pk)
+        self.assertEqual(PaymentEvent.objects.count(), 1)
+
+    def test_replay_is_answered_from_the_ledger_alone(self, send_email):
+        self.callback()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.callback()
+        self.assertEqual(response.data['status'], 'duplicate')
+        # Besides the savepoint around it, only the ledger lookup runs
+        statements = [q['sql'] for q in queries if 'SAVEPOINT' not in q['sql']]
+        self.assertEqual(len(statements), 1, statements)
+
+    def test_late_status_does_not_override_a_settled_payment(self, send_email):
+        self.callback(chapa_status='failed')
+        self.callback(chapa_status='success')
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'Failed')
+        send_email.delay.assert_not_called()
+
+    def test_unknown_transaction_leaves_no_ledger_entry(self, send_email):
+        self.assertEqual(self.callback(tx_ref="nope").status_code, 404)
+        self.assertFalse(PaymentEvent.objects.exists())
+
+
+class ConfirmationEmailBatchTests(TestCase):
+    def setUp(self):
+        host = User.objects.create_user(username="host")
+        self.guests = [
+            User.objects.create_user(username=f"guest{i}", email=f"guest{i}@example.com") for i in range(3)
+        ]
+        listing = make_listing(host, title="Lake House")
+        self.bookings = [make_booking(listing, guest, offset=i) for i, guest in enumerate(self.guests)]
+        self.payments = [
+            Payment.objects.create(booking=booking, amount=200, transaction_id=f"tx-{booking.pk}")
+            for booking in self.bookings
+        ]
+
+    def test_batch_is_loaded_with_one_query_per_kind(self):
+        items = [(mail.BOOKING, b.pk) for b in self.bookings] + [(mail.PAYMENT, p.pk) for p in self.payments]
+        with self.assertNumQueries(2):
+            messages = mail.load_messages(items)
+        self.assertEqual(len(messages), 6)
+        self.assertIn("Lake House", messages[0].body)
+        self.assertEqual(messages[3].to, ["guest0@example.com"])
+
+    def test_payment_email_states_the_payment_currency(self):
+        payment = self.payments[0]
+        payment.currency = "USD"
+        payment.save()
+        [message] = mail.load_messages([(mail.PAYMENT, payment.pk)])
+        self.assertIn("- Amount: USD 200.00", message.body)
+
+    @override_settings(EMAIL_BATCH_SIZE=3, EMAIL_BATCH_WINDOW=60)
+    @mock.patch('listings.tasks.send_pending_confirmations.apply_async')
+    def test_confirmations_wait_until_the_batch_is_full(self, schedule):
+        cache.clear()
+        for booking in self.bookings[:2]:
+            send_booking_confirmation_email(booking.pk)
+        self.assertEqual(len(outbox.outbox), 0)
+        self.assertEqual(PendingConfirmation.objects.count(), 2)
+        schedule.assert_called_once_with(countdown=60)
+        send_booking_confirmation_email(self.bookings[2].pk)
+        self.assertEqual(len(outbox.outbox), 3)
+        self.assertFalse(PendingConfirmation.objects.exists())
+
+    @override_settings(EMAIL_BATCH_WINDOW=60)
+    @mock.patch('listings.tasks.send_pending_confirmations.apply_async')
+    def test_waiting_confirmations_survive_the_worker(self, schedule):
+        cache.clear()
+        send_payment_confirmation_email(self.payments[0].pk)
+        send_payment_confirmation_email(self.payments[0].pk)
+        # Nothing lives in the worker: whichever process runs the flush sends it, once
+        self.assertEqual(list(PendingConfirmation.objects.values_list('kind', 'object_id')),
+                         [(mail.PAYMENT, self.payments[0].pk)])
+        self.assertTrue(send_pending_confirmations.apply().successful())
+        self.assertEqual(len(outbox.outbox), 1)
+        self.assertFalse(PendingConfirmation.objects.exists())
+
+    def test_a_failed_flush_keeps_its_batch(self):
+        mail.queue(mail.BOOKING, self.bookings[0].pk)
+        with mock.patch('listings.mail.send_batch', side_effect=RuntimeError("worker lost")):
+            with self.assertRaises(RuntimeError):
+                mail.flush()
+        self.assertEqual(PendingConfirmation.objects.count(), 1)
+        self.assertEqual(mail.flush(), 1)
+        self.assertEqual(len(outbox.outbox), 1)
+
+    @mock.patch('listings.tasks.send_confirmation_batch.delay')
+    @mock.patch('listings.mail.deliver', return_value=[('booking', 3)])
+    def test_flush_hands_unsent_messages_to_celery(self, deliver, delay):
+        mail.queue(mail.BOOKING, 3)
+        mail.queue(mail.BOOKING, 4)
+        self.assertEqual(mail.flush(), 2)
+        delay.assert_called_once_with([('booking', 3)])
+        self.assertFalse(PendingConfirmation.objects.exists())
+
+    def test_failed_messages_are_retried_on_a_fresh_connection(self):
+        original = LocmemBackend.send_messages
+        # Keyed by the booking id in the subject
+        failures = {f"#{self.bookings[1].pk}": 2}
+
+        def flaky(backend, messages):
+            booking_ref = messages[0].subject.rsplit(' ', 1)[1]
+            if failures.get(booking_ref):
+                failures[booking_ref] -= 1
+                raise ConnectionError("SMTP hiccup")
+            return original(backend, messages)
+
+        with mock.patch.object(LocmemBackend, 'send_messages', flaky):
+            unsent = mail.send_batch(
+                mail.load_messages([(mail.PAYMENT, p.pk) for p in self.payments]), max_retries=2, backoff=0,
+            )
+        self.assertEqual(unsent, [])
+        self.assertEqual(len(outbox.outbox), 3)
+
+    def test_gives_up_after_max_retries(self):
+        with mock.patch.object(LocmemBackend, 'send_messages', side_effect=ConnectionError):
+            unsent = mail.send_batch(mail.load_messages([(mail.BOOKING, self.bookings[0].pk)]),
+                                     max_retries=2, backoff=0)
+        self.assertEqual(len(unsent), 1)
+
+
+class TaskProfileTests(SimpleTestCase):
+    def test_email_and_payment_work_use_separate_queues(self):
+        router = send_confirmation_batch.app.amqp.router
+        self.assertEqual(router.route({}, send_payment_confirmation_email.name)['queue'].name, 'email')
+        self.assertEqual(router.route({}, send_confirmation_batch.name)['queue'].name, 'email')
+        self.assertEqual(router.route({}, initiate_chapa_payment.name)['queue'].name, 'payments')
+        self.assertEqual(router.route({}, refresh_analytics_rollup.name)['queue'].name, 'analytics')
+
+    def test_tasks_ack_late_and_skip_results(self):
+        for task in (send_payment_confirmation_email, send_confirmation_batch, initiate_chapa_payment):
+            self.assertTrue(task.acks_late)
+            self.assertTrue(task.ignore_result)
+        self.assertEqual(initiate_chapa_payment.rate_limit, '20/s')
+
+    @mock.patch('listings.mail.deliver')
+    def test_batch_task_retries_only_what_was_not_sent(self, deliver):
+        deliver.side_effect = [[['payment', 2]], []]
+        result = send_confirmation_batch.apply(args=([['payment', 1], ['payment', 2]],))
+        self.assertTrue(result.successful())
+        self.assertEqual(deliver.call_args_list, [
+            mock.call([['payment', 1], ['payment', 2]]), mock.call([['payment', 2]]),
+        ])
+
+
+@mock.patch('listings.tasks.send_confirmation_batch')
+class PaymentReconciliationTests(TestCase):
+    def setUp(self):
+        self.stub = StubChapaServer(default_status='pending').__enter__()
+        self.addCleanup(self.stub.__exit__, None, None, None)
+        settings_override = override_settings(CHAPA_BASE_URL=self.stub.base_url, CHAPA_RETRY_BACKOFF=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        host = User.objects.create_user(username="host")
+        guest = User.objects.create_user(username="guest")
+        listing = make_listing(host)
+        self.payments = [
+            Payment.objects.create(booking=make_booking(listing, guest, offset=i), amount=200, transaction_id=f"tx-{i}")
+            for i in range(7)
+        ]
+        # Everything but the last payment is stale
+        Payment.objects.exclude(pk=self.payments[-1].pk).update(created_at=timezone.now() - timedelta(hours=2))
+        self.stub.statuses.update({'tx-0': 'success', 'tx-1': 'failed', 'tx-2': 'success', 'tx-6': 'success'})
+
+    def statuses(self):
+        return dict(Payment.objects.values_list('transaction_id', 'status'))
+
+    def test_settles_what_chapa_resolved(self, send_batch):
+        with self.captureOnCommitCallbacks(execute=True):
+            stats = Reconciliation(chunk_size=2, workers=3).run()
+        self.assertEqual(self.statuses(), {
+            'tx-0': 'Success', 'tx-1': 'Failed', 'tx-2': 'Success', 'tx-3': 'Pending',
+            'tx-4': 'Pending', 'tx-5': 'Pending', 'tx-6': 'Pending',
+        })
+        self.assertEqual(
+            {k: stats[k] for k in ('chunks', 'scanned', 'success', 'failed', 'unresolved', 'updated')},
+            {'chunks': 3, 'scanned': 6, 'success': 2, 'failed': 1, 'unresolved': 3, 'updated': 3},
+        )
+        self.assertEqual(len(self.stub.requests), 6)
+        sent = [item for call in send_batch.delay.call_args_list for item in call.args[0]]
+        self.assertEqual(sent, [[mail.PAYMENT, self.payments[0].pk], [mail.PAYMENT, self.payments[2].pk]])
+
+    def test_dry_run_changes_nothing(self, send_batch):
+        stats = Reconciliation(dry_run=True).run()
+        self.assertEqual((stats['success'], stats['failed'], stats['updated']), (2, 1, 0))
+        self.assertEqual(set(self.statuses().values()), {'Pending'})
+        send_batch.delay.assert_not_called()
+
+    def test_older_than_zero_includes_fresh_payments(self, send_batch):
+        stats = Reconciliation(older_than=timedelta(0), dry_run=True).run()
+        self.assertEqual((stats['scanned'], stats['success']), (7, 3))
+
+    def test_payment_settled_meanwhile_is_left_alone(self, send_batch):
+        original = Reconciliation.apply
+
+        def callback_lands_first(run, resolved):
+            Payment.objects.filter(transaction_id='tx-0').settle('Failed')
+            return original(run, resolved)
+
+        with mock.patch.object(Reconciliation, 'apply', callback_lands_first):
+            stats = Reconciliation().run()
+        self.assertEqual(self.statuses()['tx-0'], 'Failed')
+        self.assertEqual(stats['updated'], 2)
+
+    def test_gateway_errors_are_counted_not_raised(self, send_batch):
+        self.stub.fail_next = 100
+        with override_settings(CHAPA_MAX_RETRIES=0, CHAPA_BREAKER_THRESHOLD=100), \
+                self.assertLogs('listings.reconcile', 'WARNING') as logs:
+            stats = Reconciliation().run()
+        self.assertEqual(len(logs.records), 6)
+        self.assertEqual((stats['scanned'], stats['errors'], stats['updated']), (6, 6, 0))
+
+    def test_queries_per_chunk_are_constant(self, send_batch):
+        with CaptureQueriesContext(connection) as small:
+            Reconciliation(chunk_size=100, dry_run=True).run()
+        with CaptureQueriesContext(connection) as chunked:
+            Reconciliation(chunk_size=3, dry_run=True).run()
+        # A chunk of 6 or two chunks of 3, plus the final empty read
+        self.assertEqual((len(small), len(chunked)), (2, 3))
+
+
+class RequestMetricsTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.reset()
+        self.host = User.objects.create_user(username="host")
+        for i in range(3):
+            make_listing(self.host, title=f"Cabin {i}")
+
+    def test_server_timing_breaks_down_the_request(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/listings/')
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'^app;dur=[\d.]+, db;dur=[\d.]+;desc="(\d+) queries", http;dur=0.0, ser;dur=[\d.]+$')
+        self.assertIn(f'desc="{len(queries)} queries"', timing)
+
+    def test_histograms_are_exposed_per_view(self):
+        self.client.get('/api/listings/')
+        self.client.get('/api/listings/')
+        with override_settings(METRICS_TOKEN="scrape"):
+            text = self.client.get('/api/metrics/', HTTP_AUTHORIZATION="Bearer scrape").content.decode()
+        labels = '{view="listing-list",method="GET"}'
+        self.assertIn(f'http_request_duration_seconds_count{labels} 2', text)
+        self.assertIn(f'serializer_duration_seconds_count{labels} 2', text)
+        self.assertIn('# TYPE db_queries_per_request histogram', text)
+        # The second request was a cache hit that issued no queries
+        self.assertIn('db_queries_per_request_bucket{view="listing-list",method="GET",le="0"} 1', text)
+
+    @override_settings(METRICS_TOKEN="scrape")
+    def test_metrics_need_the_token_or_a_staff_user(self):
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 403)
+        self.assertEqual(self.client.get('/api/metrics/', HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+        self.client.force_login(self.host)
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 403)
+        self.client.logout()
+
+        self.assertEqual(self.client.get('/api/metrics/', HTTP_AUTHORIZATION="Bearer scrape").status_code, 200)
+        self.client.force_login(User.objects.create_user(username="ops", is_staff=True))
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 200)
+
+    @override_settings(METRICS_TOKEN="")
+    def test_an_empty_token_lets_no_scraper_in(self):
+        self.assertEqual(self.client.get('/api/metrics/', HTTP_AUTHORIZATION="Bearer ").status_code, 403)
+
+    def test_outbound_http_time_is_charged_to_the_request(self):
+        guest = User.objects.create_user(username="guest")
+        booking = make_booking(Listing.objects.first(), guest)
+        Payment.objects.create(booking=booking, amount=200, transaction_id="tx-1")
+        self.client.force_authenticate(guest)
+        with StubChapaServer(delay=0.02) as stub, override_settings(CHAPA_BASE_URL=stub.base_url), \
+                mock.patch('listings.views.send_payment_confirmation_email'):
+            response = self.client.post('/api/payments/verify/', {'tx_ref': "tx-1"})
+        http_ms = float(response['Server-Timing'].split('http;dur=')[1].split(',')[0])
+        self.assertGreaterEqual(http_ms, 20)
+
+
+class HistogramTests(SimpleTestCase):
+    def test_buckets_are_cumulative(self):
+        metrics.reset()
+        for value in (0, 1, 1, 7, 500):
+            metrics.observe('db_queries_per_request', (('view', 'v'),), value)
+        text = metrics.exposition()
+        for bound, count in (('0', 1), ('1', 3), ('5', 3), ('10', 4), ('200', 4), ('+Inf', 5)):
+            self.assertIn(f'db_queries_per_request_bucket{{view="v",le="{bound}"}} {count}', text)
+        self.assertIn('db_queries_per_request_sum{view="v"} 509.0', text)
+
+
+class ListingSearchTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        host = User.objects.create_user(username="host")
+        self.cabin = make_listing(host, title="Cozy Cabin", description="Pine cabin by the lake", price_per_night=80)
+        self.loft = make_listing(host, title="Cozy Loft", description="City loft", location="Mombasa", price_per_night=150)
+        self.villa = make_listing(host, title="Modern Villa", description="Cozy fireplace and a pool", price_per_night=600)
+        make_listing(host, title="Quiet Studio", description="Small studio", location="Kisumu")
+
+    def search(self, **params):
+        response = self.client.get('/api/listings/search/', params)
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def test_results_are_ranked(self):
+        data = self.search(q="cozy cabin")
+        self.assertEqual(data['count'], 3)
+        self.assertEqual(data['results'][0]['id'], self.cabin.pk)
+        self.assertEqual({r['id'] for r in data['results']}, {self.cabin.pk, self.loft.pk, self.villa.pk})
+
+    def test_filters_and_facets(self):
+        data = self.search(q="cozy", max_price=200, location="Nairobi")
+        self.assertEqual([r['id'] for r in data['results']], [self.cabin.pk])
+        self.assertEqual(data['count'], 1)
+        # The location facet ignores the location filter, the price facet does not
+        self.assertEqual(data['facets']['location'], [
+            {'value': "Mombasa", 'count': 1}, {'value': "Nairobi", 'count': 1},
+        ])
+        self.assertEqual([b['count'] for b in data['facets']['price']], [0, 1, 0, 0, 0])
+
+    def test_repeated_locations_and_paging(self):
+        data = self.search(q="cozy", location=["Nairobi", "Mombasa"], page_size=1, offset=1)
+        self.assertEqual(data['count'], 3)
+        self.assertEqual(len(data['results']), 1)
+
+    def test_index_follows_listing_changes(self):
+        self.search(q="cozy")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.loft.title = "Airy Loft"
+            self.loft.save()
+        self.assertEqual(self.search(q="cozy")['count'], 2)
+
+    def test_warm_search_loads_only_the_page(self):
+        self.search(q="cozy")
+        with self.assertNumQueries(1):
+            self.search(q="cozy", location="Nairobi")
+
+    def test_query_is_required(self):
+        self.assertEqual(self.client.get('/api/listings/search/').status_code, 400)
+        self.assertEqual(self.client.get('/api/listings/search/', {'q': "x", 'min_price': 9, 'max_price': 1}).status_code, 400)
+
+
+class NearbySearchTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.host = User.objects.create_user(username="host")
+        # Nairobi CBD, Westlands (~2 km), Thika (~40 km), Mombasa (~440 km)
+        self.cbd = make_listing(self.host, latitude=-1.2864, longitude=36.8172)
+        self.westlands = make_listing(self.host, latitude=-1.2676, longitude=36.8108)
+        self.thika = make_listing(self.host, latitude=-1.0333, longitude=37.0693)
+        self.mombasa = make_listing(self.host, latitude=-4.0435, longitude=39.6682, location="Mombasa")
+        make_listing(self.host, title="Somewhere")
+
+    def nearby(self, **params):
+        response = self.client.get('/api/listings/nearby/', params)
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def test_nearest_first_within_radius(self):
+        data = self.nearby(lat=-1.2833, lng=36.8167, radius_km=50)
+        self.assertEqual([r['id'] for r in data['results']], [self.cbd.pk, self.westlands.pk, self.thika.pk])
+        self.assertEqual(data['count'], 3)
+        self.assertAlmostEqual(data['results'][1]['distance_km'], 1.865, places=2)
+        self.assertEqual([r['id'] for r in self.nearby(lat=-1.2833, lng=36.8167, radius_km=20)['results']],
+                         [self.cbd.pk, self.westlands.pk])
+
+    def test_matches_a_full_scan(self):
+        rng = random.Random(3)
+        Listing.objects.bulk_create(
+            Listing(
+                title="Scattered", description="", location="", price_per_night=50, host=self.host,
+                latitude=latitude, longitude=longitude, geocell=geo.cell_for(latitude, longitude),
+            )
+            for latitude, longitude in ((rng.uniform(-89, 89), rng.uniform(-180, 180)) for _ in range(2000))
+        )
+        rows = list(Listing.objects.exclude(latitude=None).values_list('pk', 'latitude', 'longitude'))
+        # Around the antimeridian, near a pole and at an ordinary spot
+        for latitude, longitude, radius in ((10, 179.9, 800), (-87, 20, 500), (-1.28, 36.8, 300)):
+            expected = {
+                pk for pk, lat, lng in rows if geo.haversine_km(latitude, longitude, lat, lng) <= radius
+            }
+            result = geo.nearby(Listing.objects.all(), latitude, longitude, radius, limit=len(rows))
+            self.assertEqual({listing.pk for listing in result.listings}, expected)
+            self.assertEqual(result.distances, sorted(result.distances))
+
+    def test_cell_follows_coordinate_updates(self):
+        self.mombasa.latitude, self.mombasa.longitude = -1.29, 36.82
+        self.mombasa.save(update_fields=['latitude', 'longitude'])
+        self.mombasa.refresh_from_db()
+        self.assertEqual(self.mombasa.geocell, geo.cell_for(-1.29, 36.82))
+        self.assertEqual(self.nearby(lat=-1.2833, lng=36.8167, radius_km=5)['count'], 3)
+
+    def test_two_queries(self):
+        with self.assertNumQueries(2):
+            self.nearby(lat=-1.2833, lng=36.8167, radius_km=50)
+
+    def test_validation(self):
+        self.assertEqual(self.client.get('/api/listings/nearby/', {'lat': 91, 'lng': 0}).status_code, 400)
+        self.assertEqual(self.client.get('/api/listings/nearby/', {'lat': 0}).status_code, 400)
+        self.client.force_authenticate(self.host)
+        response = self.client.post('/api/listings/', {
+            'title': "Half", 'description': "x", 'location': "x", 'price_per_night': 10, 'latitude': 1,
+        })
+        self.assertEqual(response.status_code, 400)
+
+
+class OccupancyCalendarTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.guest = User.objects.create_user(username="guest")
+        self.listing = make_listing(self.guest)
+        self.first = timezone.localdate().replace(day=1)
+        self.month = self.first.strftime('%Y-%m')
+
+    def book(self, start, nights, listing=None):
+        check_in = self.first + timedelta(days=start)
+        return Booking.objects.create(
+            listing=listing or self.listing, guest=self.guest,
+            check_in=check_in, check_out=check_in + timedelta(days=nights),
+        )
+
+    def booked_days(self, listing=None, month=None):
+        listing = listing or self.listing
+        response = self.client.get(f'/api/listings/{listing.pk}/calendar/', {'month': month or self.month})
+        self.assertEqual(response.status_code, 200, response.data)
+        return [day['date'].day - 1 for day in response.data['days'] if day['booked']]
+
+    def test_bookings_fill_the_calendar(self):
+        self.book(2, 3)
+        self.book(10, 1)
+        self.assertEqual(self.booked_days(), [2, 3, 4, 10])
+        with self.assertNumQueries(1):
+            self.booked_days()
+
+    def test_moves_and_deletes_free_nights(self):
+        booking = self.book(2, 3)
+        booking.check_in, booking.check_out = booking.check_in + timedelta(days=5), booking.check_out + timedelta(days=5)
+        booking.save()
+        self.assertEqual(self.booked_days(), [7, 8, 9])
+
+        other = make_listing(self.guest)
+        booking.listing = other
+        booking.save()
+        self.assertEqual(self.booked_days(), [])
+        self.assertEqual(self.booked_days(other), [7, 8, 9])
+
+        booking.delete()
+        self.assertEqual(self.booked_days(other), [])
+
+    def test_freed_nights_still_held_by_another_booking_stay_booked(self):
+        self.book(2, 3)
+        overlapping = self.book(4, 2)
+        overlapping.delete()
+        self.assertEqual(self.booked_days(), [2, 3, 4])
+
+    def test_outdated_row_is_rebuilt_on_read(self):
+        self.book(1, 2)
+        ListingCalendar.objects.filter(listing=self.listing).update(origin=self.first - timedelta(days=31))
+        self.assertEqual(self.booked_days(), [1, 2])
+        self.assertEqual(ListingCalendar.objects.get(listing=self.listing).origin, self.first)
+
+    def test_listing_with_bookings_can_be_deleted(self):
+        self.book(1, 2)
+        self.listing.delete()
+        self.assertFalse(ListingCalendar.objects.exists())
+
+    def test_bad_requests(self):
+        self.assertEqual(self.client.get(f'/api/listings/{self.listing.pk}/calendar/', {'month': "1999-01"}).status_code, 400)
+        self.assertEqual(self.client.get(f'/api/listings/{self.listing.pk}/calendar/', {'month': "soon"}).status_code, 400)
+        self.assertEqual(self.client.get('/api/listings/999999/calendar/').status_code, 404)
+
+    def test_checker_finds_and_fixes_drift(self):
+        self.book(3, 2)
+        Booking.objects.bulk_create([Booking(
+            listing=self.listing, guest=self.guest, total_price=100,
+            check_in=self.first + timedelta(days=20), check_out=self.first + timedelta(days=21),
+        )])
+        with self.assertRaises(CommandError):
+            call_command('check_calendars', stdout=StringIO())
+        call_command('check_calendars', fix=True, stdout=StringIO())
+        call_command('check_calendars', stdout=StringIO())
+        self.assertEqual(self.booked_days(), [3, 4, 20])
+
+    def test_rebuild_command(self):
+        self.book(0, 1)
+        ListingCalendar.objects.all().delete()
+        call_command('rebuild_calendars', stdout=StringIO())
+        self.assertEqual(occupancy.check([self.listing.pk]), {'mismatched': [], 'outdated': [], 'missing': []})
+        self.assertEqual(self.booked_days(), [0])
+
+
+@mock.patch('listings.bulk.send_confirmation_batch')
+class BulkImportTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        # Schedules cached by earlier tests would hide the pricing queries
+        pricing.clear_caches()
+        self.guest = User.objects.create_user(username="guest")
+        self.client.force_authenticate(self.guest)
+        self.listing = make_listing(self.guest)
+        self.first = timezone.localdate().replace(day=1)
+
+    def stay(self, start, nights, listing=None):
+        check_in = self.first + timedelta(days=start)
+        return {
+            'listing': (listing or self.listing).pk,
+            'check_in': check_in.isoformat(),
+            'check_out': (check_in + timedelta(days=nights)).isoformat(),
+        }
+
+    def post_ndjson(self, url, items):
+        body = "\n".join(json.dumps(item) for item in items) + "\n"
+        return self.client.post(url, body, content_type='application/x-ndjson')
+
+    def test_listings_from_a_json_array(self, batch):
+        response = self.client.post('/api/listings/bulk/', [
+            {'title': "Loft", 'description': "x", 'location': "Nairobi", 'price_per_night': 80,
+             'latitude': -1.28, 'longitude': 36.82},
+            {'title': "No price", 'description': "x", 'location': "Nairobi"},
+            {'title': "Villa", 'description': "x", 'location': "Mombasa", 'price_per_night': 300},
+        ], format='json')
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual((response.data['created'], response.data['failed']), (2, 1))
+        statuses = [result['status'] for result in response.data['results']]
+        self.assertEqual(statuses, ['created', 'invalid', 'created'])
+        self.assertIn('price_per_night', response.data['results'][1]['errors'])
+        loft = Listing.objects.get(pk=response.data['results'][0]['id'])
+        self.assertEqual((loft.host, loft.geocell), (self.guest, geo.cell_for(-1.28, 36.82)))
+
+    def test_bookings_from_ndjson_with_conflicts(self, batch):
+        Booking.objects.create(
+            listing=self.listing, guest=self.guest,
+            check_in=self.first + timedelta(days=10), check_out=self.first + timedelta(days=12),
+        )
+        other = make_listing(self.guest)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.post_ndjson('/api/bookings/bulk/', [
+                self.stay(0, 3),
+                self.stay(11, 2),             # overlaps the existing booking
+                self.stay(2, 2),              # overlaps the first item
+                self.stay(3, 2),
+                self.stay(0, 3, other),
+                {'listing': 999999, 'check_in': "2030-01-01", 'check_out': "2030-01-02"},
+                self.stay(20, 0),
+            ])
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(
+            [result['status'] for result in response.data['results']],
+            ['created', 'conflict', 'conflict', 'created', 'created', 'invalid', 'invalid'],
+        )
+        created = [result['id'] for result in response.data['results'] if result['status'] == 'created']
+        self.assertEqual(Booking.objects.filter(pk__in=created, guest=self.guest).count(), 3)
+        self.assertEqual(count_double_bookings(), 0)
+        self.assertEqual(occupancy.check([self.listing.pk, other.pk])['mismatched'], [])
+        batch.delay.assert_called_once_with([['booking', pk] for pk in created])
+
+    def test_queries_do_not_grow_with_items(self, batch):
+        listings = [make_listing(self.guest) for _ in range(20)]
+
+        def run(count, start):
+            items = [self.stay(start, 1, listings[i % 20]) for i in range(count)]
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post('/api/bookings/bulk/', items, format='json')
+            self.assertEqual(response.status_code, 201, response.data)
+            return len(queries)
+
+        self.assertEqual(run(5, 0), run(20, 5))
+
+    def test_rejects_malformed_bodies(self, batch):
+        response = self.client.post('/api/bookings/bulk/', '{"listing": 1}\n{oops\n', content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("line 2", response.data['detail'])
+        self.assertEqual(self.client.post('/api/bookings/bulk/', {'listing': 1}, format='json').status_code, 400)
+        self.assertEqual(self.client.post('/api/bookings/bulk/', [], format='json').status_code, 400)
+        with override_settings(BULK_IMPORT_MAX_ITEMS=2):
+            response = self.client.post('/api/bookings/bulk/', [self.stay(i * 2, 1) for i in range(3)], format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class ExportTests(APITestCase):
+    def setUp(self):
+        self.guest = User.objects.create_user(username="guest")
+        self.listing = make_listing(self.guest)
+        self.bookings = [make_booking(self.listing, self.guest, offset=i) for i in range(5)]
+        self.payments = [
+            Payment.objects.create(booking=booking, amount=200, transaction_id=f"tx_{booking.pk}")
+            for booking in self.bookings[:3]
+        ]
+        self.client.force_authenticate(User.objects.create_user(username="finance", is_staff=True))
+        self.later = timezone.now() + timedelta(minutes=1)
+
+    def export(self, kind, **params):
+        response = self.client.get(f'/api/exports/{kind}/', {'until': self.later.isoformat(), **params})
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_bookings_as_csv(self):
+        response, body = self.export('bookings')
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertEqual(response['X-Export-Watermark'], self.later.isoformat())
+        lines = body.splitlines()
+        self.assertEqual(lines[0], "id,listing_id,guest_id,check_in,check_out,total_price,currency,created_at,updated_at")
+        self.assertEqual([int(line.split(',')[0]) for line in lines[1:]], [b.pk for b in self.bookings])
+        self.assertIn(",200.00,ETB,", lines[1])
+        self.assertTrue(lines[1].endswith(self.bookings[0].updated_at.isoformat()))
+
+    def test_edited_bookings_are_exported_again(self):
+        watermark = timezone.now()
+        _, body = self.export('bookings', since=watermark.isoformat())
+        self.assertEqual(body.splitlines()[1:], [])
+
+        # Moving the stay re-prices it, which finance has to see
+        booking = self.bookings[2]
+        booking.check_out += timedelta(days=1)
+        booking.save()
+        _, body = self.export('bookings', since=watermark.isoformat())
+        [row] = body.splitlines()[1:]
+        self.assertTrue(row.startswith(f"{booking.pk},"))
+        self.assertIn(",300.00,ETB,", row)
+
+    def test_payments_since_a_watermark(self):
+        _, body = self.export('payments', output='ndjson')
+        rows = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual([row['id'] for row in rows], [p.pk for p in self.payments])
+        self.assertEqual(rows[0]['amount'], "200.00")
+
+        watermark = timezone.now()
+        Payment.objects.filter(pk=self.payments[1].pk).settle('Success')
+        _, body = self.export('payments', output='ndjson', since=watermark.isoformat())
+        self.assertEqual([json.loads(line)['status'] for line in body.splitlines()], ['Success'])
+
+    @override_settings(EXPORT_CHUNK_SIZE=2)
+    def test_pages_through_rows_sharing_a_watermark(self):
+        Booking.objects.update(updated_at=timezone.now())
+        with CaptureQueriesContext(connection) as queries:
+            _, body = self.export('bookings')
+        self.assertEqual(len(body.splitlines()), 6)
+        # Three full-or-partial pages plus the empty one that ends the scan
+        self.assertEqual(len(queries), 4)
+
+    def test_requires_staff_and_a_known_kind(self):
+        self.assertEqual(self.client.get('/api/exports/reviews/').status_code, 404)
+        self.client.force_authenticate(self.guest)
+        self.assertEqual(self.client.get('/api/exports/bookings/').status_code, 403)
+
+    def test_command_writes_a_file(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'payments.csv')
+        stderr = StringIO()
+        call_command('export', 'payments', file=path, until=self.later.isoformat(), stderr=stderr)
+        with open(path, encoding='utf-8') as exported:
+            self.assertEqual(len(exported.read().splitlines()), 4)
+        self.assertIn(self.later.isoformat(), stderr.getvalue())
+
+
+class FieldPlanListTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.host = User.objects.create_user(username="host", password="pw")
+        self.guest = User.objects.create_user(username="guest", password="pw")
+        self.listings = [
+            make_listing(self.host, title="Café ☕ — Nairobi", latitude=-1.2921, longitude=36.8219),
+            make_listing(self.host, title="Line\u2028separated", latitude=0.00001, longitude=1e-07),
+            make_listing(self.host, title="No map pin"),
+            make_listing(self.host, title="Quote \" and \\ backslash", price_per_night="99.95"),
+        ]
+        for rating, listing in zip([5, 3, 4], self.listings):
+            Review.objects.create(listing=listing, guest=self.guest, rating=rating, comment="ok")
+        for offset, listing in enumerate(self.listings):
+            make_booking(listing, self.guest, offset=offset)
+
+    def get_both(self, url):
+        """The fast response and the one the ModelSerializer and stdlib renderer produce."""
+        cache.clear()
+        fast = self.client.get(url)
+        cache.clear()
+        with mock.patch.object(FieldPlan, 'compile', return_value=None), \
+                mock.patch('listings.renderers.orjson', None):
+            slow = self.client.get(url)
+        self.assertEqual(fast.status_code, 200, fast.content)
+        return fast, slow
+
+    def assertSameBytes(self, url):
+        fast, slow = self.get_both(url)
+        self.assertEqual(fast.content, slow.content)
+        return fast
+
+    def test_listing_pages_match_the_serializer(self):
+        url = '/api/listings/?page_size=3'
+        pages = 0
+        while url:
+            url = json.loads(self.assertSameBytes(url).content)['next']
+            pages += 1
+        self.assertEqual(pages, 2)
+
+    def test_ordering_and_sparse_fields_match_the_serializer(self):
+        self.assertSameBytes('/api/listings/?ordering=-rating_avg')
+        self.assertSameBytes('/api/listings/?ordering=-rating_avg&page_size=2')
+        response = self.assertSameBytes('/api/listings/?fields=id,latitude,rating_avg')
+        self.assertEqual(set(response.data['results'][0]), {'id', 'latitude', 'rating_avg'})
+
+    def test_booking_list_matches_the_serializer(self):
+        self.client.force_authenticate(self.guest)
+        self.assertSameBytes('/api/bookings/')
+        self.assertSameBytes('/api/bookings/?fields=check_in,created_at')
+
+    def test_list_is_one_query_without_instances(self):
+        with mock.patch.object(Listing, '__init__', side_effect=AssertionError("instance built")):
+            with self.assertNumQueries(1):
+                response = self.client.get('/api/listings/')
+        self.assertEqual(len(response.data['results']), 4)
+
+    def test_browsable_api_still_renders(self):
+        response = self.client.get('/api/listings/', HTTP_ACCEPT='text/html')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Café ☕".encode(), response.content)
+
+
+class FastJSONRendererTests(SimpleTestCase):
+    data = {
+        'text': "naïve\u2028\u2029 \"quoted\" </script>",
+        'looks_numeric': ["a,0.00001,b", "[1e5]"],
+        'floats': [0.1, 1.5, 1e16, 1e-05, 0.0001, 123456789.125, -0.0, 2.5e-300],
+        'when': timezone.now(),
+        'day': date(2030, 1, 1),
+        'price': Decimal("100.50"),
+        'nested': [{'id': 1, 'ok': True, 'none': None}],
+    }
+
+    def test_same_bytes_as_json_renderer(self):
+        self.assertEqual(FastJSONRenderer().render(self.data), JSONRenderer().render(self.data))
+
+    def test_rewrites_floats_orjson_formats_differently(self):
+        data = {'small': [1e-05, -0.00008, 1e-05], 'large': 2e16, 'plain': 0.0001, 'text': "1e16 0.00008"}
+        self.assertEqual(FastJSONRenderer().render(data), b'{"small":[1e-05,-8e-05,1e-05],"large":2e+16,'
+                                                          b'"plain":0.0001,"text":"1e16 0.00008"}')
+
+    def test_falls_back_for_indent_and_ascii(self):
+        context = {'indent': 2}
+        self.assertEqual(
+            FastJSONRenderer().render(self.data, renderer_context=context),
+            JSONRenderer().render(self.data, renderer_context=context),
+        )
+        with override_settings(REST_FRAMEWORK={'UNICODE_JSON': False}):
+            renderer, reference = FastJSONRenderer(), JSONRenderer()
+            self.assertEqual(renderer.render(self.data), reference.render(self.data))
+
+
+class QuoteTests(APITestCase):
+    def setUp(self):
+        pricing.clear_caches()
+        self.host = User.objects.create_user(username="host", password="pw")
+        self.guest = User.objects.create_user(username="guest", password="pw")
+        self.listing = make_listing(self.host, price_per_night="100.00")
+        # 2030-01-04 is a Friday
+        self.friday = date(2030, 1, 4)
+
+    def quote(self, check_in, nights):
+        self.listing.refresh_from_db()
+        return pricing.quote(self.listing, check_in, check_in + timedelta(days=nights))
+
+    def test_base_price_times_nights(self):
+        quote = self.quote(self.friday, 3)
+        self.assertEqual((quote.nights, quote.subtotal, quote.total, quote.currency), (3, Decimal("300.00"), Decimal("300.00"), "ETB"))
+
+    def test_weekend_and_season_rules(self):
+        PricingRule.objects.create(listing=self.listing, weekdays=PricingRule.WEEKEND, price_per_night="150.00")
+        PricingRule.objects.create(
+            listing=self.listing, start_date=self.friday + timedelta(days=7), end_date=self.friday + timedelta(days=8),
+            price_per_night="300.00", priority=1,
+        )
+        # Thu 100, Fri 150, Sat 150, Sun-Thu 5 x 100, Fri-Sat in season 2 x 300, Sun 100
+        self.assertEqual(self.quote(self.friday - timedelta(days=1), 11).total, Decimal("1600.00"))
+
+    def test_longest_qualifying_stay_discount(self):
+        StayDiscount.objects.create(listing=self.listing, min_nights=7, percent="10")
+        StayDiscount.objects.create(listing=self.listing, min_nights=28, percent="25")
+        self.assertEqual(self.quote(self.friday, 6).discount, Decimal("0.00"))
+        self.assertEqual(self.quote(self.friday, 7).total, Decimal("630.00"))
+        self.assertEqual(self.quote(self.friday, 30).total, Decimal("2250.00"))
+
+    def test_matches_night_by_night_pricing(self):
+        rng = random.Random(7)
+        rules = []
+        for priority in range(6):
+            start = self.friday + timedelta(days=rng.randint(-20, 60))
+            rules.append(PricingRule.objects.create(
+                listing=self.listing, priority=rng.randint(-2, 2), weekdays=rng.randint(1, 127),
+                start_date=rng.choice([None, start]), end_date=rng.choice([None, start + timedelta(days=rng.randint(0, 30))]),
+                price_per_night=Decimal(rng.randint(50, 400)),
+            ))
+        rules.sort(key=lambda rule: (rule.priority, rule.pk), reverse=True)
+
+        def night_price(night):
+            for rule in rules:
+                if ((rule.start_date is None or rule.start_date <= night)
+                        and (rule.end_date is None or night <= rule.end_date)
+                        and rule.weekdays >> night.weekday() & 1):
+                    return rule.price_per_night
+            return Decimal("100.00")
+
+        for _ in range(50):
+            check_in = self.friday + timedelta(days=rng.randint(-40, 80))
+            nights = rng.randint(1, 90)
+            expected = sum(night_price(check_in + timedelta(days=i)) for i in range(nights))
+            self.assertEqual(self.quote(check_in, nights).subtotal, expected)
+
+    def test_quotes_are_memoized_until_rules_change(self):
+        self.quote(self.friday, 3)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.quote(self.friday, 3).total, Decimal("300.00"))
+        PricingRule.objects.create(listing=self.listing, price_per_night="80.00")
+        self.assertEqual(self.quote(self.friday, 3).total, Decimal("240.00"))
+        self.listing.price_per_night = Decimal("90.00")
+        self.listing.save()
+        PricingRule.objects.all().delete()
+        self.assertEqual(self.quote(self.friday, 3).total, Decimal("270.00"))
+
+    def test_quote_endpoint(self):
+        StayDiscount.objects.create(listing=self.listing, min_nights=2, percent="12.5")
+        url = f'/api/listings/{self.listing.pk}/quote/'
+        response = self.client.get(url, {'check_in': '2030-01-04', 'check_out': '2030-01-07'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {
+            'listing': self.listing.pk, 'check_in': '2030-01-04', 'check_out': '2030-01-07', 'nights': 3,
+            'currency': 'ETB', 'subtotal': '300.00', 'discount': '37.50', 'total': '262.50',
+        })
+        response = self.client.get(url, {'check_in': '2030-01-04', 'check_out': '2030-01-04'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get('/api/listings/0/quote/', {'check_in': '2030-01-04', 'check_out': '2030-01-05'}).status_code, 404)
+
+    def test_bookings_store_their_quote(self):
+        PricingRule.objects.create(listing=self.listing, weekdays=PricingRule.WEEKEND, price_per_night="150.00")
+        self.client.force_authenticate(self.guest)
+        with mock.patch('listings.views.send_booking_confirmation_email'):
+            response = self.client.post('/api/bookings/', {
+                'listing': self.listing.pk, 'check_in': '2030-01-03', 'check_out': '2030-01-06',
+            })
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual((response.data['total_price'], response.data['currency']), ("400.00", "ETB"))
+
+        booking = Booking.objects.get(pk=response.data['id'])
+        booking.check_out = date(2030, 1, 5)
+        booking.save(update_fields=['check_out'])
+        booking.refresh_from_db()
+        self.assertEqual(booking.total_price, Decimal("250.00"))
+
+    def test_bulk_imported_bookings_are_quoted(self):
+        PricingRule.objects.create(listing=self.listing, weekdays=PricingRule.WEEKEND, price_per_night="150.00")
+        self.client.force_authenticate(self.guest)
+        with mock.patch('listings.bulk.send_confirmation_batch'):
+            response = self.client.post('/api/bookings/bulk/', [
+                {'listing': self.listing.pk, 'check_in': '2030-01-03', 'check_out': '2030-01-06'},
+                {'listing': self.listing.pk, 'check_in': '2030-01-06', 'check_out': '2030-01-07'},
+            ], format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(
+            list(Booking.objects.order_by('check_in').values_list('total_price', flat=True)),
+            [Decimal("400.00"), Decimal("100.00")],
+        )
+
+
+class HostAnalyticsTests(QueryCountMixin, APITestCase):
+    url = '/api/analytics/host/?start=2030-02-01&end=2030-02-28'
+
+    def setUp(self):
+        cache.clear()
+        self.host = User.objects.create_user(username="host")
+        self.guest = User.objects.create_user(username="guest")
+        self.cabin = make_listing(self.host, title="Cabin")
+        self.loft = make_listing(self.host, title="Loft")
+        self.stay(self.cabin, date(2030, 1, 30), date(2030, 2, 3), 'Success')
+        self.stay(self.cabin, date(2030, 2, 3), date(2030, 2, 7), 'Success')
+        self.stay(self.cabin, date(2030, 2, 10), date(2030, 2, 12), 'Failed')
+        self.stay(self.loft, date(2030, 2, 20), date(2030, 2, 22))
+        self.stay(make_listing(self.guest), date(2030, 2, 1), date(2030, 2, 28), 'Success')
+        Booking.objects.update(created_at=timezone.make_aware(timezone.datetime(2030, 1, 1, 12)))
+        Review.objects.create(listing=self.cabin, guest=self.guest, rating=4)
+        Review.objects.create(listing=self.loft, guest=self.guest, rating=2)
+        Review.objects.update(created_at=timezone.make_aware(timezone.datetime(2030, 2, 5, 9)))
+        self.client.force_authenticate(self.host)
+
+    def stay(self, listing, check_in, check_out, paid=None):
+        booking = Booking.objects.create(listing=listing, guest=self.guest, check_in=check_in, check_out=check_out)
+        if paid:
+            Payment.objects.create(booking=booking, amount=booking.total_price, status=paid)
+        return booking
+
+    def report(self, url=None):
+        response = self.client.get(url or self.url)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def test_figures_per_listing_and_in_total(self):
+        report = self.report(self.url + '&interval=month')
+        cabin, loft = report['listings']
+        self.assertEqual(report['source'], 'live')
+        self.assertEqual(
+            [cabin['nights_booked'], cabin['occupancy_rate'], cabin['bookings'], cabin['revenue']],
+            [8, 0.2857, 2, {'ETB': '400.00'}],
+        )
+        self.assertEqual(cabin['lead_time_days'], 36.5)
+        self.assertEqual([loft['nights_booked'], loft['revenue'], loft['lead_time_days']], [2, {}, 50.0])
+        self.assertEqual(report['totals'], {
+            'listings': 2, 'nights': 56, 'nights_booked': 10, 'occupancy_rate': 0.1786, 'bookings': 3,
+            'revenue': {'ETB': '400.00'}, 'lead_time_days': 41.0, 'reviews': 2, 'rating_avg': 3.0,
+        })
+        (month,) = report['series']
+        totals = {key: value for key, value in report['totals'].items() if key != 'listings'}
+        self.assertEqual(month, {'period': '2030-02-01', **totals})
+
+    def test_weekly_series_clips_the_window(self):
+        series = self.report(self.url + '&interval=week')['series']
+        self.assertEqual([week['period'] for week in series][:2], ['2030-01-28', '2030-02-04'])
+        self.assertEqual([series[0]['nights'], series[0]['nights_booked']], [6, 3])
+        self.assertEqual(sum(week['nights_booked'] for week in series), 10)
+
+    def test_queries_do_not_grow_with_listings(self):
+        def add_rows(count):
+            for i in range(count):
+                listing = make_listing(self.host, title=f"Listing {i}")
+                self.stay(listing, date(2030, 2, 3), date(2030, 2, 6), 'Success')
+                Review.objects.create(listing=listing, guest=self.guest, rating=5)
+
+        self.assertEqual(self.assertConstantQueries(self.url + '&interval=week', add_rows, grow_by=10), 6)
+
+    @override_settings(ANALYTICS_ROLLUP_MIN_LISTINGS=2, ANALYTICS_ROLLUP_FUTURE_DAYS=3000)
+    def test_large_hosts_read_the_rollup(self):
+        live = self.report()
+        self.assertEqual(live['source'], 'live')
+        self.assertGreater(refresh_analytics_rollup(), 0)
+
+        with CaptureQueriesContext(connection) as queries:
+            rollup = self.report()
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(rollup['source'], 'rollup')
+        self.assertIsNotNone(rollup['refreshed_at'])
+        self.assertEqual({**rollup, 'source': 'live', 'refreshed_at': None}, live)
+        self.assertEqual(self.report(self.url + '&source=live')['source'], 'live')
+
+    def test_validates_the_window(self):
+        self.assertEqual(self.client.get('/api/analytics/host/?start=2030-02-02&end=2030-02-01').status_code, 400)
+        self.assertEqual(self.client.get('/api/analytics/host/?start=2029-01-01&end=2030-02-01').status_code, 400)
+        self.assertEqual(len(self.report('/api/analytics/host/')['series']), 30)
+        self.client.force_authenticate(None)
+        self.assertIn(self.client.get(self.url).status_code, (401, 403))
+
+
+class AdminTests(QueryCountMixin, TestCase):
+    changelists = ['/admin/listings/listing/', '/admin/listings/booking/', '/admin/listings/review/', '/admin/listings/payment/']
+
+    def setUp(self):
+        call_command('seed', users=6, listings=5, bookings=60, reviews=12, payments=25, seed=7, stdout=StringIO())
+        self.admin = User.objects.create_superuser(username="admin", password="secret")
+        self.client.force_login(self.admin)
+
+    def add_rows(self, count):
+        host = User.objects.create_user(username=f"admin_rows_{Listing.objects.count()}")
+        for _ in range(count):
+            listing = make_listing(host)
+            booking = make_booking(listing, host)
+            Payment.objects.create(booking=booking, amount=booking.total_price, transaction_id=f"tx_admin_{booking.pk}")
+            Review.objects.create(listing=listing, guest=host, rating=3)
+
+    def test_changelists_run_constant_queries(self):
+        # Session, user, count and the page with its related rows
+        for url in self.changelists:
+            with self.subTest(url=url):
+                self.assertEqual(self.assertConstantQueries(url, self.add_rows, grow_by=5), 4)
+                self.assertEqual(self.count_queries(url + '?created_at__gte=2000-01-01+00:00:00%2B00:00'), 4)
+
+    def test_a_non_numeric_rating_filter_is_ignored(self):
+        response = self.client.get('/admin/listings/listing/?min_rating=abc')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_count, Listing.objects.count())
+
+    def test_foreign_keys_are_raw_ids(self):
+        booking = Booking.objects.first()
+        response = self.client.get(f'/admin/listings/booking/{booking.pk}/change/')
+        self.assertContains(response, 'vForeignKeyRawIdAdminField', count=2)
+        self.assertNotContains(response, f'<option value="{booking.guest_id}"')
+
+    def test_unfiltered_lists_use_the_estimated_count(self):
+        self.assertIsNone(django_admin.estimated_row_count(Booking))
+        with mock.patch('listings.admin.estimated_row_count', return_value=2_000_000) as estimate:
+            cl = self.client.get('/admin/listings/booking/').context['cl']
+            self.assertEqual((cl.result_count, cl.paginator.num_pages), (2_000_000, 40_000))
+            filtered = self.client.get('/admin/listings/payment/?status__exact=Pending').context['cl']
+            self.assertEqual(filtered.result_count, Payment.objects.filter(status='Pending').count())
+            estimate.return_value = 500
+            self.assertEqual(self.client.get('/admin/listings/booking/').context['cl'].result_count, 60)
+
+    def test_settling_payments_is_set_based(self):
+        Payment.objects.update(status='Pending')
+        Payment.objects.filter(pk=Payment.objects.order_by('pk')[0].pk).update(status='Failed')
+        payments = list(Payment.objects.order_by('pk').values_list('pk', flat=True))
+
+        def settle(action, selected):
+            with CaptureQueriesContext(connection) as queries, \
+                    mock.patch('listings.admin.send_confirmation_batch') as batch, \
+                    self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post('/admin/listings/payment/', {'action': action, '_selected_action': selected})
+            self.assertEqual(response.status_code, 302)
+            return len(queries), batch
+
+        few, _ = settle('mark_failed', payments[-2:])
+        many, batch = settle('mark_success', payments[:-2])
+        self.assertEqual(few, many)
+        statuses = dict(Payment.objects.values_list('pk', 'status'))
+        self.assertEqual([statuses[pk] for pk in payments[:2]], ['Failed', 'Success'])
+        self.assertEqual(statuses[payments[-1]], 'Failed')
+        batch.delay.assert_called_once_with([[mail.PAYMENT, pk] for pk in payments[1:-2]])
+
+    def test_rebuild_ratings_action(self):
+        Listing.objects.update(review_count=0, rating_sum=0)
+        response = self.client.post('/admin/listings/listing/', {
+            'action': 'rebuild_ratings', '_selected_action': list(Listing.objects.values_list('pk', flat=True)),
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Listing.objects.aggregate(total=Sum('review_count'))['total'], Review.objects.count())
+
+
+class QueryPlanTests(QueryPlanMixin, APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        call_command(
+            'seed', users=30, listings=600, bookings=3000, reviews=600, payments=1500, seed=3, stdout=StringIO(),
+        )
+        cls.payment = Payment.objects.select_related('booking__listing').exclude(transaction_id=None).first()
+        cls.guest = cls.payment.booking.guest
+        cls.listing = cls.payment.booking.listing
+        cls.admin = User.objects.create_superuser(username="admin", password="secret")
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_authenticate(self.guest)
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+        return response
+
+    def test_api_endpoints(self):
+        listing = self.listing.pk
+        for url in [
+            '/api/listings/',
+            '/api/listings/?ordering=-rating_avg',
+            '/api/listings/?min_rating=4',
+            f'/api/listings/{listing}/',
+            '/api/listings/available/?check_in=2030-01-01&check_out=2030-01-05',
+            '/api/listings/nearby/?lat=-1.28&lng=36.82&radius_km=20',
+            f'/api/listings/{listing}/calendar/',
+            f'/api/listings/{listing}/quote/?check_in=2030-01-01&check_out=2030-01-05',
+            '/api/bookings/',
+            '/api/payments/',
+            f'/api/payments/{self.payment.pk}/status/',
+            '/api/analytics/host/',
+        ]:
+            with self.subTest(url=url):
+                self.assertNoFullScans(lambda: self.get(url))
+
+    def test_payment_and_booking_lookups(self):
+        lookups = {
+            'payment by transaction id': lambda: Payment.objects.get(transaction_id=self.payment.transaction_id),
+            'bookings of a listing by date': lambda: list(
+                Booking.objects.filter(listing=self.listing, check_in__gte=date(2030, 1, 1)),
+            ),
+            'overlapping stays': lambda: Booking.objects.filter(listing=self.listing).overlapping(
+                date(2030, 1, 1), date(2030, 1, 5),
+            ).exists(),
+            'payments of a guest': lambda: list(Payment.objects.filter(booking__guest=self.guest)),
+            'stale payments': lambda: list(stale_payments(timedelta(minutes=30)).order_by('pk')[:200]),
+            'callback replay check': lambda: PaymentEvent.objects.filter(
+                tx_ref=self.payment.transaction_id, status='Success',
+            ).exists(),
+        }
+        for name, lookup in lookups.items():
+            with self.subTest(name):
+                self.assertNoFullScans(lookup)
+
+    def test_exports_and_admin_filters(self):
+        since = timezone.now() - timedelta(hours=1)
+        for kind in EXPORTS:
+            with self.subTest(kind):
+                self.assertNoFullScans(lambda: list(EXPORTS[kind].rows(since=since)))
+        self.client.force_login(self.admin)
+        for url in [
+            '/admin/listings/payment/?status__exact=Pending',
+            f'/admin/listings/payment/?q={self.payment.transaction_id}',
+            '/admin/listings/listing/?min_rating=4',
+            f'/admin/listings/booking/?created_at__gte={since.isoformat()}'.replace('+', '%2B'),
+        ]:
+            with self.subTest(url=url):
+                self.assertNoFullScans(lambda: self.get(url))
+
+    def test_reports_scans_of_large_tables_only(self):
+        with CaptureQueriesContext(connection) as queries:
+            list(Booking.objects.filter(check_out__gte=date(2030, 1, 1)))
+            list(User.objects.filter(email__endswith="@example.com"))
+        (scan,) = queryplan.check(queries.captured_queries, self.min_rows)
+        self.assertEqual((scan.table, scan.rows), ('listings_booking', 3000))
+        self.assertIn("Full scan of listings_booking", str(scan))
+        self.assertEqual(queryplan.aliases('SELECT 1 FROM "listings_review" U0 INNER JOIN "auth_user" ON'), {
+            'listings_review': 'listings_review', 'U0': 'listings_review', 'auth_user': 'auth_user',
+        })
+
+
+# The router leaves reads on the primary inside transactions, so these
+# tests can't run inside TestCase's
+@override_settings(DATABASE_REPLICAS=[REPLICA], REPLICA_STICKY_SECONDS=5)
+class ReplicaRoutingTests(ReplicaDatabaseMixin, APITransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.host = User.objects.create_user(username="host", password="pw")
+        self.guest = User.objects.create_user(username="guest", password="pw")
+        self.replicate(self.host, self.guest)
+
+    def test_safe_requests_read_from_replica(self):
+        listing = make_listing(self.host)
+        self.replicate(listing)
+        Listing.objects.filter(pk=listing.pk).update(title="Lodge")
+
+        self.assertEqual(self.client.get(f'/api/listings/{listing.pk}/').data['title'], "Cabin")
+        self.assertEqual(self.client.head(f'/api/listings/{listing.pk}/').status_code, 200)
+        self.assertNotIn(routers.STICKY_COOKIE, self.client.cookies)
+
+    def test_client_reads_its_writes_during_replica_lag(self):
+        self.client.force_authenticate(self.host)
+        response = self.client.post('/api/listings/', {
+            'title': "Lodge", 'description': "New", 'location': "Nairobi", 'price_per_night': '80.00',
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertIn(routers.STICKY_COOKIE, response.cookies)
+        self.assertEqual(response.cookies[routers.STICKY_COOKIE]['max-age'], 5)
+        url = f"/api/listings/{response.data['id']}/"
+
+        # Everyone else reads from the lagging replica; the writer from the primary
+        self.assertEqual(APIClient().get(url).status_code, 404)
+        self.assertEqual(self.client.get(url).data['title'], "Lodge")
+
+        # Once the window is over the writer is back on the replica
+        cache.clear()
+        with mock.patch('listings.routers.time.time', return_value=routers.time.time() + 6):
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_cache_keeps_out_replica_reads_of_fresh_versions(self):
+        listing = make_listing(self.host)
+        self.replicate(listing)
+        self.client.force_authenticate(self.host)
+        self.assertEqual(self.client.patch(f'/api/listings/{listing.pk}/', {'title': "Lodge"}).status_code, 200)
+
+        stale = APIClient().get(f'/api/listings/{listing.pk}/')
+        self.assertEqual(stale.data['title'], "Cabin")
+        self.assertNotIn('ETag', stale)
+        self.assertEqual(self.client.get(f'/api/listings/{listing.pk}/').data['title'], "Lodge")
+
+    def test_writes_in_safe_requests_stick_to_primary(self):
+        listing = make_listing(self.host)
+        self.replicate(listing)
+        with routers.routing() as state:
+            state.use_replica()
+            self.assertEqual(Listing.objects.all().db, REPLICA)
+            with transaction.atomic():
+                self.assertEqual(Listing.objects.all().db, DEFAULT_DB_ALIAS)
+            self.assertEqual(Listing.objects.all().db, REPLICA)
+            # Related rows follow their instance
+            self.assertEqual(Listing.objects.get(pk=listing.pk).host._state.db, REPLICA)
+
+            self.assertEqual(Listing.objects.select_for_update().db, DEFAULT_DB_ALIAS)
+            self.assertTrue(state.wrote)
+            self.assertEqual(Listing.objects.all().db, DEFAULT_DB_ALIAS)
+        self.assertEqual(Listing.objects.all().db, DEFAULT_DB_ALIAS)
+
+    def test_views_opt_out_of_replica_reads(self):
+        booking = make_booking(make_listing(self.host), self.guest)
+        payment = Payment.objects.create(booking=booking, amount=200, transaction_id="tx-1", status='Success')
+        self.client.force_authenticate(self.guest)
+        response = self.client.get(f'/api/payments/{payment.pk}/status/')
+        self.assertEqual(response.data['data']['status'], 'Success')
@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import ListingViewSet, BookingViewSet, PaymentViewSet
+from .views import ListingViewSet, BookingViewSet, PaymentViewSet, ExportView, HostAnalyticsView, prometheus_metrics
 
 router = DefaultRouter()
 router.register(r"listings", ListingViewSet, basename="listing")
@@ -10,4 +10,7 @@ router.register(r'payments', PaymentViewSet, basename='payment')
 
 urlpatterns = [
     path("", include(router.urls)),
+    path("metrics/", prometheus_metrics, name="metrics"),
+    path("exports/<str:kind>/", ExportView.as_view(), name="export"),
+    path("analytics/host/", HostAnalyticsView.as_view(), name="host-analytics"),
 ]
@@ -1,16 +1,88 @@
+from django.db import transaction
 from rest_framework import viewsets, permissions, status
-from .models import Listing, Booking, Payment
-from .serializers import ListingSerializer, BookingSerializer, PaymentSerializer
-import os
-import requests
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework.filters import OrderingFilter
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import BrowsableAPIRenderer
+from .models import Listing, Booking, Payment, PaymentEvent, BookingConflict
+from .serializers import (
+    ListingSerializer, BookingSerializer, PaymentSerializer, AvailabilityQuerySerializer,
+    SearchQuerySerializer, NearbyQuerySerializer, CalendarQuerySerializer, ExportQuerySerializer, FieldPlan,
+    AnalyticsQuerySerializer,
+    QuoteQuerySerializer,
+)
+import hmac
+import time
 import uuid
 from rest_framework.response import Response
 from rest_framework.decorators import action
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.reverse import reverse
+from django.conf import settings
+from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
+from rest_framework.views import APIView
+from django.http import Http404, HttpResponse, HttpResponseForbidden, StreamingHttpResponse
+from django.utils import timezone
+from . import analytics
+from . import bulk as bulk_import
+from . import cache as listing_cache
+from . import export
+from . import geo
+from . import metrics
+from . import occupancy
+from . import pricing
+from . import search as listing_search
+from .chapa import get_client, ChapaError
+from .pagination import CreatedAtCursorPagination
+from .parsers import NDJSONParser
+from .renderers import FastJSONRenderer
 from .tasks import send_payment_confirmation_email
 from .tasks import send_booking_confirmation_email
+from .tasks import initiate_chapa_payment
 
-class ListingViewSet(viewsets.ModelViewSet):
+class BookingConflictError(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = "The listing is already booked for some of these nights."
+    default_code = 'booking_conflict'
+
+
+def bulk_import_response(result):
+    """201 when every item was created, 207 with the per-item outcome otherwise."""
+    return Response(
+        {'created': result.created, 'failed': result.failed, 'results': result.results},
+        status=status.HTTP_207_MULTI_STATUS if result.failed else status.HTTP_201_CREATED,
+    )
+
+
+class FieldPlanListMixin:
+    """
+    Serves ``list`` from values_list rows through a precompiled FieldPlan
+    instead of a serializer per instance, and renders with orjson when it
+    is available. The response bytes are the same as the regular path's,
+    which still handles serializers the plan can't express.
+    """
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
+
+    def list(self, request, *args, **kwargs):
+        plan = FieldPlan.compile(self.get_serializer())
+        if plan is None:
+            return super().list(request, *args, **kwargs)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        get_ordering = getattr(self.paginator, 'get_ordering', None)
+        # The cursor paginator reads its position from the ordering columns
+        ordering = [name.lstrip('-') for name in get_ordering(request, queryset, self)] if get_ordering else []
+        rows = plan.rows(queryset, *ordering)
+        page = self.paginate_queryset(rows)
+
+        started = time.perf_counter()
+        data = plan.render(rows if page is None else page)
+        metrics.record_serializer(time.perf_counter() - started)
+        if page is None:
+            return Response(data)
+        return self.get_paginated_response(data)
+
+
+class ListingViewSet(FieldPlanListMixin, viewsets.ModelViewSet):
     """
     ViewSet for Listings.
     """
@@ -18,12 +90,169 @@ class ListingViewSet(viewsets.ModelViewSet):
     queryset = Listing.objects.all()
     serializer_class = ListingSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+    pagination_class = CreatedAtCursorPagination
+    filter_backends = [OrderingFilter]
+    # Only indexed columns, so ?ordering= never falls back to a filesort
+    ordering_fields = ['created_at', 'rating_avg']
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        deferred = self.get_serializer_class().deferred_fields(self.request)
+        if deferred:
+            queryset = queryset.defer(*deferred)
+        min_rating = self.request.query_params.get('min_rating')
+        if min_rating:
+            try:
+                queryset = queryset.filter(rating_avg__gte=float(min_rating))
+            except ValueError:
+                raise ValidationError({'min_rating': "A number is required."})
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        return listing_cache.cached_response(
+            request, listing_cache.LIST_SCOPE, lambda: super(ListingViewSet, self).list(request, *args, **kwargs).data,
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        pk = kwargs[self.lookup_field]
+        if not pk.isdigit():
+            return super().retrieve(request, *args, **kwargs)
+        return listing_cache.cached_response(
+            request, int(pk), lambda: super(ListingViewSet, self).retrieve(request, *args, **kwargs).data,
+        )
 
     def perform_create(self, serializer):
         serializer.save(host=self.request.user)
 
+    @action(detail=False, methods=['get'], url_path='available')
+    def available(self, request):
+        """
+        Listings free for the whole [check_in, check_out) stay.
+
+        Answered with a single NOT EXISTS query that probes
+        booking_listing_dates_idx once per listing.
+        """
+        params = AvailabilityQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        queryset = self.filter_queryset(self.get_queryset()).available_between(
+            params.validated_data['check_in'], params.validated_data['check_out'],
+        )
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+        serializer = self.get_serializer(queryset, many=True)
+        return Response(serializer.data)
+
+    @action(detail=False, methods=['get'], url_path='search')
+    def search(self, request):
+        """
+        Full-text search: ``?q=`` ranked by relevance, narrowed by
+        ``min_price``/``max_price`` and repeated ``location``, with location
+        and price facet counts for the matches.
+        """
+        params = SearchQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        data = params.validated_data
+
+        result = listing_search.search(
+            data['q'],
+            min_price=data.get('min_price'),
+            max_price=data.get('max_price'),
+            locations=data['location'],
+            offset=data['offset'],
+            limit=data['page_size'],
+            queryset=self.get_queryset(),
+        )
+        return Response({
+            'count': result.count,
+            'results': self.get_serializer(result.listings, many=True).data,
+            'facets': result.facets,
+        })
+
+    @action(detail=False, methods=['get'], url_path='nearby')
+    def nearby(self, request):
+        """
+        Listings within ``radius_km`` of ``lat``/``lng``, nearest first, each
+        with its ``distance_km``.
 
-class BookingViewSet(viewsets.ModelViewSet):
+        The grid cells around the point narrow the candidates through
+        listing_geocell_idx before the exact distance check.
+        """
+        params = NearbyQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        data = params.validated_data
+
+        result = geo.nearby(
+            self.get_queryset(), data['lat'], data['lng'], data['radius_km'],
+            offset=data['offset'], limit=data['page_size'],
+        )
+        results = self.get_serializer(result.listings, many=True).data
+        for item, distance in zip(results, result.distances):
+            item['distance_km'] = round(distance, 3)
+        return Response({'count': result.count, 'results': results})
+
+    @action(detail=False, methods=['post'], url_path='bulk', parser_classes=[JSONParser, NDJSONParser])
+    def bulk(self, request):
+        """
+        Create many listings from a JSON array or an NDJSON body, validated
+        item by item and inserted in batches.
+        """
+        return bulk_import_response(
+            bulk_import.import_listings(request.data, self.get_serializer_context(), request.user)
+        )
+
+    @action(detail=True, methods=['get'], url_path='calendar')
+    def calendar(self, request, pk=None):
+        """
+        Which nights of ``?month=YYYY-MM`` are booked, read from the
+        listing's occupancy bitmap rather than its bookings.
+        """
+        params = CalendarQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        first = params.validated_data.get('month', timezone.localdate().replace(day=1))
+        if not pk.isdigit():
+            raise Http404
+        try:
+            booked = occupancy.booked_nights(int(pk), first.year, first.month)
+        except occupancy.OutsideHorizon as exc:
+            raise ValidationError({'month': str(exc)})
+        if booked is None:
+            raise Http404
+        return Response({
+            'listing': int(pk),
+            'month': first.strftime('%Y-%m'),
+            'days': [
+                {'date': first.replace(day=day), 'booked': taken}
+                for day, taken in enumerate(booked, start=1)
+            ],
+        })
+
+    @action(detail=True, methods=['get'], url_path='quote')
+    def quote(self, request, pk=None):
+        """
+        Price of staying ``?check_in=`` to ``?check_out=``: nightly prices
+        after pricing rules, less the listing's stay discount.
+        """
+        params = QuoteQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        quote = pricing.quote(
+            self.get_object(), params.validated_data['check_in'], params.validated_data['check_out'],
+        )
+        return Response({
+            'listing': quote.listing_id,
+            'check_in': quote.check_in,
+            'check_out': quote.check_out,
+            'nights': quote.nights,
+            'currency': quote.currency,
+            'subtotal': str(quote.subtotal),
+            'discount': str(quote.discount),
+            'total': str(quote.total),
+        })
+
+
+class BookingViewSet(FieldPlanListMixin, viewsets.ModelViewSet):
     """
     ViewSet for Bookings.
     """
@@ -31,25 +260,67 @@ class BookingViewSet(viewsets.ModelViewSet):
     queryset = Booking.objects.all()
     serializer_class = BookingSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = CreatedAtCursorPagination
 
     def perform_create(self, serializer):
-        booking = serializer.save(guest=self.request.user)
+        with transaction.atomic():
+            self.reserve(serializer)
+            booking = serializer.save(guest=self.request.user)
         send_booking_confirmation_email.delay(booking.id)
 
+    def perform_update(self, serializer):
+        with transaction.atomic():
+            self.reserve(serializer)
+            serializer.save()
+
+    @action(detail=False, methods=['post'], url_path='bulk', parser_classes=[JSONParser, NDJSONParser])
+    def bulk(self, request):
+        """
+        Create many bookings from a JSON array or an NDJSON body. Overlap
+        checks run once for the whole import; clashing items come back as
+        conflicts while the rest are booked.
+        """
+        return bulk_import_response(
+            bulk_import.import_bookings(request.data, self.get_serializer_context(), request.user)
+        )
+
+    def reserve(self, serializer):
+        """Lock the target listing and reject stays overlapping another booking."""
+        instance = serializer.instance
+        data = serializer.validated_data
+        try:
+            Booking.objects.reserve(
+                data.get('listing', getattr(instance, 'listing', None)),
+                data.get('check_in', getattr(instance, 'check_in', None)),
+                data.get('check_out', getattr(instance, 'check_out', None)),
+                exclude=instance,
+            )
+        except BookingConflict:
+            raise BookingConflictError()
+
 
 class PaymentViewSet(viewsets.ModelViewSet):
     """ViewSet for handling payments with Chapa integration"""
     queryset = Payment.objects.all()
     serializer_class = PaymentSerializer
     permission_classes = [IsAuthenticated]
+    # Chapa's callbacks settle payments behind their payer's back; status reads must see them
+    replica_reads = False
     
     def get_queryset(self):
         """Filter payments by current user"""
-        return Payment.objects.filter(booking__user=self.request.user)
+        # booking_details reads booking and booking.guest for every row
+        return Payment.objects.filter(booking__guest=self.request.user).select_related('booking__guest')
     
     @action(detail=False, methods=['post'], url_path='initiate')
     def initiate_payment(self, request):
-        """Initiate payment with Chapa API"""
+        """
+        Initiate payment with Chapa API.
+
+        With ``"async": true`` (or PAYMENT_INITIATION_ASYNC) the Chapa call
+        runs in a Celery task and the response is a 202 pointing at the
+        status endpoint, so a slow gateway never holds a web worker.
+        """
         try:
             booking_id = request.data.get('booking_id')
             
@@ -60,14 +331,16 @@ class PaymentViewSet(viewsets.ModelViewSet):
             
             # Get booking
             try:
-                booking = Booking.objects.get(id=booking_id, user=request.user)
+                booking = Booking.objects.select_related('listing', 'payment').get(
+                    id=booking_id, guest=request.user,
+                )
             except Booking.DoesNotExist:
                 return Response({
                     "error": "Booking not found"
                 }, status=status.HTTP_404_NOT_FOUND)
             
             # Check if payment already exists and is completed
-            if hasattr(booking, 'payment') and booking.payment.status == 'completed':
+            if hasattr(booking, 'payment') and booking.payment.status == 'Success':
                 return Response({
                     "error": "Booking already paid"
                 }, status=status.HTTP_400_BAD_REQUEST)
@@ -78,7 +351,7 @@ class PaymentViewSet(viewsets.ModelViewSet):
             # Chapa payload
             chapa_payload = {
                 "amount": str(booking.total_price),
-                "currency": "ETB",
+                "currency": booking.currency,
                 "email": request.user.email,
                 "first_name": request.user.first_name or "Customer",
                 "last_name": request.user.last_name or "User",
@@ -88,37 +361,32 @@ class PaymentViewSet(viewsets.ModelViewSet):
                 "description": f"Payment for booking {booking.id}"
             }
             
+            if self.wants_async(request):
+                with transaction.atomic():
+                    payment = self.record_pending_payment(booking, tx_ref)
+                    transaction.on_commit(lambda: initiate_chapa_payment.delay(payment.id, chapa_payload))
+                return Response({
+                    "status": "pending",
+                    "data": {
+                        "payment_id": payment.id,
+                        "transaction_id": tx_ref,
+                        "amount": str(booking.total_price),
+                        "status_url": reverse('payment-get-payment-status', args=[payment.id], request=request),
+                    },
+                    "message": "Payment initiation queued"
+                }, status=status.HTTP_202_ACCEPTED)
+
             # Make request to Chapa
-            headers = {
-                'Authorization': f'Bearer {os.getenv("CHAPA_SECRET_KEY")}',
-                'Content-Type': 'application/json',
-            }
-            
-            response = requests.post(
-                'https://api.chapa.co/v1/transaction/initialize',
-                json=chapa_payload,
-                headers=headers,
-                timeout=30
-            )
+            response = get_client().initialize(chapa_payload)
             
             if response.status_code == 200:
                 chapa_response = response.json()
                 
                 # Create or update payment record
-                payment, created = Payment.objects.get_or_create(
-                    booking=booking,
-                    defaults={
-                        'amount': booking.total_price,
-                        'transaction_id': tx_ref,
-                        'status': 'pending'
-                    }
+                payment = self.record_pending_payment(
+                    booking, tx_ref, checkout_url=chapa_response['data']['checkout_url'],
                 )
                 
-                if not created:
-                    payment.transaction_id = tx_ref
-                    payment.status = 'pending'
-                    payment.save()
-                
                 return Response({
                     "status": "success",
                     "data": {
@@ -135,11 +403,41 @@ class PaymentViewSet(viewsets.ModelViewSet):
                     "details": response.text
                 }, status=status.HTTP_400_BAD_REQUEST)
                 
+        except ChapaError as e:
+            return Response({
+                "error": f"Payment gateway unavailable: {str(e)}"
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
         except Exception as e:
             return Response({
                 "error": f"An error occurred: {str(e)}"
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     
+    def wants_async(self, request):
+        flag = request.data.get('async', settings.PAYMENT_INITIATION_ASYNC)
+        return str(flag).lower() in ('1', 'true', 'yes')
+
+    def record_pending_payment(self, booking, tx_ref, checkout_url=''):
+        """Create or reset the booking's payment as Pending for ``tx_ref``."""
+        payment, created = Payment.objects.get_or_create(
+            booking=booking,
+            defaults={
+                'amount': booking.total_price,
+                'currency': booking.currency,
+                'transaction_id': tx_ref,
+                'checkout_url': checkout_url,
+                'status': 'Pending'
+            }
+        )
+        
+        if not created:
+            payment.amount = booking.total_price
+            payment.currency = booking.currency
+            payment.transaction_id = tx_ref
+            payment.checkout_url = checkout_url
+            payment.status = 'Pending'
+            payment.save()
+        return payment
+    
     @action(detail=False, methods=['post'], url_path='verify')
     def verify_payment(self, request):
         """Verify payment with Chapa API"""
@@ -152,36 +450,26 @@ class PaymentViewSet(viewsets.ModelViewSet):
                 }, status=status.HTTP_400_BAD_REQUEST)
             
             # Verify with Chapa
-            headers = {
-                'Authorization': f'Bearer {os.getenv("CHAPA_SECRET_KEY")}',
-            }
-            
-            response = requests.get(
-                f'https://api.chapa.co/v1/transaction/verify/{tx_ref}',
-                headers=headers,
-                timeout=30
-            )
+            response = get_client().verify(tx_ref)
             
             if response.status_code == 200:
                 verification_data = response.json()
                 
                 # Get payment record
                 try:
-                    payment = Payment.objects.get(transaction_id=tx_ref)
+                    payment = Payment.objects.select_related('booking__guest').get(transaction_id=tx_ref)
                 except Payment.DoesNotExist:
                     return Response({
                         "error": "Payment record not found"
                     }, status=status.HTTP_404_NOT_FOUND)
                 
-                # Update payment status based on Chapa response
+                # Update payment status based on Chapa response; only a real
+                # Pending -> Success transition sends the confirmation
                 if verification_data.get('status') == 'success' and \
                    verification_data.get('data', {}).get('status') == 'success':
-                    payment.status = 'completed'
-                    payment.booking.status = 'confirmed'
-                    payment.booking.save()
-                    payment.save()
-                    
-                    send_payment_confirmation_email.delay(payment.id)
+                    if Payment.objects.filter(pk=payment.pk).settle('Success'):
+                        send_payment_confirmation_email.delay(payment.id)
+                    payment.refresh_from_db()
                     
                     serializer = self.get_serializer(payment)
                     return Response({
@@ -190,8 +478,7 @@ class PaymentViewSet(viewsets.ModelViewSet):
                         "data": serializer.data
                     })
                 else:
-                    payment.status = 'failed'
-                    payment.save()
+                    Payment.objects.filter(pk=payment.pk).settle('Failed')
                     
                     return Response({
                         "status": "failed",
@@ -204,6 +491,10 @@ class PaymentViewSet(viewsets.ModelViewSet):
                     "details": response.text
                 }, status=status.HTTP_400_BAD_REQUEST)
                 
+        except ChapaError as e:
+            return Response({
+                "error": f"Payment gateway unavailable: {str(e)}"
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
         except Exception as e:
             return Response({
                 "error": f"Verification error: {str(e)}"
@@ -212,7 +503,14 @@ class PaymentViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=['post'], url_path='callback', 
             permission_classes=[AllowAny])
     def payment_callback(self, request):
-        """Handle Chapa webhook callback"""
+        """
+        Handle Chapa webhook callback.
+
+        Idempotent: each (tx_ref, status) is recorded once in PaymentEvent,
+        replays return straight after that lookup, and the status change is
+        a conditional UPDATE so the confirmation email is queued only on the
+        actual Pending -> Success transition.
+        """
         try:
             tx_ref = request.data.get('tx_ref')
             chapa_status = request.data.get('status')
@@ -222,29 +520,30 @@ class PaymentViewSet(viewsets.ModelViewSet):
                     "error": "Transaction reference missing"
                 }, status=status.HTTP_400_BAD_REQUEST)
             
-            try:
-                payment = Payment.objects.get(transaction_id=tx_ref)
-            except Payment.DoesNotExist:
-                return Response({
-                    "error": "Payment not found"
-                }, status=status.HTTP_404_NOT_FOUND)
-            
-            # Update payment status
-            if chapa_status == 'success':
-                payment.status = 'completed'
-                payment.booking.status = 'confirmed'
-                payment.booking.save()
+            new_status = 'Success' if chapa_status == 'success' else 'Failed'
+            with transaction.atomic():
+                _, created = PaymentEvent.objects.get_or_create(tx_ref=tx_ref, status=new_status)
+                if not created:
+                    return Response({
+                        "status": "duplicate",
+                        "message": "Callback already processed"
+                    })
                 
-                # Send confirmation email
-                send_payment_confirmation_email.delay(payment.id)
-            else:
-                payment.status = 'failed'
-            
-            payment.save()
+                payment_id = Payment.objects.filter(transaction_id=tx_ref).values_list('pk', flat=True).first()
+                if payment_id is None:
+                    # Forget the event so a later delivery for this tx_ref is processed
+                    transaction.set_rollback(True)
+                    return Response({
+                        "error": "Payment not found"
+                    }, status=status.HTTP_404_NOT_FOUND)
+                
+                changed = Payment.objects.filter(pk=payment_id).settle(new_status)
+                if changed and new_status == 'Success':
+                    transaction.on_commit(lambda: send_payment_confirmation_email.delay(payment_id))
             
             return Response({
                 "status": "received",
-                "message": f"Payment status updated to {payment.status}"
+                "message": f"Payment status updated to {new_status}" if changed else "Payment already settled"
             })
             
         except Exception as e:
@@ -261,3 +560,58 @@ class PaymentViewSet(viewsets.ModelViewSet):
             "status": "success",
             "data": serializer.data
         })
+
+
+def prometheus_metrics(request):
+    """
+    Request histograms of this process in the Prometheus text format, for
+    staff or a scraper sending ``Authorization: Bearer <METRICS_TOKEN>``.
+    """
+    token = settings.METRICS_TOKEN
+    bearer = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not request.user.is_staff and not (token and hmac.compare_digest(bearer, token)):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class ExportView(APIView):
+    """
+    Streams every booking or payment with a watermark in (since, until] as
+    CSV or NDJSON, for finance. The X-Export-Watermark header carries the
+    ``until`` to send as ``since`` next time.
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, kind):
+        if kind not in export.EXPORTS:
+            raise Http404
+        params = ExportQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        data = params.validated_data
+        until = data.get('until') or export.default_until()
+
+        _, content_type = export.FORMATS[data['output']]
+        response = StreamingHttpResponse(
+            export.stream(kind, data['output'], since=data.get('since'), until=until),
+            content_type=content_type,
+        )
+        stamp = until.strftime('%Y%m%dT%H%M%S')
+        response['Content-Disposition'] = f'attachment; filename="{kind}-{stamp}.{data["output"]}"'
+        response['X-Export-Watermark'] = until.isoformat()
+        return response
+
+
+class HostAnalyticsView(APIView):
+    """
+    Occupancy, revenue, lead time and ratings of the requesting host's
+    listings over a window of nights, per listing and as a series; see
+    listings.analytics.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        params = AnalyticsQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        data = params.validated_data
+        report = analytics.Report(request.user, data['start'], data['end'], data['interval'])
+        return Response(report.load(data.get('source')).as_dict())